@@ -2,75 +2,235 @@
 File:   analyze_dataset.py
 
 Spec:   This program looks into a directory and analyzes all of, or a subset
-        of, wave files in said directory by calling audio_to_spectro.py
-        via command line args. This program writes to <analyst_logs.csv>, a csv that indicates
-        what files have been previously analyzed and checks to avoid 
-        double analyzing the same file. 
+        of, wave files in said directory by calling audio_to_spectro() from
+        audio_to_spectro.py. This program writes to <analyst_logs.csv>, a csv that indicates
+        what files have been previously analyzed and checks to avoid
+        double analyzing the same file. The log is read once per run (see common/analyst_log.py).
 
-Usage: python3 audio_transform/analyze_dataset.py <dataset/path> -o <output/directory> -c <number of wave files to analyze> 
+        With --workers N the wave files are handed to a pool of N worker processes.
+        Each worker imports matplotlib/scipy/numpy once and then transforms file after file,
+        results (or errors) are sent back to this process which does all of the logging.
+
+        -ch picks the channel, several channels (1,3,5) are read in one pass, and auto picks the
+        channel with the best band SNR for each minute (see audio_to_spectro.py).
+
+        With --stream the files can be any length (see stream_to_spectro() in audio_to_spectro.py).
+
+        -d downsamples the audio to the lowest rate that keeps the band before the FFT (see audio_to_spectro.py).
+
+        --prescreen skips the images without band energy or tonal contours (see prescreen.py),
+        the images it screens out are recorded in the prescreen log.
+
+        With --manifest the wave files are picked from a manifest of their headers (see recording_manifest.py):
+        only new or changed files are looked at, and with one minute files (no --stream) the ones that are not ~60 seconds
+        long are skipped before any audio is opened, so they do not count towards -c.
+
+        With --cache the spectrogram arrays are kept (see spectro_cache.py), so re-rendering
+        files that were analyzed before (ex: with --no_logs) skips the wave read and the STFT.
+
+        --metrics <file.jsonl> records the time spent in each stage (workers send theirs back
+        with their results) and --summary prints it at the end, see common/metrics.py.
+
+Usage: python3 audio_transform/analyze_dataset.py <dataset/path> -o <output/directory> -c <number of wave files to analyze> -w <number of workers>
 '''
 
-import os 
-import argparse 
-import csv 
-import subprocess
-import sys 
+import os
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import audio_to_spectro, stream_to_spectro, parse_channel, desired_channel, decimate, minute_durations
+from audio_transform.spectro_cache import SpectroCache, cache_directory
+from audio_transform.prescreen import Prescreen, record_screened_out, prescreen_logs_path
+from audio_transform.recording_manifest import RecordingManifest, manifest_path
+from common.analyst_log import open_log
+from common import metrics
 
 
 ###################################################################
 # CONFIGURATION DEFAULTS
-audio_to_spectro_path = "audio_transform/audio_to_spectro.py"       # This program is a wrapped for audio_to_spectro 
+spectrogram_logs_path = 'audio_transform/analyst_logs/spectrogram_logs.csv' # .csv or .db/.sqlite, see common/analyst_log.py
 count = 1                                                           # Default number of wave files to analyze
+workers = 1                                                         # Default number of worker processes
+renderer = 'matplotlib'                                             # 'matplotlib' or 'raster', see audio_to_spectro.py
 ###################################################################
-parser = argparse.ArgumentParser()
-parser.add_argument("input_directory", help="process audio in this directory")
-parser.add_argument("-o", "--output", help="choose a location for image outputs") # output directory 
-parser.add_argument("-c","--count", type=int, default = 1, 
-                    help="count specifies the number of audio files to analyze")
-parser.add_argument("--no_logs", action="store_true", help="ignore existing analyst logs and do not write new logs.")
-args = parser.parse_args() # TODO: Allow channel and down sampling as args
-
-if not (args.output):
-    parser.error("Please specify output directory")
-
-if (args.count):
-    count = int(args.count)
-
-i = 0
-for  file in sorted(os.listdir(args.input_directory)):
+
+def select_files(input_directory, count, log=None, manifest=None, durations=None):
+    '''
+    Pick 'count' number of wave files in a given directory that have not been analyzed yet.
+    log is the spectrogram log (common/analyst_log.py), None ignores existing logs.
+    With a RecordingManifest (recording_manifest.py) the directory is rescanned (only new or changed headers are read)
+    and only wave files with a readable header are picked, durations (min, max) also skips the ones outside that range
+    (seconds) without opening them.
+    '''
+    if manifest is not None:
+        read, dropped = manifest.scan([input_directory])
+        manifest.save()
+        print(f"Manifest: {read} new or changed wave files, {dropped} gone")
+        recordings = manifest.recordings(input_directory)
+        candidates = [(os.path.join(input_directory, os.path.basename(recording.path)), recording.duration) for recording in recordings]
+    else:
+        with os.scandir(input_directory) as scan:
+            candidates = sorted((entry.path, None) for entry in scan if entry.name.lower().endswith('.wav') and entry.is_file())
+
+    selected = []
+    for filename, duration in candidates:
+        if (len(selected) >= count):
+            print(f"Max file analysis count [{count}] reached")
+            break
+
+        # Check to see if file has already been analyzed (unless no_logs argument is present)
+        if log is not None and filename in log:
+            print(f"Already analyzed [{filename}]")
+            continue
+
+        if duration is not None and durations is not None and not (durations[0] < duration < durations[1]):
+            print(f"Skipping [{filename}]: {duration:.1f} seconds long")
+            continue
+
+        selected.append(filename)
+
+    return selected
+
+def stream_file(filename, output_directory, renderer=renderer, channel=desired_channel, decimate=decimate, prescreen=None):
+    '''Worker entry point for --stream with a pool: stream one file on its own (nothing is carried between files).'''
+    images = []
+    for _, file_images, error in stream_to_spectro([filename], output_directory, channel, carry_over=False, renderer=renderer,
+                                                   decimate=decimate, prescreen=prescreen):
+        if error is not None:
+            raise error
+        images.extend(file_images)
+    return images
+
+def analyze_file(filename, output_directory, renderer=renderer, stream=False, cache=None, channel=desired_channel, decimate=decimate,
+                 prescreen=None):
+    '''
+    Worker entry point for the pool: returns the image names, the images the prescreen screened out
+    and the stage timings of this file (see common/metrics.py).
     '''
-    Tranform 'count' number of files in a given directory into spectrograms. 
-    Save names into a csv, check csv for doubles. 
+    if stream:
+        images = stream_file(filename, output_directory, renderer, channel, decimate, prescreen)
+    else:
+        images = audio_to_spectro(filename, output_directory, channel, renderer=renderer, cache=cache, decimate=decimate, prescreen=prescreen)
+    return images, prescreen.take() if prescreen is not None else [], metrics.take()
+
+def analyze_files(filenames, output_directory, workers=workers, log=None, renderer=renderer, stream=False, cache=None,
+                  channel=desired_channel, decimate=decimate, prescreen=None, prescreen_log=None):
+    '''
+    Tranform each file into spectrograms, either in this process (workers=1)
+    or in a pool of worker processes. Returns the number of files that failed.
+    With stream=True files can be any length, and with one worker samples left over
+    at the end of a file are carried into the next file when it continues the recording.
+    Files are only recorded in the log (if given) once they were successfully analyzed.
+    cache is an optional SpectroCache (one minute files only, not used with stream).
+    channel is a channel number, a list of channels or an AutoChannel, see parse_channel() in audio_to_spectro.py.
+    decimate downsamples the audio before the FFT, see band_spectrogram() in audio_to_spectro.py.
+    With a Prescreen (prescreen.py) images it screens out are not made, they are recorded in prescreen_log (if given).
     '''
-    filename = os.path.join(args.input_directory, file)
-
-    if os.path.isfile(filename):
-        if (i >= args.count): 
-            print(f"Max file analysis count [{args.count}] reached, exiting...")
-            sys.exit(0)
-
-        with open('audio_transform/analyst_logs/spectrogram_logs.csv', mode='a+', newline='') as spectrogram_logs: 
-            # TODO: if this file doesn't exisit, the program will fail
-            # TODO: only add once the file has been successfully analyzed 
-            spectrogram_logs.seek(0) # Move cursor to the start of the existing data
-            reader = csv.reader(spectrogram_logs)
-
-            # Check to see if file has already been analyzed (unless no_logs argument is present)
-            if not args.no_logs:
-                if any(row == [filename] for row in reader):
-                    print(f"Already analyzed [{filename}]")
-                    continue 
-            
-            # Add filename if it has not yet been analyzed 
-            else: 
-                if not args.no_logs: 
-                    '''Write in the logs if the no_logs argument is not present'''
-                    writer = csv.writer(spectrogram_logs)
-                    writer.writerow([filename])
-                    print(f"Logged [{filename}] as analyzed")
-                i = i + 1 # Only increment i if you have analyzed a file
-                # TODO: print analyzing x/count
-
-                # Analyze the file 
-                subprocess.run(["python3", audio_to_spectro_path, filename, '-o', args.output], stdout=sys.stdout, stderr=sys.stderr)
-        
\ No newline at end of file
+    failures = 0
+
+    def handle_result(n, filename, images, error, screened_out=()):
+        nonlocal failures
+        if prescreen_log is not None:
+            record_screened_out(prescreen_log, screened_out)
+        if error is not None:
+            failures += 1
+            print(f"[{n}/{len(filenames)}] Failed to analyze [{filename}]: {error}")
+            return
+        print(f"[{n}/{len(filenames)}] Analyzed [{filename}] -> {len(images)} images" + (f", {len(screened_out)} screened out" if screened_out else ''))
+        if log is not None:
+            '''Write in the logs if the no_logs argument is not present'''
+            log.record(filename)
+            print(f"Logged [{filename}] as analyzed")
+
+    if stream and workers <= 1:
+        n = 0
+        try:
+            for n, (filename, images, error) in enumerate(stream_to_spectro(filenames, output_directory, channel, renderer=renderer,
+                                                                            decimate=decimate, prescreen=prescreen), start=1):
+                # A file that cannot be read is reported and skipped, the stream goes on with the next one
+                handle_result(n, filename, images, error, prescreen.take() if prescreen is not None else [])
+        except Exception as e:
+            # Anything else stops the stream, the files after it are left for the next run
+            failed_file = getattr(e, 'wave_file_path', None) # Set by stream_to_spectro() when it was making a file's images
+            if failed_file is None:
+                failures += 1
+                print(f"[{n + 1}/{len(filenames)}] Stream stopped: {e}")
+            else:
+                handle_result(n + 1, failed_file, [], e)
+        return failures
+
+    if workers <= 1:
+        for n, filename in enumerate(filenames, start=1):
+            try:
+                images, error = audio_to_spectro(filename, output_directory, channel, renderer=renderer, cache=cache, decimate=decimate,
+                                                 prescreen=prescreen), None
+            except Exception as e:
+                images, error = [], e
+            handle_result(n, filename, images, error, prescreen.take() if prescreen is not None else [])
+        return failures
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=metrics.init_worker) as pool:
+        futures = {pool.submit(analyze_file, filename, output_directory, renderer, stream, cache, channel, decimate, prescreen): filename for filename in filenames}
+        for n, future in enumerate(as_completed(futures), start=1):
+            filename = futures[future]
+            try:
+                (images, screened_out, timings), error = future.result(), None
+                metrics.merge(timings)
+            except Exception as e:
+                images, screened_out, error = [], [], e
+            handle_result(n, filename, images, error, screened_out)
+
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", help="process audio in this directory")
+    parser.add_argument("-o", "--output", help="choose a location for image outputs") # output directory
+    parser.add_argument("-c","--count", type=int, default = count,
+                        help="count specifies the number of audio files to analyze")
+    parser.add_argument("-w", "--workers", type=int, default=workers,
+                        help="number of worker processes used to make spectrograms (default: 1, no pool)")
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to transform: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)")
+    parser.add_argument("-r", "--renderer", choices=['matplotlib', 'raster'], default=renderer, help="how images are drawn, raster is much faster")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="accept audio of any length, carrying left over samples into the next consecutive file")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample to the lowest rate that keeps the band before the FFT")
+    parser.add_argument("--prescreen", action="store_true", help="skip images without band energy or tonal contours (see prescreen.py)")
+    parser.add_argument("--prescreen_log", default=prescreen_logs_path, help="analyst log of the images the prescreen skipped")
+    parser.add_argument("--log", default=spectrogram_logs_path, help="analyst log to check and write (.csv or .db/.sqlite)")
+    parser.add_argument("--no_logs", action="store_true", help="ignore existing analyst logs and do not write new logs.")
+    parser.add_argument("--cache", nargs='?', const=cache_directory,
+                        help=f"read / save spectrogram arrays in a cache directory (default {cache_directory}), see spectro_cache.py")
+    parser.add_argument("--manifest", nargs='?', const=manifest_path,
+                        help=f"pick wave files from a header manifest (default {manifest_path}), see recording_manifest.py")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.output):
+        parser.error("Please specify output directory")
+
+    metrics.start('analyze_dataset', args.metrics, args.summary)
+    log = None if args.no_logs else open_log(args.log)
+    prescreen = Prescreen() if args.prescreen else None
+    prescreen_log = open_log(args.prescreen_log) if args.prescreen and not args.no_logs else None
+    try:
+        manifest = RecordingManifest(args.manifest) if args.manifest else None
+        filenames = select_files(args.input_directory, args.count, log, manifest, None if args.stream else minute_durations)
+        cache = SpectroCache(args.cache) if args.cache else None
+        failures = analyze_files(filenames, args.output, args.workers, log, args.renderer, args.stream, cache, args.channel, args.decimate,
+                                 prescreen, prescreen_log)
+    finally:
+        for open_file in (log, prescreen_log):
+            if open_file is not None:
+                open_file.close()
+        metrics.finish()
+
+    if failures:
+        print(f"{failures} of {len(filenames)} files failed")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,71 @@
 '''
 File:   audio_to_spectro.py
 
-Spec:   Audio to spectro produces two images per one minute of ingested audio. 
-        Each image contains ten, three second spectrogram strips separated by a small 
-        black space. Images are roughly square for optimal performance with YOLO. 
-        Images are not saved in gray scale for YOLO training purposes. 
+Spec:   Audio to spectro produces two images per one minute of ingested audio.
+        Each image contains ten, three second spectrogram strips separated by a small
+        black space. Images are roughly square for optimal performance with YOLO.
+        Images are not saved in gray scale for YOLO training purposes.
 
-I/O:    This program expects one minute audio inputs. 
+I/O:    This program expects one minute audio inputs.
         This program outputs spetrograms images containing ten spectrogram strips.
         Spectrograms do not overlap each other.
-        This program currently can ONLY ingest 1 minute audio inputs. 
+        Without --stream this program can ONLY ingest 1 minute audio inputs.
+        With --stream audio of any length is read 30 seconds at a time and every full
+        30 seconds becomes an image named <audio>-<first strip number>, ex: -0001, -0011, -0021 ...
+
+        Several channels are read in one pass over the file and transformed in one vectorized STFT:
+            -ch 1,3,5       images of every listed channel, each in its own ch<N> sub directory
+            -ch auto        images of the channel with the best band SNR (freq_min - freq_max, see
+                            band_snr()) picked per minute (per 30 second image with --stream),
+                            auto:1,3,5 only picks among those channels
+
+        Only freq_min - freq_max is kept, so most of a 1024 point FFT at the recorder's rate goes to bins
+        that are thrown away. --decimate first low pass filters and downsamples the audio by a factor D
+        (polyphase FIR, scipy.signal.upfirdn) to the lowest rate that keeps the band with room for a short
+        filter (see decimation_factor()), then runs fft_size / D point FFTs with a hop of 896 / D: the same
+        frequency bins and segment times, so the images match the full rate ones. It pays off on high
+        rate recordings (ex: 2x less CPU at 384 kHz), 48 kHz audio is left as it is
+        (benchmarks/bench_decimation.py measures both).
 
 Usage:  python3 audio_transform/audio_to_spectro.py <path/to/audio.wave> -o <output/directory>
 
-Optioanal Args: -ch allows for channel selections: default channel is 5
+        Or from python (this is how analyze_dataset.py runs it):
+            from audio_transform.audio_to_spectro import audio_to_spectro
+            image_names = audio_to_spectro("path/to/audio.wav", "output/directory")
+
+Optioanal Args: -ch allows for channel selections: default channel is 5, also 1,3,5 or auto (see above)
+                --fft_workers sets the number of FFT threads: default is 1
+                -r raster draws images with NumPy instead of matplotlib: default is matplotlib
+                -s streams audio of any length
+                --prescreen skips images without band energy or tonal contours (see prescreen.py)
+                -d decimates the audio to the lowest rate that keeps the band before the FFT (see above)
+                --cache [directory] keeps the spectrogram arrays so a re-render skips the read and STFT (see spectro_cache.py)
+                --metrics <file.jsonl> records the time spent per stage, --summary prints it (see common/metrics.py)
 '''
 
+import matplotlib
+matplotlib.use('Agg') # Images are only ever written to disk, this also keeps worker processes display free
 import matplotlib.pyplot as plt
 import os
-from scipy.signal import spectrogram, get_window
-from scipy.io import wavfile
+from scipy.signal import get_window, kaiserord, firwin, upfirdn
+from scipy.fft import rfft, rfftfreq
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from functools import lru_cache
+from collections import namedtuple
+from datetime import timedelta
 import argparse
-import sys 
+import struct
+import sys
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.raster_render import render_strips, save_image
+from audio_transform.wav_reader import read_wav_header, read_channel, read_channels
+from audio_transform.spectro_cache import SpectroCache, cache_directory
+from common.strip_geometry import strips_per_image
+from common.file_names import recording_start_time, image_name
+from common import metrics
 
 
 
@@ -31,104 +74,514 @@ import sys
 output_directory = 'images'
 desired_channel = 5             # Which channel do you want? 5 is default b/c it is furthest from the boat
 chunk_duration = 3              # Number of seconds represented in each pane of the spectrogram
-freq_min = 3500                 # Spectrogram strip's minimum sampled frequency 
-freq_max = 9500                 # Spectrogram strip's maximum sampled frequency 
+freq_min = 3500                 # Spectrogram strip's minimum sampled frequency
+freq_max = 9500                 # Spectrogram strip's maximum sampled frequency
 plot_min = 4000                 # Spectrogram strip's minumum DISPLAYED frequency
 plot_max = 9000                 # Spectrogram strip's maximum DISPLAYED frequency
+fft_size = 1024                 # Number of samples per FFT segment
+fft_workers = 1                 # Number of threads used by scipy.fft, -1 uses every core
+renderer = 'matplotlib'         # 'matplotlib' (pcolormesh + savefig) or 'raster' (NumPy image, see raster_render.py)
+max_gap = 1.5                   # Seconds between the end of one file and the start of the next that still counts as one recording (streaming)
+snr_percentile = 99             # Channel auto: a frequency bin's signal level is this percentile of its values, its noise floor the median
+decimate = False                # Downsample before the FFT (-d), see decimation_factor()
+band_margin = 2.5               # Decimating keeps the Nyquist frequency at least this many times freq_max, see decimation_factor()
+filter_attenuation = 60         # dB the decimation filter takes off everything that would fold into the band
+minute_durations = (58, 62)     # audio_to_spectro() only transforms files longer than the first and shorter than the second (seconds)
 ###################################################################
-# Accept command line inputs
-parser = argparse.ArgumentParser()
-parser.add_argument("wave_file_path", help="process this file from audio to spectrograms")
-parser.add_argument("-o", "--output", help="choose a location for image outputs") # Output directory 
-parser.add_argument("-ch", "--channel", help="select an audio channel to transform") #Channel 
-args = parser.parse_args() 
-
-# Use arguement values if they exist
-if (args.output):
-    output_directory = args.output 
-if (args.channel):
-    desired_channel = int(args.channel)
-
-print(f"\nMetadata for [{args.wave_file_path}]:")
-audio_file_name = os.path.basename(args.wave_file_path)[:-4]    # Get the name of the audio 
-print(f"Audio name: [{audio_file_name}]")
-
-try:
-    sample_rate, data = wavfile.read(args.wave_file_path)       # Read audio file
-except ValueError:
-    print("Invalid input file type. Supported file type(s): .wav")
-    sys.exit(1)
-
-print(f"Sample rate = {sample_rate}")
-
-# Select a channel if multiple 
-if len(data.shape) > 1:
-    print(f"number of channels = {data.shape[1]}")
-    print(f"sampling from channel: {desired_channel}")
-    data = data[:, desired_channel]  # Select desired channel
-else:
-    print(f"number of channels = 1")
-
-length = data.shape[0] / sample_rate    # Original sample rate 
-if not (58 < length < 62): # Make sure length is 60 seconds for now! 
-    print(f"Length not ~60 second, undefined behavior... exiting")
-    sys.exit(0)
-print(f"length (seconds) = {length}")
-
-# Determine the number of whole 3 second chunks
-samples_per_chunk = int(sample_rate * chunk_duration)
-num_chunks = int(len(data) / samples_per_chunk)
-print(f"num chunks = {num_chunks}")
-
-all_chunks = [] 
-for i in range(num_chunks):
-    start_sample = i * samples_per_chunk
-    end_sample = start_sample + samples_per_chunk
-    chunk_data = data[ start_sample : end_sample ]
-    all_chunks.append(chunk_data)
+
+Block = namedtuple('Block', ['wave_file_path', 'audio_file_name', 'first_strip', 'samples', 'sample_rate', 'channels', 'error'],
+                   defaults=(None, None))
+AutoChannel = namedtuple('AutoChannel', ['candidates']) # -ch auto: the best band SNR among candidates (None: every channel)
+
+def parse_channel(text):
+    '''
+    The -ch argument: a channel (5), several channels (1,3,5), 'auto' or 'auto:1,3,5'.
+    Returns an int, a list of ints or an AutoChannel.
+    '''
+    text = str(text).strip().lower()
+    auto = text.startswith('auto')
+    if auto:
+        text = text[4:].lstrip(':')
+    try:
+        channels = [int(channel) for channel in text.split(',')] if text else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid channel [{text}], use a number, a list like 1,3,5, auto or auto:1,3,5")
+    if auto:
+        return AutoChannel(channels)
+    if channels is None:
+        raise argparse.ArgumentTypeError("no channel given")
+    return channels[0] if len(channels) == 1 else channels
+
+def file_channels(channel, info):
+    '''The channels of a file to read for a -ch value (see parse_channel()), a single channel file only has channel 0.'''
+    if info.channels == 1:
+        return [0]
+    if isinstance(channel, AutoChannel):
+        return list(channel.candidates) if channel.candidates else list(range(info.channels))
+    return list(channel) if isinstance(channel, (list, tuple)) else [channel]
+
+def image_directory(output_directory, subdirectory=None):
+    '''output_directory, or its (created) sub directory for the images of one channel of several.'''
+    if subdirectory is None:
+        return output_directory
+    directory = os.path.join(output_directory, subdirectory)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def spectro_path(audio_file_name, first_strip, output_directory=output_directory):
+    '''Where the image starting at strip number 'first_strip' (0 based) of a recording is saved.'''
+    return os.path.join(output_directory, f"{image_name(audio_file_name, first_strip)}.jpg")
+
+def load_header(wave_file_path):
+    '''
+    Read (only) the header of a wave file and print its metadata.
+    Raises ValueError if the file is not a valid wave file.
+    '''
+    try:
+        with metrics.stage('wav_header'):
+            info = read_wav_header(wave_file_path)
+    except (ValueError, struct.error):
+        raise ValueError("Invalid input file type. Supported file type(s): .wav")
+
+    print(f"Sample rate = {info.sample_rate}")
+    print(f"number of channels = {info.channels}")
+    print(f"sample type = {info.bits_per_sample} bit {info.dtype or 'int24'}")
+    print(f"length (seconds) = {info.duration}")
+    return info
+
+def load_audio(wave_file_path, channel=desired_channel, info=None):
+    '''
+    Return the sample rate and the samples of a single channel of a wave file.
+    The file is memory mapped so only the selected channel is copied into RAM.
+    '''
+    info = info or load_header(wave_file_path)
+
+    # Select a channel if multiple
+    if info.channels > 1:
+        print(f"sampling from channel: {channel}")
+    else:
+        channel = 0
+    with metrics.stage('wav_read'):
+        return read_channel(wave_file_path, channel, info=info)
+
+def load_channels(wave_file_path, channels, info=None):
+    '''
+    Return the sample rate and a (len(channels), samples) array of several channels of a wave file.
+    Every channel is copied out of the memory map in the same pass over the file.
+    '''
+    info = info or load_header(wave_file_path)
+    if info.channels > 1:
+        print(f"sampling from channel{'s' if len(channels) > 1 else ''}: {', '.join(map(str, channels))}")
+    with metrics.stage('wav_read'):
+        return read_channels(wave_file_path, channels, info=info)
+
+def split_chunks(data, sample_rate):
+    '''
+    Split the audio into whole 3 second chunks, left over samples are dropped.
+    Returns a (num_chunks, samples_per_chunk) view of the data (no copy),
+    or (channels, num_chunks, samples_per_chunk) for (channels, samples) data.
+    '''
+    samples_per_chunk = int(sample_rate * chunk_duration)
+    num_chunks = int(data.shape[-1] / samples_per_chunk)
+    print(f"num chunks = {num_chunks}")
+
+    return data[..., :num_chunks * samples_per_chunk].reshape(*data.shape[:-1], num_chunks, samples_per_chunk)
+
+@lru_cache(maxsize=8)
+def stft_setup(sample_rate, samples_per_chunk, fft_size=fft_size):
+    '''
+    Everything about the STFT that only depends on the sample rate and FFT size.
+    Cached so the window and frequency slice are built once per recording format.
+    Mirrors scipy.signal.spectrogram defaults: 1/8 overlap, constant detrend, one sided density scaling.
+    The window and scale are float32 like the segments they are applied to (see batch_spectrogram()).
+    '''
+    window = get_window("hann", fft_size).astype(np.float32)
+    step = fft_size - fft_size // 8
+    num_segments = (samples_per_chunk - fft_size) // step + 1
+
+    f = rfftfreq(fft_size, 1 / sample_rate)
+    freq_bins = np.flatnonzero((f >= freq_min) & (f <= freq_max))
+    freq_slice = slice(freq_bins[0], freq_bins[-1] + 1)
+    t = np.arange(fft_size / 2, fft_size / 2 + num_segments * step, step) / sample_rate
+
+    # Density scaling, one sided spectra count every bin twice except DC and Nyquist
+    scale = np.full(len(f), 2.0 / (sample_rate * (window * window).sum()))
+    scale[0] /= 2
+    if fft_size % 2 == 0:
+        scale[-1] /= 2
+
+    return window, step, f[freq_slice], t, freq_slice, scale[freq_slice].astype(np.float32)
+
+def decimation_factor(sample_rate, fft_size=fft_size):
+    '''
+    Largest factor D the audio can be downsampled by before the STFT: sample_rate / D keeps its Nyquist frequency
+    at least band_margin * freq_max, and the FFT size, its hop and a chunk stay whole numbers of samples, so
+    fft_size / D points at sample_rate / D give the same frequency bins and segment times. 1 if there is none.
+    The margin gives the filter a wide transition band so it stays short: downsampling right to the band
+    (band_margin near 1) needs a filter that costs more than the FFT work it saves.
+    '''
+    factor = 1
+    for candidate in range(2, fft_size // 8 + 1):
+        if (sample_rate / candidate / 2 >= band_margin * freq_max and fft_size % (8 * candidate) == 0
+                and (sample_rate * chunk_duration) % candidate == 0):
+            factor = candidate
+    return factor
+
+@lru_cache(maxsize=8)
+def decimation_filter(sample_rate, factor):
+    '''
+    Linear phase low pass FIR (Kaiser window) for downsampling by factor: flat up to freq_max and filter_attenuation dB
+    down from sample_rate / factor - freq_max (the lowest frequency that folds into the band) up.
+    Its length is rounded up so its delay is a whole number of output samples.
+    '''
+    numtaps, beta = kaiserord(filter_attenuation, (sample_rate / factor - 2 * freq_max) / (sample_rate / 2))
+    numtaps = 2 * factor * -(-(numtaps - 1) // (2 * factor)) + 1
+    return firwin(numtaps, 1 / factor, window=('kaiser', beta)).astype(np.float32)
+
+def decimate_samples(data, sample_rate, factor):
+    '''Low pass filter and keep every factor-th sample of ([channels,] samples) audio, returns the new rate and samples.'''
+    if factor == 1:
+        return sample_rate, data
+    with metrics.stage('decimate'):
+        taps = decimation_filter(sample_rate, factor)
+        delay = (len(taps) - 1) // 2 // factor
+        # Polyphase: only the kept samples are computed, float32 halves the memory traffic here and in the STFT
+        filtered = upfirdn(taps, data.astype(np.float32), 1, factor, axis=-1)
+        return sample_rate // factor, filtered[..., delay : delay + data.shape[-1] // factor]
+
+def band_spectrogram(data, sample_rate, fft_workers=fft_workers, decimate=decimate):
+    '''f, t, Sxx_db of every whole chunk of ([channels,] samples) audio, downsampled first with decimate (see decimation_factor()).'''
+    factor = decimation_factor(sample_rate) if decimate else 1
+    if factor > 1 and data.ndim > 1:
+        # One channel at a time, like the FFT (see batch_spectrogram()), so the filter's copies are of one channel
+        spectrograms = [band_spectrogram(channel_data, sample_rate, fft_workers, decimate) for channel_data in data]
+        f, t, _ = spectrograms[0]
+        return f, t, np.stack([Sxx_db for _, _, Sxx_db in spectrograms])
+    sample_rate, data = decimate_samples(data, sample_rate, factor)
+    return batch_spectrogram(split_chunks(data, sample_rate), sample_rate, fft_size // factor, fft_workers)
+
+def band_power_db(chunks, window, step, freq_slice, scale, fft_workers):
+    '''(num_chunks, num_segments, len(freq_slice)) dB power of the chunks of one channel, see batch_spectrogram().'''
+    # (num_chunks, num_segments, fft_size) strided view, copied once as float32, then detrend and window each segment
+    segments = sliding_window_view(chunks, len(window), axis=-1)[..., ::step, :].astype(np.float32)
+    segments -= segments.mean(axis=-1, keepdims=True)
+    segments *= window
+
+    # The full spectra are dropped as soon as the band bins are out of them
+    spectra = rfft(segments, axis=-1, workers=fft_workers)[..., freq_slice]
+    Sxx = spectra.real**2 + spectra.imag**2
+    Sxx *= scale
+    Sxx += 1e-10
+    return 10 * np.log10(Sxx)
+
+def batch_spectrogram(chunks, sample_rate, fft_size=fft_size, fft_workers=1):
+    '''
+    Compute the band limited spectrogram of every chunk in one vectorized call.
+    chunks is a (num_chunks, samples_per_chunk) array, see split_chunks(), or (channels, num_chunks,
+    samples_per_chunk) to transform several channels.
+    Returns f, t and float32 Sxx_db with shape (num_chunks, len(f), len(t)) (channels first if given), matching
+    a per chunk scipy.signal.spectrogram() call followed by the freq_min - freq_max slice to float32 precision.
+    Channels are transformed one at a time in float32 and only their band bins are kept, so the memory the
+    FFT needs is that of one channel however many are selected.
+    '''
+    with metrics.stage('stft'):
+        window, step, f, t, freq_slice, scale = stft_setup(sample_rate, chunks.shape[-1], fft_size)
+        channel_chunks = chunks.reshape(-1, *chunks.shape[-2:])
+        Sxx_db = np.empty((len(channel_chunks), chunks.shape[-2], len(t), len(f)), dtype=np.float32)
+        for channel_db, chunks_of_channel in zip(Sxx_db, channel_chunks):
+            channel_db[:] = band_power_db(chunks_of_channel, window, step, freq_slice, scale, fft_workers)
+    return f, t, Sxx_db.reshape(*chunks.shape[:-1], len(t), len(f)).swapaxes(-1, -2)
+
+def channel_spectrograms(wave_file_path, channels, info=None, fft_workers=fft_workers, cache=None, decimate=decimate):
+    '''
+    f, t, Sxx_db of every whole 3 second chunk of several channels of a wave file, Sxx_db has shape
+    (len(channels), num_chunks, len(f), len(t)). The file is read once for every channel, then
+    batch_spectrogram() transforms the channels one after the other.
+    With a SpectroCache (spectro_cache.py) a channel is read from the cache when this file, channel,
+    FFT size and band were transformed before, only the missing channels are computed and added to the cache.
+    decimate downsamples the audio before the FFT, see band_spectrogram().
+    '''
+    info = info or load_header(wave_file_path)
+    spectrograms = {}
+    if cache is not None:
+        effective_fft_size = fft_size // decimation_factor(info.sample_rate) if decimate else fft_size # Decimated spectrograms are cached apart
+        keys = {channel: cache.key(wave_file_path, channel, effective_fft_size, freq_min, freq_max) for channel in channels}
+        for channel in channels:
+            cached = cache.get(keys[channel])
+            if cached is not None:
+                print(f"Spectrogram read from cache [{cache.path(keys[channel])}]")
+                spectrograms[channel] = cached
+
+    missing = [channel for channel in channels if channel not in spectrograms]
+    if missing:
+        sample_rate, data = load_channels(wave_file_path, missing, info)
+        f, t, Sxx_db = band_spectrogram(data, sample_rate, fft_workers, decimate)
+        for channel, channel_db in zip(missing, Sxx_db):
+            spectrograms[channel] = (f, t, channel_db)
+            if cache is not None:
+                cache.put(keys[channel], f, t, channel_db)
+
+    f, t, _ = spectrograms[channels[0]]
+    return f, t, np.stack([spectrograms[channel][2] for channel in channels])
+
+def file_spectrogram(wave_file_path, channel=desired_channel, info=None, fft_workers=fft_workers, cache=None, decimate=decimate):
+    '''f, t, Sxx_db of every whole 3 second chunk of one channel of a wave file, see channel_spectrograms().'''
+    info = info or load_header(wave_file_path)
+    f, t, Sxx_db = channel_spectrograms(wave_file_path, file_channels(channel, info)[:1], info, fft_workers, cache, decimate)
+    return f, t, Sxx_db[0]
+
+def band_snr(Sxx_db):
+    '''
+    Band SNR (dB) of each channel of a (channels, num_chunks, freq, time) spectrogram: for every frequency
+    bin the snr_percentile of its values over its median (the noise floor), averaged over the band.
+    Whistles lift the top values of the bins they sweep through, steady broadband noise (ex: the boat) lifts the floor.
+    '''
+    channels, _, num_freqs, _ = Sxx_db.shape
+    values = Sxx_db.transpose(0, 2, 1, 3).reshape(channels, num_freqs, -1)
+    floor, peak = np.percentile(values, [50, snr_percentile], axis=-1)
+    return (peak - floor).mean(axis=-1)
+
+def select_channels(Sxx_db, channels, channel):
+    '''
+    Which of the spectrograms of several channels (see channel_spectrograms()) become images for a -ch value.
+    Returns a list of (channel, its Sxx_db, sub directory or None): for auto only the channel with the best
+    band SNR, for a list of channels every channel into its own ch<N> sub directory.
+    '''
+    if len(channels) == 1:
+        return [(channels[0], Sxx_db[0], None)]
+    if isinstance(channel, AutoChannel):
+        with metrics.stage('channel_select'):
+            snr = band_snr(Sxx_db)
+        best = int(np.argmax(snr))
+        print(f"Channel auto: {channels[best]} (band SNR " + ", ".join(f"{c}: {s:.1f}" for c, s in zip(channels, snr)) + " dB)")
+        return [(channels[best], Sxx_db[best], None)]
+    return [(channel_number, channel_db, f"ch{channel_number}") for channel_number, channel_db in zip(channels, Sxx_db)]
 
 ## Create Spectrograms
-def make_spectro(num_rows=10, which_plot=0): 
-    fig, axes = plt.subplots(
-        nrows=num_rows, 
-        ncols=1, figsize=(8, 5),
-        facecolor='black',
-        gridspec_kw={'hspace': -0.5},
-        constrained_layout=True)
-    
-    fig.patch.set_facecolor('black')
-
-
-    for i in range(num_rows):
-        # Compute spectrogram
-        fft_size = 1024
-        hop_size = fft_size // 2
-        window = get_window("hann", fft_size)
-
-                                            # 10 spectros to a plot, if 2nd  spectro grab 10 - 19
-        f, t, Sxx = spectrogram(all_chunks[i + which_plot*10], fs=sample_rate,  window=window, nperseg=fft_size, scaling='density')
-
-        fmin, fmax = freq_min, freq_max
-        freq_slice = np.where((f >= fmin) & (f <= fmax))
-        f = f[freq_slice]
-        Sxx = Sxx[freq_slice, :][0]
-
-        Sxx_db = 10 * np.log10(Sxx + 1e-10)
-
-        # Plot
-        ax = axes[i]
-        #ax.set_facecolor('black')  # Set each subplot background to black
-        pcm = ax.pcolormesh(t, f, Sxx_db, shading='gouraud', cmap=plt.cm.binary)
-        ax.set_ylim(plot_min, plot_max)
-        ax.axis('off')
-
-
-    base_name=audio_file_name + '-' + str("{:04}".format(which_plot*10 + 1)) 
-    image_name = os.path.join(output_directory, f"{base_name}.jpg")
-    plt.savefig(image_name, bbox_inches='tight', pad_inches=0, dpi=300)
-    plt.close()
-    print(f"Saved {image_name}") 
-
-# Make two spectrograms with the input data # TODO: generalize to any # of spectrograms
-make_spectro(10, 0)
-make_spectro(10, 1)
+def encode_spectro(f, t, Sxx_db, image_format='jpg'):
+    '''Plot each strip in Sxx_db (normally ten) as stacked spectrogram strips with matplotlib, returns the encoded image bytes.'''
+    num_rows = len(Sxx_db)
+
+    with metrics.stage('render'):
+        fig, axes = plt.subplots(
+            nrows=num_rows,
+            ncols=1, figsize=(8, 5),
+            facecolor='black',
+            gridspec_kw={'hspace': -0.5},
+            constrained_layout=True)
+
+        fig.patch.set_facecolor('black')
+
+
+        for i in range(num_rows):
+            # Plot
+            ax = axes[i]
+            #ax.set_facecolor('black')  # Set each subplot background to black
+            pcm = ax.pcolormesh(t, f, Sxx_db[i], shading='gouraud', cmap=plt.cm.binary)
+            ax.set_ylim(plot_min, plot_max)
+            ax.axis('off')
+
+
+    # savefig draws the figure and encodes it, written to memory so the disk write is timed on its own
+    with metrics.stage('encode'):
+        encoded = io.BytesIO()
+        plt.savefig(encoded, format=image_format, bbox_inches='tight', pad_inches=0, dpi=300)
+        plt.close(fig)
+    return encoded.getbuffer()
+
+def make_spectro(f, t, Sxx_db, image_name, renderer=renderer):
+    '''Plot each strip in Sxx_db (normally ten) as stacked spectrogram strips and save them as one image, returns the image name.'''
+    metrics.count('images')
+
+    if renderer == 'raster':
+        with metrics.stage('render'):
+            image = render_strips(f, t, Sxx_db, plot_min, plot_max)
+        save_image(image, image_name)
+        print(f"Saved {image_name}")
+        return image_name
+
+    encoded = encode_spectro(f, t, Sxx_db, os.path.splitext(image_name)[1][1:])
+    with metrics.stage('write'):
+        with open(image_name, 'wb') as image_file:
+            image_file.write(encoded)
+    print(f"Saved {image_name}")
+    return image_name
+
+def audio_to_spectro(wave_file_path, output_directory=output_directory, channel=desired_channel, fft_workers=fft_workers, renderer=renderer,
+                     cache=None, decimate=decimate, prescreen=None):
+    '''
+    Turn one minute of audio into two ten strip spectrogram images (per channel for a list of channels).
+    channel is a channel number, a list of channels or an AutoChannel, see parse_channel().
+    Returns a list of the saved image names (empty if the audio is not ~60 seconds long).
+    cache is an optional SpectroCache, see channel_spectrograms(), decimate downsamples before the FFT (see band_spectrogram()).
+    With a Prescreen (prescreen.py) images it screens out are not made.
+    '''
+    print(f"\nMetadata for [{wave_file_path}]:")
+    audio_file_name = os.path.basename(wave_file_path)[:-4]    # Get the name of the audio
+    print(f"Audio name: [{audio_file_name}]")
+
+    info = load_header(wave_file_path)
+    if not (minute_durations[0] < info.duration < minute_durations[1]): # Make sure length is 60 seconds for now! (checked before reading any samples)
+        print(f"Length not ~60 second, undefined behavior... skipping")
+        return []
+
+    channels = file_channels(channel, info)
+    f, t, Sxx_all = channel_spectrograms(wave_file_path, channels, info, fft_workers, cache, decimate)
+
+    # Make two spectrograms with the input data, 10 spectros to a plot, 2nd spectro grabs 10 - 19
+    image_names = []
+    for _, Sxx_db, subdirectory in select_channels(Sxx_all, channels, channel):
+        directory = image_directory(output_directory, subdirectory)
+        for which_plot in range(2):
+            strips, image_path = Sxx_db[which_plot*10 : (which_plot + 1)*10], spectro_path(audio_file_name, which_plot*10, directory)
+            if prescreen is None or prescreen.keep(f, strips, image_path):
+                image_names.append(make_spectro(f, t, strips, image_path, renderer))
+    metrics.count('files')
+    return image_names
+
+def stream_blocks(wave_file_paths, channel=desired_channel, carry_over=True, block_strips=strips_per_image):
+    '''
+    Read recordings of any length one image (30 seconds) at a time, memory use does not depend on file size.
+    Yields Block(wave_file_path, audio_file_name, first_strip, samples, sample_rate, channels) for every full block.
+    For a list of channels or an AutoChannel (see parse_channel()) every channel needed is read in the same pass,
+    samples is then a (len(channels), block samples) array, otherwise the samples of the one channel (channels None).
+    Image names are anchored to the recording the block's first sample came from: with carry_over, samples
+    left over at the end of a file are completed with the start of the next file if that file continues
+    the recording (it starts where the previous one ended), so the strips keep counting up from the earlier file.
+    Once a file has been fully read a Block with samples=None is yielded for it. A file that cannot be read
+    (not a wave file, a missing channel, ...) is reported and skipped: its end Block carries the exception as
+    error, samples left over from the file before it are dropped and the next file starts a new recording.
+    '''
+    leftover = None             # Samples that did not fill a whole block
+    anchor = None               # (audio file name, first strip of the next block) used to name images
+    expected_start = None       # When the next file should start to continue the current recording
+    multichannel = isinstance(channel, (AutoChannel, list, tuple))
+
+    for wave_file_path in wave_file_paths:
+        audio_file_name = os.path.basename(wave_file_path)[:-4]
+        try:
+            info = load_header(wave_file_path)
+            block_samples = int(info.sample_rate * chunk_duration) * block_strips
+            channels = file_channels(channel, info)
+            try:
+                start_time = recording_start_time(audio_file_name, milliseconds=True)
+            except ValueError:
+                start_time = None
+
+            continues = (carry_over and leftover is not None and leftover.shape[-1] and start_time is not None and expected_start is not None
+                         and info.sample_rate == leftover_rate and channels == leftover_channels
+                         and abs((start_time - expected_start).total_seconds()) <= max_gap)
+            if not continues:
+                if leftover is not None and leftover.shape[-1]:
+                    print(f"Dropping {leftover.shape[-1] / leftover_rate:.2f} left over seconds of [{anchor[0]}]")
+                leftover = np.empty((len(channels), 0) if multichannel else 0, dtype=info.dtype or np.int32)
+                leftover_rate, leftover_channels = info.sample_rate, channels
+                anchor = (audio_file_name, 0)
+
+            position = 0
+            while True:
+                needed = block_samples - leftover.shape[-1]
+                with metrics.stage('wav_read'):
+                    if multichannel:
+                        _, samples = read_channels(wave_file_path, channels, start_frame=position, num_frames=needed, info=info)
+                    else:
+                        _, samples = read_channel(wave_file_path, channels[0], start_frame=position, num_frames=needed, info=info)
+                    position += samples.shape[-1]
+                    if leftover.shape[-1]:
+                        samples = np.concatenate([leftover, samples], axis=-1)
+                if samples.shape[-1] < block_samples:
+                    leftover = samples
+                    break
+                yield Block(wave_file_path, anchor[0], anchor[1], samples, info.sample_rate, channels if multichannel else None)
+                leftover = samples[..., :0]
+                anchor = (anchor[0], anchor[1] + block_strips)
+        except Exception as e:
+            print(f"Skipping [{wave_file_path}]: {e}")
+            if leftover is not None and leftover.shape[-1]:
+                print(f"Dropping {leftover.shape[-1] / leftover_rate:.2f} left over seconds of [{anchor[0]}]")
+            leftover, expected_start = None, None
+            yield Block(wave_file_path, audio_file_name, None, None, None, error=e)
+            continue
+
+        if start_time is not None:
+            expected_start = start_time + timedelta(seconds=info.duration)
+        yield Block(wave_file_path, audio_file_name, None, None, info.sample_rate)
+
+    if leftover is not None and leftover.shape[-1]:
+        print(f"Dropping {leftover.shape[-1] / leftover_rate:.2f} left over seconds of [{anchor[0]}]")
+
+def block_spectrograms(block, channel=desired_channel, fft_workers=fft_workers, decimate=decimate):
+    '''f, t and a list of (Sxx_db, sub directory or None), one per image to make from a stream Block, see select_channels().'''
+    f, t, Sxx_db = band_spectrogram(block.samples, block.sample_rate, fft_workers, decimate)
+    if block.channels is None:
+        return f, t, [(Sxx_db, None)]
+    return f, t, [(channel_db, subdirectory) for _, channel_db, subdirectory in select_channels(Sxx_db, block.channels, channel)]
+
+def stream_to_spectro(wave_file_paths, output_directory=output_directory, channel=desired_channel, carry_over=True,
+                      fft_workers=fft_workers, renderer=renderer, decimate=decimate, prescreen=None):
+    '''
+    Turn recordings of any length into ten strip spectrogram images, see stream_blocks().
+    Yields (wave_file_path, image names, error) as each file is finished, images made from samples
+    carried over into the next file belong to that next file. Images a Prescreen screens out are not made.
+    error is None, or the exception of a file that could not be read (the stream goes on with the next file).
+    Anything else that goes wrong (ex: an image cannot be written) stops the stream, the exception raised
+    then has the path of the file whose images were being made as its wave_file_path attribute.
+    '''
+    image_names = []
+    for block in stream_blocks(wave_file_paths, channel, carry_over):
+        if block.samples is None:
+            if block.error is None:
+                metrics.count('files')
+            yield block.wave_file_path, image_names, block.error
+            image_names = []
+            continue
+
+        try:
+            f, t, spectrograms = block_spectrograms(block, channel, fft_workers, decimate)
+            for Sxx_db, subdirectory in spectrograms:
+                image_path = spectro_path(block.audio_file_name, block.first_strip, image_directory(output_directory, subdirectory))
+                if prescreen is None or prescreen.keep(f, Sxx_db, image_path):
+                    image_names.append(make_spectro(f, t, Sxx_db, image_path, renderer))
+        except Exception as e:
+            e.wave_file_path = block.wave_file_path
+            raise
+
+def main():
+    # Accept command line inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wave_file_path", help="process this file from audio to spectrograms")
+    parser.add_argument("-o", "--output", default=output_directory, help="choose a location for image outputs") # Output directory
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to transform: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)") #Channel
+    parser.add_argument("--fft_workers", type=int, default=fft_workers, help="number of threads used for the FFTs (-1 uses every core)")
+    parser.add_argument("-r", "--renderer", choices=['matplotlib', 'raster'], default=renderer, help="how images are drawn, raster is much faster")
+    parser.add_argument("-s", "--stream", action="store_true", help="accept audio of any length, one image per 30 seconds")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample to the lowest rate that keeps the band before the FFT")
+    parser.add_argument("--prescreen", action="store_true", help="skip images without band energy or tonal contours (see prescreen.py)")
+    parser.add_argument("--cache", nargs='?', const=cache_directory,
+                        help=f"read / save the spectrogram arrays in a cache directory (default {cache_directory}), not used with --stream")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start('audio_to_spectro', args.metrics, args.summary)
+    prescreen = None
+    if args.prescreen:
+        from audio_transform.prescreen import Prescreen # prescreen.py imports this file
+        prescreen = Prescreen()
+    try:
+        if args.stream:
+            for _, _, error in stream_to_spectro([args.wave_file_path], args.output, args.channel, False, args.fft_workers, args.renderer,
+                                                 args.decimate, prescreen):
+                if error is not None:
+                    sys.exit(1)
+        else:
+            cache = SpectroCache(args.cache) if args.cache else None
+            audio_to_spectro(args.wave_file_path, args.output, args.channel, args.fft_workers, args.renderer, cache, args.decimate, prescreen)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
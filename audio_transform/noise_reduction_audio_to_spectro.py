@@ -1,25 +1,36 @@
 '''
-File:   audio_to_spectro.py
+File:   noise_reduction_audio_to_spectro.py
 
-Spec:   Try eliminating noise by requiring a minumum threshold to plot data. 
+Spec:   Try eliminating noise by requiring a minumum threshold to plot data.
+        Reading, chunking, the STFT and plotting are shared with audio_to_spectro.py,
+        only the threshold step is unique to this program.
+        With --cache the spectrogram arrays are kept (see spectro_cache.py), so trying
+        another threshold on the same recording skips the wave read and the STFT.
 
-I/O:    This program expects one minute audio inputs. 
+I/O:    This program expects one minute audio inputs.
         This program outputs spetrograms images containing ten spectrogram strips.
         Spectrograms do not overlap each other.
-        This program currently can ONLY ingest 1 minute audio inputs. 
+        This program currently can ONLY ingest 1 minute audio inputs.
 
-Usage:  python3 audio_transform/audio_to_spectro.py <path/to/audio.wave> -o <output/directory>
+Usage:  python3 audio_transform/noise_reduction_audio_to_spectro.py <path/to/audio.wave> -o <output/directory>
 
-Optional Args: -ch allows for channel selections
+Optional Args: -ch allows for channel selections, also several (1,3,5) or auto (see audio_to_spectro.py)
+               -r raster draws images with NumPy instead of matplotlib: default is matplotlib
+               -d decimates the audio to the lowest rate that keeps the band before the FFT
+               -t sets the threshold (dB): default is 1.0
+               --cache [directory] reads / saves spectrogram arrays in a cache
+               --metrics <file.jsonl> / --summary record and print the time spent per stage
 '''
 
-import matplotlib.pyplot as plt
 import os
-from scipy.signal import spectrogram, get_window
-from scipy.io import wavfile
-import numpy as np
 import argparse
-import sys 
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import (load_header, channel_spectrograms, file_channels, select_channels, image_directory,
+                                              make_spectro, spectro_path, parse_channel, decimate, minute_durations)
+from audio_transform.spectro_cache import SpectroCache, cache_directory
+from common import metrics
 
 
 
@@ -27,107 +38,67 @@ import sys
 # CONFIGURATION DEFAULTS
 output_directory = 'images'
 desired_channel = 5             # Which channel do you want? 5 is default b/c it is furthest from the boat
-chunk_duration = 3              # Number of seconds represented in each pane of the spectrogram
-freq_min = 3500                 # Spectrogram strip's minimum sampled frequency 
-freq_max = 9500                 # Spectrogram strip's maximum sampled frequency 
-plot_min = 4000                 # Spectrogram strip's minumum DISPLAYED frequency
-plot_max = 9000                 # Spectrogram strip's maximum DISPLAYED frequency
+threshold = 1.0                 # dB values below the threshold are replaced with threshold_fill
+threshold_fill = 10
+renderer = 'matplotlib'         # 'matplotlib' or 'raster'
 ###################################################################
-# Accept command line inputs
-parser = argparse.ArgumentParser()
-parser.add_argument("wave_file_path", help="process this file from audio to spectrograms")
-parser.add_argument("-o", "--output", help="choose a location for image outputs") # Output directory 
-parser.add_argument("-ch", "--channel", help="select an audio channel to transform") #Channel 
-args = parser.parse_args() 
-
-# Use arguement values if they exist
-if (args.output):
-    output_directory = args.output 
-if (args.channel):
-    desired_channel = int(args.channel)
-
-print(f"\nMetadata for [{args.wave_file_path}]:")
-audio_file_name = os.path.basename(args.wave_file_path)[:-4]    # Get the name of the audio 
-print(f"Audio name: [{audio_file_name}]")
-
-try:
-    sample_rate, data = wavfile.read(args.wave_file_path)       # Read audio file
-except ValueError:
-    print("Invalid input file type. Supported file type(s): .wav")
-    sys.exit(1)
-
-print(f"Sample rate = {sample_rate}")
-
-# Select a channel if multiple 
-if len(data.shape) > 1:
-    print(f"number of channels = {data.shape[1]}")
-    print(f"sampling from channel: {desired_channel}")
-    data = data[:, desired_channel]  # Select desired channel
-else:
-    print(f"number of channels = 1")
-
-length = data.shape[0] / sample_rate    # Original sample rate 
-if not (58 < length < 62): # Make sure length is 60 seconds for now! 
-    print(f"Length not ~60 second, undefined behavior... exiting")
-    sys.exit(0)
-print(f"length (seconds) = {length}")
-
-# Determine the number of whole 3 second chunks
-samples_per_chunk = int(sample_rate * chunk_duration)
-num_chunks = int(len(data) / samples_per_chunk)
-print(f"num chunks = {num_chunks}")
-
-all_chunks = [] 
-for i in range(num_chunks):
-    start_sample = i * samples_per_chunk
-    end_sample = start_sample + samples_per_chunk
-    chunk_data = data[ start_sample : end_sample ]
-    all_chunks.append(chunk_data)
-
-## Create Spectrograms
-def make_spectro(num_rows=10, which_plot=0): 
-    fig, axes = plt.subplots(
-        nrows=num_rows, 
-        ncols=1, figsize=(8, 5),
-        facecolor='black',
-        gridspec_kw={'hspace': -0.5},
-        constrained_layout=True)
-    
-    fig.patch.set_facecolor('black')
-
-
-    for i in range(num_rows):
-        # Compute spectrogram
-        fft_size = 1024
-        hop_size = fft_size // 2
-        window = get_window("hann", fft_size)
-
-                                            # 10 spectros to a plot, if 2nd  spectro grab 10 - 19
-        f, t, Sxx = spectrogram(all_chunks[i + which_plot*10], fs=sample_rate,  window=window, nperseg=fft_size, scaling='density')
-
-        fmin, fmax = freq_min, freq_max
-        freq_slice = np.where((f >= fmin) & (f <= fmax))
-        f = f[freq_slice]
-        Sxx = Sxx[freq_slice, :][0]
-
-        Sxx_db = 10 * np.log10(Sxx + 1e-10)
-        threshold = 1.0 
-        Sxx_db[Sxx_db < threshold] = 10 
-
-        # Plot
-        ax = axes[i]
-        #ax.set_facecolor('black')  # Set each subplot background to black
-        pcm = ax.pcolormesh(t, f, Sxx_db, shading='gouraud', cmap=plt.cm.binary)
-        ax.set_ylim(plot_min, plot_max)
-        ax.axis('off')
-
-
-    base_name=audio_file_name + '-' + str("{:04}".format(which_plot*10 + 1)) 
-    image_name = os.path.join(output_directory, f"{base_name}.jpg")
-    plt.savefig(image_name, bbox_inches='tight', pad_inches=0, dpi=300)
-    plt.close()
-    print(f"Saved {image_name}") 
-
-# Make two spectrograms with the input data # TODO: generalize to any # of spectrograms
-make_spectro(10, 0)
-make_spectro(10, 1)
+
+def noise_reduction_audio_to_spectro(wave_file_path, output_directory=output_directory, channel=desired_channel, renderer=renderer,
+                                     threshold=threshold, cache=None, decimate=decimate):
+    '''
+    Turn one minute of audio into two thresholded ten strip spectrogram images.
+    Returns a list of the saved image names (empty if the audio is not ~60 seconds long).
+    channel is a channel number, a list of channels or an AutoChannel, see parse_channel() in audio_to_spectro.py.
+    cache is an optional SpectroCache and decimate downsamples before the FFT, see channel_spectrograms() in audio_to_spectro.py.
+    '''
+    print(f"\nMetadata for [{wave_file_path}]:")
+    audio_file_name = os.path.basename(wave_file_path)[:-4]    # Get the name of the audio
+    print(f"Audio name: [{audio_file_name}]")
+
+    info = load_header(wave_file_path)
+    if not (minute_durations[0] < info.duration < minute_durations[1]): # Make sure length is 60 seconds for now! (checked before reading any samples)
+        print(f"Length not ~60 second, undefined behavior... skipping")
+        return []
+
+    channels = file_channels(channel, info)
+    f, t, Sxx_all = channel_spectrograms(wave_file_path, channels, info, cache=cache, decimate=decimate)
+
+    image_names = []
+    for _, Sxx_db, subdirectory in select_channels(Sxx_all, channels, channel): # Picked before thresholding
+        with metrics.stage('threshold'):
+            Sxx_db[Sxx_db < threshold] = threshold_fill
+
+        # Make two spectrograms with the input data, 10 spectros to a plot, 2nd spectro grabs 10 - 19
+        directory = image_directory(output_directory, subdirectory)
+        image_names += [make_spectro(f, t, Sxx_db[which_plot*10 : (which_plot + 1)*10], spectro_path(audio_file_name, which_plot*10, directory), renderer)
+                        for which_plot in range(2)]
+    metrics.count('files')
+    return image_names
+
+def main():
+    # Accept command line inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wave_file_path", help="process this file from audio to spectrograms")
+    parser.add_argument("-o", "--output", default=output_directory, help="choose a location for image outputs") # Output directory
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to transform: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)") #Channel
+    parser.add_argument("-r", "--renderer", choices=['matplotlib', 'raster'], default=renderer, help="how images are drawn, raster is much faster")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample to the lowest rate that keeps the band before the FFT")
+    parser.add_argument("-t", "--threshold", type=float, default=threshold, help=f"dB values below this are replaced with {threshold_fill}")
+    parser.add_argument("--cache", nargs='?', const=cache_directory,
+                        help=f"read / save the spectrogram arrays in a cache directory (default {cache_directory})")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start('noise_reduction_audio_to_spectro', args.metrics, args.summary)
+    try:
+        cache = SpectroCache(args.cache) if args.cache else None
+        noise_reduction_audio_to_spectro(args.wave_file_path, args.output, args.channel, args.renderer, args.threshold, cache, args.decimate)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''
+File:   prescreen.py
+
+Spec:   Cheap pre-screen that skips images with nothing in them before they are rendered and
+        inferenced. Most minutes of a towed array survey have no whistles, but each one still pays for
+        two renders and two YOLO passes. The spectrograms are already computed at that point, so every
+        3 second chunk is scored from its band (prescreen_min - prescreen_max) in vectorized NumPy:
+            band energy     how far the chunk's loudest frames (energy_percentile of the band power)
+                            stand above the image's median frame, in dB
+            tonal score     share of the chunk's frames that continue a tonal contour: the strongest bin
+                            stands peak_prominence dB above its own median level (which removes steady
+                            tones like the ship's) and is at most max_jump bins from the previous frame's
+        An image (30 seconds) is kept if any of its chunks reaches energy_threshold or tonal_threshold,
+        otherwise it is screened out: not rendered, and recorded in the prescreen log
+        (image path, band energy, tonal score, 'Screened out'). A minute is screened out when both of its images are.
+
+        Use --prescreen with audio_to_spectro.py, analyze_dataset.py, audio_pipeline.py or watch_recordings.py.
+
+        This file's own command line tunes the thresholds: it scores recordings that have PAMGuard
+        annotations and reports, for a grid of thresholds, how many images and minutes would be skipped
+        and how many annotated ones would have been missed.
+
+Usage:  python3 audio_transform/prescreen.py <wave/directory> <pamguard.csv> -c <number of wave files>
+        python3 audio_transform/prescreen.py <wave/directory> <pamguard.csv> --energy 3 4 6 --tonal 0.02 0.05 --scores scores.csv
+        --manifest picks the wave files from a manifest of their headers (see recording_manifest.py).
+'''
+
+import os
+import sys
+import csv
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import (stream_blocks, block_spectrograms, spectro_path, parse_channel, desired_channel,
+                                              plot_min, plot_max, chunk_duration)
+from audio_transform.recording_manifest import RecordingManifest, manifest_path
+from common.strip_geometry import strips_per_image
+from common.detection_index import image_start_ms
+from common.pamguard_csv import load_pamguard_csv
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+prescreen_min = plot_min        # Band the pre-screen looks at (the displayed band, 4 - 9 kHz)
+prescreen_max = plot_max
+energy_threshold = 6.0          # dB a chunk's loud frames must stand above the image's median frame
+energy_percentile = 90          # Which of a chunk's frames count as its loud ones
+tonal_threshold = 0.05          # Share of a chunk's frames on a tonal contour
+peak_prominence = 10.0          # dB a frame's strongest bin must stand above that bin's median to be tonal
+max_jump = 2                    # Bins a contour may move from one frame to the next
+prescreen_logs_path = 'audio_transform/analyst_logs/prescreen_logs.csv'
+desired_species = 33            # PAMGuard species code of the annotations the report counts (False Killer Whale)
+energy_grid = [2, 3, 4, 6, 8, 10]
+tonal_grid = [0.02, 0.05, 0.1, 0.2]
+###################################################################
+
+def chunk_scores(f, Sxx_db, band=(prescreen_min, prescreen_max)):
+    '''
+    Band energy (dB) and tonal score (0 - 1) of every chunk of a (..., num_chunks, len(f), len(t)) spectrogram,
+    see the Spec. Returns two arrays of shape (..., num_chunks).
+    '''
+    in_band = (f >= band[0]) & (f <= band[1])
+    S = Sxx_db[..., in_band, :]
+
+    # Band power of every frame, loud frames against the median frame of all chunks
+    power = 10 * np.log10((10 ** (S / 10)).sum(axis=-2))
+    floor = np.median(power, axis=(-2, -1), keepdims=True)[..., 0]
+    energy = np.percentile(power, energy_percentile, axis=-1) - floor
+
+    # Strongest bin of every frame over that bin's median level in the chunk
+    excess = S - np.median(S, axis=-1, keepdims=True)
+    peak_bin = excess.argmax(axis=-2)
+    tonal_frame = excess.max(axis=-2) >= peak_prominence
+    contour = tonal_frame[..., 1:] & tonal_frame[..., :-1] & (np.abs(np.diff(peak_bin, axis=-1)) <= max_jump)
+    return energy, contour.mean(axis=-1)
+
+def passes(energy, tonal, energy_threshold=energy_threshold, tonal_threshold=tonal_threshold):
+    '''Chunks with enough band energy or a tonal contour.'''
+    return (energy >= energy_threshold) | (tonal >= tonal_threshold)
+
+class Prescreen:
+    '''The pre-screen's thresholds and the images it screened out since the last take().'''
+
+    def __init__(self, energy_threshold=energy_threshold, tonal_threshold=tonal_threshold):
+        self.energy_threshold = energy_threshold
+        self.tonal_threshold = tonal_threshold
+        self.screened_out = []  # (image path, band energy, tonal score)
+
+    def keep(self, f, Sxx_db, image_path):
+        '''True if the image of the chunks in Sxx_db is worth rendering, otherwise it is remembered as screened out.'''
+        with metrics.stage('prescreen'):
+            energy, tonal = chunk_scores(f, Sxx_db)
+            keep = passes(energy, tonal, self.energy_threshold, self.tonal_threshold).any()
+        if keep:
+            return True
+        metrics.count('screened_out')
+        self.screened_out.append((image_path, round(float(energy.max()), 2), round(float(tonal.max()), 3)))
+        print(f"Screened out [{image_path}] (band energy {energy.max():.1f} dB, tonal {tonal.max():.2f})")
+        return False
+
+    def take(self):
+        '''The images screened out since the last call (a worker process sends them back with its results).'''
+        screened_out, self.screened_out = self.screened_out, []
+        return screened_out
+
+def record_screened_out(log, screened_out):
+    '''Write images screened out by a Prescreen (see take()) in the prescreen log.'''
+    for image_path, energy, tonal in screened_out:
+        log.record(image_path, energy, tonal, 'Screened out')
+
+def load_annotations(csv_path, species=desired_species):
+    '''(start, end) UTC times in ms since 1970 of the PAMGuard annotations of one species, start sorted and end sorted.'''
+    df = load_pamguard_csv(csv_path)
+    df = df[(df['species'] == species) & df['UTC'].notna()]
+    start = df['UTC'].to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    end = start + np.round(df['duration'].to_numpy(dtype=float) * 1000).astype(np.int64)
+    return np.sort(start), np.sort(end)
+
+def annotated(chunk_start, annotation_start, annotation_end, duration_ms=chunk_duration * 1000):
+    '''True for every chunk (start times in ms) overlapping an annotation: annotations starting before its end minus those ended before its start.'''
+    started = np.searchsorted(annotation_start, chunk_start + duration_ms, side='left')
+    ended = np.searchsorted(annotation_end, chunk_start, side='right')
+    return started > ended
+
+def score_recordings(wave_file_paths, channel=desired_channel, decimate=False):
+    '''
+    Score every chunk of the recordings the way the pre-screen does. Returns a list of
+    (image name, minute key, first chunk start in ms since 1970 or None, energy array, tonal array) per image.
+    '''
+    images = []
+    for block in stream_blocks(wave_file_paths, channel, carry_over=False):
+        if block.samples is None:
+            continue
+        f, t, spectrograms = block_spectrograms(block, channel, decimate=decimate)
+        image_name = os.path.basename(spectro_path(block.audio_file_name, block.first_strip, ''))
+        start_ms = image_start_ms(image_name)
+        for Sxx_db, _ in spectrograms:
+            with metrics.stage('prescreen'):
+                energy, tonal = chunk_scores(f, Sxx_db)
+            images.append((image_name, (block.audio_file_name, block.first_strip // (2 * strips_per_image)), start_ms, energy, tonal))
+    return images
+
+def tuning_report(images, annotation_start, annotation_end, energy_grid=energy_grid, tonal_grid=tonal_grid):
+    '''
+    For every (energy threshold, tonal threshold) the share of images and minutes skipped and the number of
+    annotated images and minutes that would have been missed. Returns a list of dictionaries.
+    '''
+    energy = np.stack([image[3] for image in images])   # (images, chunks)
+    tonal = np.stack([image[4] for image in images])
+    is_annotated = np.zeros(len(images), dtype=bool)
+    for n, (_, _, start_ms, _, _) in enumerate(images):
+        if start_ms is not None:
+            chunk_starts = start_ms + np.arange(energy.shape[1]) * chunk_duration * 1000
+            is_annotated[n] = annotated(chunk_starts, annotation_start, annotation_end).any()
+    _, minute = np.unique([str(image[1]) for image in images], return_inverse=True)
+    minute_annotated = np.bincount(minute, weights=is_annotated, minlength=minute.max() + 1) > 0
+
+    rows = []
+    for energy_limit in energy_grid:
+        for tonal_limit in tonal_grid:
+            skipped = ~passes(energy, tonal, energy_limit, tonal_limit).any(axis=1)
+            minute_kept = np.bincount(minute, weights=~skipped, minlength=minute.max() + 1) > 0
+            rows.append({'energy_threshold': energy_limit, 'tonal_threshold': tonal_limit,
+                         'images_skipped': float(skipped.mean()), 'minutes_skipped': float((~minute_kept).mean()),
+                         'images_missed': int((skipped & is_annotated).sum()), 'minutes_missed': int((~minute_kept & minute_annotated).sum())})
+    return rows, int(is_annotated.sum()), int(minute_annotated.sum()), minute.max() + 1
+
+def save_scores(path, images):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image', 'chunk', 'band_energy_db', 'tonal_score'])
+        for image_name, _, _, energy, tonal in images:
+            for chunk, (e, s) in enumerate(zip(energy, tonal)):
+                writer.writerow([image_name, chunk, round(float(e), 3), round(float(s), 4)])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", help="wave files with PAMGuard annotations")
+    parser.add_argument("csv_filepath", help="PAMGuard annotations of the recordings")
+    parser.add_argument("-c", "--count", type=int, default=0, help="number of wave files scored (sorted by name), 0 for all")
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to score: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample before the FFT (see audio_to_spectro.py)")
+    parser.add_argument("--species", type=int, default=desired_species, help="PAMGuard species code of the annotations counted")
+    parser.add_argument("--energy", type=float, nargs='+', default=energy_grid, help="band energy thresholds (dB) to try")
+    parser.add_argument("--tonal", type=float, nargs='+', default=tonal_grid, help="tonal score thresholds to try")
+    parser.add_argument("--scores", help="save every chunk's scores to this CSV")
+    parser.add_argument("--manifest", nargs='?', const=manifest_path,
+                        help=f"pick wave files from a header manifest (default {manifest_path}), see recording_manifest.py")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.manifest:
+        manifest = RecordingManifest(args.manifest)
+        manifest.scan([args.input_directory])
+        manifest.save()
+        wave_file_paths = [os.path.join(args.input_directory, os.path.basename(recording.path))
+                           for recording in manifest.recordings(args.input_directory)]
+    else:
+        wave_file_paths = sorted(os.path.join(args.input_directory, name) for name in os.listdir(args.input_directory)
+                                 if name.lower().endswith('.wav'))
+    wave_file_paths = wave_file_paths[:args.count] if args.count else wave_file_paths
+    if not wave_file_paths:
+        print(f"No wave files in [{args.input_directory}]")
+        sys.exit(1)
+
+    metrics.start('prescreen', args.metrics, args.summary)
+    try:
+        annotation_start, annotation_end = load_annotations(args.csv_filepath, args.species)
+        images = score_recordings(wave_file_paths, args.channel, args.decimate)
+    finally:
+        metrics.finish()
+    if not images:
+        print("No full 30 second images in the recordings")
+        sys.exit(1)
+    if args.scores:
+        save_scores(args.scores, images)
+
+    rows, annotated_images, annotated_minutes, minutes = tuning_report(images, annotation_start, annotation_end, args.energy, args.tonal)
+    print(f"\n{len(images)} images ({minutes} minutes), {annotated_images} images ({annotated_minutes} minutes) "
+          f"with species {args.species} annotations")
+    print(f"{'energy dB':>9} {'tonal':>6} {'images skipped':>15} {'minutes skipped':>16} {'images missed':>14} {'minutes missed':>15}")
+    for row in rows:
+        default = ' <- default' if (row['energy_threshold'], row['tonal_threshold']) == (energy_threshold, tonal_threshold) else ''
+        print(f"{row['energy_threshold']:>9g} {row['tonal_threshold']:>6g} {row['images_skipped']:>14.1%} {row['minutes_skipped']:>15.1%} "
+              f"{row['images_missed']:>14} {row['minutes_missed']:>15}{default}")
+
+if __name__ == '__main__':
+    main()
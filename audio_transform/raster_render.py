@@ -0,0 +1,81 @@
+'''
+File:   raster_render.py
+
+Spec:   Draw a ten strip spectrogram image straight into a NumPy array, skipping
+        matplotlib's pcolormesh/savefig. The image looks like the matplotlib one: same size,
+        binary (white to black) colormap scaled to each strip's own min/max, bilinear
+        shading, and black gaps between strips at the normalized_stripe_ys positions
+        so annotations made by create_pamguard_annotations.py still line up.
+
+Usage:  from audio_transform.raster_render import render_strips, save_image
+        image = render_strips(f, t, Sxx_db[0:10], plot_min, plot_max)
+        save_image(image, "path/to/image.jpg")
+'''
+
+import os
+import io
+import sys
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common.strip_geometry import normalized_stripe_ys, normalized_strip_height, image_size
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+jpeg_quality = 75 # Same as matplotlib's (pillow's) default
+binary_lut = (255 - np.arange(256)).astype(np.uint8) # matplotlib's 256 color 'binary' colormap, 0 = white, 255 = black
+###################################################################
+
+def strip_rows(height):
+    '''Return the top row of each strip and the strip height (in pixels) for an image height.'''
+    tops = np.round(np.array(list(normalized_stripe_ys.values())) * height).astype(int)
+    return tops, int(round(normalized_strip_height * height))
+
+def interp_weights(positions, grid):
+    '''Left neighbour index and weight for linear interpolation of 'positions' on an evenly spaced grid.'''
+    index = (positions - grid[0]) / (grid[1] - grid[0])
+    index = np.clip(index, 0, len(grid) - 1)
+    left = np.minimum(index.astype(int), len(grid) - 2)
+    return left, index - left
+
+def render_strips(f, t, Sxx_db, plot_min, plot_max, size=image_size):
+    '''
+    Render (num_strips, len(f), len(t)) dB spectrograms as one RGB uint8 image.
+    The strips show plot_max (top) to plot_min (bottom) and t[0] to t[-1] (left to right).
+    '''
+    width, height = size
+    tops, strip_height = strip_rows(height)
+
+    # Pixel centers in frequency (rows, top is high frequency) and time (columns)
+    row_freqs = plot_max - (np.arange(strip_height) + 0.5) / strip_height * (plot_max - plot_min)
+    col_times = t[0] + (np.arange(width) + 0.5) / width * (t[-1] - t[0])
+    f0, fw = interp_weights(row_freqs, f)
+    t0, tw = interp_weights(col_times, t)
+
+    # Color scale is per strip, like pcolormesh's autoscaling on each axes
+    vmin = Sxx_db.min(axis=(1, 2), keepdims=True)
+    vmax = Sxx_db.max(axis=(1, 2), keepdims=True)
+    norm = (Sxx_db - vmin) / np.where(vmax > vmin, vmax - vmin, 1)
+
+    # Separable bilinear resample: frequency axis first (small), then time axis
+    norm = norm[:, f0, :] * (1 - fw)[:, None] + norm[:, f0 + 1, :] * fw[:, None]
+    norm = norm[:, :, t0] * (1 - tw) + norm[:, :, t0 + 1] * tw
+    strips = binary_lut[np.clip((norm * 256).astype(int), 0, 255)]
+
+    image = np.zeros((height, width), dtype=np.uint8) # Black background is the gap between strips
+    for top, strip in zip(tops, strips):
+        rows = min(strip_height, height - top)
+        image[top:top + rows] = strip[:rows]
+
+    return np.repeat(image[:, :, None], 3, axis=2) # Images are not saved in gray scale for YOLO training purposes
+
+def save_image(image, image_name, quality=jpeg_quality):
+    '''Encode and write a rendered image, the format comes from the file extension.'''
+    with metrics.stage('encode'):
+        encoded = io.BytesIO()
+        Image.fromarray(image).save(encoded, format=Image.registered_extensions()[os.path.splitext(image_name)[1].lower()], quality=quality)
+    with metrics.stage('write'):
+        with open(image_name, 'wb') as image_file:
+            image_file.write(encoded.getbuffer())
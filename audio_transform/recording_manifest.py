@@ -0,0 +1,225 @@
+'''
+File:   recording_manifest.py
+
+Spec:   Manifest of the wave files in one or more recording folders, built from their headers only
+        (read_wav_header() in wav_reader.py, no samples are read), so picking files, --count limits
+        and duration checks do not open the audio.
+
+        A rescan lists every folder with os.scandir (the size and modification time come with the
+        listing) and only reads the header of a file that is new or whose size or modification time
+        changed since the last scan, files that are gone are dropped. Folders are listed and headers
+        read by a pool of threads, so the many *_AC_* folders of a cruise (ex: Sette_AC_44) are crawled at once.
+
+        The manifest is one .npz file of columns (like common/detection_index.py), rewritten whole
+        and renamed into place. It only caches what is in the headers, deleting it loses nothing.
+
+I/O:    Columns (one row per wave file): directory (row in the directory table), name, size (bytes),
+        mtime_ns, sample_rate, channels, duration (seconds) and start_ms (UTC start parsed from the
+        file name, ms since 1970, -1 if the name carries no time). A file whose header cannot be
+        read is kept with sample_rate 0, so it is not read again until it changes.
+        Directory table: directories (absolute paths).
+
+Usage:  from audio_transform.recording_manifest import RecordingManifest
+        manifest = RecordingManifest('audio_transform/analyst_logs/recording_manifest.npz')
+        manifest.scan(recording_directories(['/data/1706']))
+        manifest.save()
+        recordings = manifest.recordings('/data/1706/Sette_AC_44', min_duration=58, max_duration=62)
+
+        Build or refresh it (every *_AC_* folder below the given folders) and print a summary per folder:
+            python3 audio_transform/recording_manifest.py <root/directory> [...] -w 8 [--match '*_AC_*']
+        analyze_dataset.py, audio_pipeline.py and prescreen.py take --manifest to pick their wave files from it
+        (the input directory is rescanned first).
+'''
+
+import os
+import sys
+import struct
+import fnmatch
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.wav_reader import read_wav_header
+from common.detection_index import image_start_ms
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+manifest_path = 'audio_transform/analyst_logs/recording_manifest.npz'
+folder_match = '*_AC_*'         # Folders below the given ones that are crawled (recorder folders, ex: Sette_AC_44)
+workers = 8                     # Threads listing folders and reading headers
+###################################################################
+
+Recording = namedtuple('Recording', ['path', 'size', 'mtime_ns', 'sample_rate', 'channels', 'duration', 'start_ms'])
+columns = {'size': np.int64, 'mtime_ns': np.int64, 'sample_rate': np.int32, 'channels': np.int16,
+           'duration': np.float64, 'start_ms': np.int64}
+
+def recording_directories(roots, match=folder_match):
+    '''Every root folder and every folder below one whose name matches 'match', roots first.'''
+    directories = []
+    for root in roots:
+        directories.append(root)
+        pending = [root]
+        while pending:
+            with os.scandir(pending.pop()) as scan:
+                for entry in scan:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                        if fnmatch.fnmatch(entry.name, match):
+                            directories.append(entry.path)
+    return directories
+
+def list_directory(directory):
+    '''(name, size, mtime_ns) of every .wav file in a directory, None if the directory does not exist.'''
+    try:
+        with os.scandir(directory) as scan:
+            return [(entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in scan
+                    if entry.name.lower().endswith('.wav') and entry.is_file()]
+    except FileNotFoundError:
+        return None
+
+def header_fields(wave_file_path):
+    '''(sample_rate, channels, duration) from a wave file's header, (0, 0, 0.0) if it cannot be read.'''
+    try:
+        info = read_wav_header(wave_file_path)
+    except (OSError, ValueError, struct.error):
+        return 0, 0, 0.0
+    return info.sample_rate, info.channels, info.duration
+
+class RecordingManifest:
+    '''The recordings of every scanned folder: absolute folder path -> {file name: Recording}.'''
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        '''Read the manifest file (empty if there is none yet).'''
+        self.folders = {}
+        if not os.path.exists(self.path):
+            return
+        with metrics.stage('manifest_read'):
+            with np.load(self.path) as data:
+                directories, directory, names = data['directories'], data['directory'], data['name']
+                values = [data[name].tolist() for name in columns]
+            for row, name in enumerate(names.tolist()):
+                folder = str(directories[directory[row]])
+                self.folders.setdefault(folder, {})[name] = Recording(os.path.join(folder, name), *(column[row] for column in values))
+
+    def __len__(self):
+        return sum(len(recordings) for recordings in self.folders.values())
+
+    def scan(self, directories, workers=workers):
+        '''
+        Bring the given folders up to date: headers are only read for new or changed files.
+        Returns (number of headers read, number of files dropped). A folder that does not exist is left as it was.
+        '''
+        directories = list(dict.fromkeys(os.path.abspath(directory) for directory in directories))
+        read, dropped = 0, 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            with metrics.stage('manifest_list'):
+                listings = list(pool.map(list_directory, directories))
+
+            changed = []
+            for directory, listing in zip(directories, listings):
+                if listing is None:
+                    print(f"[{directory}] not found, its recordings are left in the manifest as they were")
+                    continue
+                known = self.folders.get(directory, {})
+                current = {}
+                for name, size, mtime_ns in listing:
+                    recording = known.get(name)
+                    if recording is not None and (recording.size, recording.mtime_ns) == (size, mtime_ns):
+                        current[name] = recording
+                    else:
+                        changed.append((directory, name, size, mtime_ns))
+                dropped += len(set(known) - {name for name, _, _ in listing})
+                self.folders[directory] = current
+
+            with metrics.stage('manifest_headers'):
+                headers = list(pool.map(header_fields, [os.path.join(directory, name) for directory, name, _, _ in changed]))
+            for (directory, name, size, mtime_ns), fields in zip(changed, headers):
+                path = os.path.join(directory, name)
+                start = image_start_ms(name)
+                self.folders[directory][name] = Recording(path, size, mtime_ns, *fields, -1 if start is None else start)
+                read += 1
+        metrics.count('headers', read)
+        return read, dropped
+
+    def save(self):
+        '''Write the manifest file (whole, renamed into place).'''
+        with metrics.stage('manifest_write'):
+            directories = sorted(self.folders)
+            recordings = [(row, recording) for row, directory in enumerate(directories)
+                          for _, recording in sorted(self.folders[directory].items())]
+            data = {'directories': np.array(directories, dtype=str),
+                    'directory': np.array([row for row, _ in recordings], dtype=np.int32),
+                    'name': np.array([os.path.basename(recording.path) for _, recording in recordings], dtype=str)}
+            for name, dtype in columns.items():
+                data[name] = np.array([getattr(recording, name) for _, recording in recordings], dtype=dtype)
+
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, **data)
+            os.replace(temporary_path, self.path)
+
+    def recordings(self, directory, min_duration=None, max_duration=None):
+        '''
+        Recordings of one scanned folder sorted by name, only the ones with a readable header and a duration
+        strictly between min_duration and max_duration (seconds, None for no limit).
+        '''
+        recordings = self.folders.get(os.path.abspath(directory), {})
+        return [recording for _, recording in sorted(recordings.items())
+                if recording.sample_rate > 0
+                and (min_duration is None or recording.duration > min_duration)
+                and (max_duration is None or recording.duration < max_duration)]
+
+def folder_summary(directory, recordings):
+    '''One line describing a folder's recordings.'''
+    readable = [recording for recording in recordings if recording.sample_rate > 0]
+    line = f"[{directory}] {len(recordings)} wave files"
+    if readable:
+        hours = sum(recording.duration for recording in readable) / 3600
+        rates = sorted({recording.sample_rate for recording in readable})
+        channels = sorted({recording.channels for recording in readable})
+        durations = [recording.duration for recording in readable]
+        line += (f", {hours:.1f} h, {' / '.join(map(str, rates))} Hz, {' / '.join(map(str, channels))} channel(s), "
+                 f"{min(durations):.1f} - {max(durations):.1f} s long")
+        starts = [recording.start_ms for recording in readable if recording.start_ms >= 0]
+        if starts:
+            first, last = np.array([min(starts), max(starts)], dtype='datetime64[ms]')
+            line += f", {str(first)[:19]} - {str(last)[:19]}"
+    if len(readable) < len(recordings):
+        line += f", {len(recordings) - len(readable)} without a readable header"
+    return line
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs='+', help="recording folders, the folders below them matching --match are crawled too")
+    parser.add_argument("--manifest", default=manifest_path, help="manifest file to build or refresh")
+    parser.add_argument("--match", default=folder_match, help="name pattern of the folders crawled below the given ones")
+    parser.add_argument("-w", "--workers", type=int, default=workers, help="threads listing folders and reading headers")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start('recording_manifest', args.metrics, args.summary)
+    try:
+        manifest = RecordingManifest(args.manifest)
+        directories = recording_directories(args.directories, args.match)
+        read, dropped = manifest.scan(directories, args.workers)
+        manifest.save()
+    finally:
+        metrics.finish()
+
+    for directory in dict.fromkeys(os.path.abspath(directory) for directory in directories):
+        recordings = list(manifest.folders.get(directory, {}).values())
+        if recordings:
+            print(folder_summary(directory, recordings))
+    print(f"Scanned {len(directories)} folders: {read} headers read (new or changed), {dropped} files gone, "
+          f"{len(manifest)} recordings in [{args.manifest}]")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+'''
+File:   spectro_cache.py
+
+Spec:   Cache of band limited dB spectrogram arrays (the Sxx_db of batch_spectrogram() in
+        audio_to_spectro.py), one .npz file per wave file, so re-rendering, trying noise thresholds
+        (noise_reduction_audio_to_spectro.py) or extracting features skips the wave read and the STFT.
+
+        Entries are keyed by the wave file (path, size and modification time, so a changed
+        recording is never served stale), the channel, the FFT size and the frequency band.
+        Arrays are stored compactly:
+            float16     every dB value to about 0.03 dB (default)
+            uint8       each strip quantized to 256 steps between its own min and max, half the size
+                        again (images scale each strip to its min/max, so renders barely change)
+        The cache is kept under a size cap: reading an entry marks it as used and the least recently
+        used entries are deleted once the cap is passed.
+
+Usage:  from audio_transform.spectro_cache import SpectroCache
+        cache = SpectroCache('audio_transform/spectro_cache')
+        key = cache.key(wave_file_path, channel, fft_size, freq_min, freq_max)
+        cached = cache.get(key)                   # (f, t, Sxx_db) or None
+        if cached is None:
+            cache.put(key, f, t, Sxx_db)
+
+        Normally through audio_to_spectro.py's file_spectrogram(), or --cache on the command line.
+        Show or clear the cache:
+            python3 audio_transform/spectro_cache.py [cache/directory] [--clear]
+'''
+
+import os
+import sys
+import hashlib
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+cache_directory = 'audio_transform/spectro_cache'
+max_cache_mb = 2048             # Least recently used entries are deleted past this size
+storage = 'float16'             # 'float16' or 'uint8', see above
+###################################################################
+
+class SpectroCache:
+    '''A directory of <audio name>_<key>.npz spectrogram arrays with least recently used eviction.'''
+
+    def __init__(self, directory=cache_directory, max_mb=max_cache_mb, storage=storage):
+        if storage not in ('float16', 'uint8'):
+            raise ValueError(f"Unknown cache storage [{storage}], use float16 or uint8")
+        self.directory = directory
+        self.max_bytes = max_mb * 1024**2
+        self.storage = storage
+        self.total_bytes = None # Found on the first put()
+
+    def key(self, wave_file_path, channel, fft_size, freq_min, freq_max):
+        '''Cache key of one wave file's spectrogram, changes when the file or any setting changes.'''
+        stat = os.stat(wave_file_path)
+        source = f"{os.path.abspath(wave_file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{channel}|{fft_size}|{freq_min}|{freq_max}"
+        audio_file_name = os.path.splitext(os.path.basename(wave_file_path))[0]
+        return f"{audio_file_name}_{hashlib.sha1(source.encode()).hexdigest()[:16]}"
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        '''(f, t, Sxx_db) of a cached entry as float32 arrays, None if it is not cached.'''
+        path = self.path(key)
+        try:
+            with metrics.stage('cache_read'):
+                with np.load(path) as entry:
+                    f, t, Sxx = entry['f'], entry['t'], entry['Sxx']
+                    if Sxx.dtype == np.uint8:
+                        Sxx_db = Sxx * entry['step'] + entry['low'] # Per strip (num_chunks, 1, 1) arrays
+                    else:
+                        Sxx_db = Sxx.astype(np.float32)
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Dropping unreadable cache entry [{path}]: {e}")
+            self.remove(path)
+            return None
+        return f, t, Sxx_db
+
+    def put(self, key, f, t, Sxx_db):
+        '''Store one entry, then evict the least recently used entries if the cache is over its cap.'''
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {'f': f.astype(np.float32), 't': t.astype(np.float32)}
+        if self.storage == 'uint8':
+            low = Sxx_db.min(axis=(1, 2), keepdims=True)
+            step = np.maximum(Sxx_db.max(axis=(1, 2), keepdims=True) - low, 1e-6) / 255
+            arrays.update(Sxx=np.round((Sxx_db - low) / step).astype(np.uint8),
+                          low=low.astype(np.float32), step=step.astype(np.float32))
+        else:
+            arrays['Sxx'] = Sxx_db.astype(np.float16)
+
+        path = self.path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp" # Written whole then renamed, so readers (or other workers) never see half a file
+        with metrics.stage('cache_write'):
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(temporary_path, path)
+
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self.entries())
+        else:
+            self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        '''(path, size, last used time) of every entry.'''
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError: # Evicted by another process
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        '''Delete least recently used entries until the cache is back under 90% of its cap.'''
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            self.remove(path)
+            self.total_bytes -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs='?', default=cache_directory, help="spectrogram cache directory")
+    parser.add_argument("--clear", action="store_true", help="delete every cached spectrogram")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"No cache at [{args.directory}]")
+        return
+    cache = SpectroCache(args.directory)
+    entries = cache.entries()
+    print(f"[{args.directory}]: {len(entries)} spectrograms, {sum(size for _, size, _ in entries) / 1024**2:.1f} MB "
+          f"(cap {max_cache_mb} MB)")
+    if args.clear:
+        for path, _, _ in entries:
+            cache.remove(path)
+        print("Cleared")
+
+if __name__ == '__main__':
+    main()
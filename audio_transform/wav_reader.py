@@ -0,0 +1,157 @@
+'''
+File:   wav_reader.py
+
+Spec:   Read a single channel (or a set of channels, in one pass over the file) out of a
+        (multichannel) wave file without loading every channel into RAM. The header is parsed by hand so the sample rate, channel count, sample type
+        and duration can be reported without touching any samples, and the samples
+        themselves are memory mapped. A channel is returned either as a strided view of the
+        memory map or as a contiguous copy that is filled a block at a time.
+
+I/O:    Supports RIFF wave files with PCM (8, 16, 24, 32 bit) or IEEE float (32, 64 bit) samples,
+        including WAVE_FORMAT_EXTENSIBLE headers. 24 bit samples cannot be memory mapped as
+        numbers, so they are always returned as a (block by block) int32 copy.
+
+Usage:  from audio_transform.wav_reader import read_wav_header, read_channel
+        info = read_wav_header("path/to/audio.wav")
+        sample_rate, data = read_channel("path/to/audio.wav", channel=5)
+        sample_rate, data = read_channels("path/to/audio.wav", [0, 3, 5])   # (3, num_frames)
+'''
+
+import os
+import struct
+from collections import namedtuple
+import numpy as np
+
+###################################################################
+# CONFIGURATION DEFAULTS
+block_frames = 1 << 20 # Number of frames copied at a time when making a contiguous channel copy
+###################################################################
+
+WavInfo = namedtuple('WavInfo', ['sample_rate', 'channels', 'dtype', 'bits_per_sample',
+                                 'num_frames', 'duration', 'data_offset', 'block_align'])
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def sample_dtype(format_tag, bits_per_sample):
+    '''Numpy dtype of one sample, None for 24 bit PCM which has no numpy equivalent.'''
+    if format_tag == WAVE_FORMAT_PCM:
+        if bits_per_sample == 8:
+            return np.dtype('u1') # 8 bit wave files are unsigned
+        if bits_per_sample in (16, 32):
+            return np.dtype(f'<i{bits_per_sample // 8}')
+        if bits_per_sample == 24:
+            return None
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT and bits_per_sample in (32, 64):
+        return np.dtype(f'<f{bits_per_sample // 8}')
+    raise ValueError(f"Unsupported wave sample format (format tag {format_tag}, {bits_per_sample} bits)")
+
+def read_wav_header(wave_file_path):
+    '''
+    Parse the RIFF header of a wave file and return a WavInfo, no samples are read.
+    Raises ValueError if the file is not a supported wave file.
+    '''
+    file_size = os.path.getsize(wave_file_path)
+    fmt = None
+    with open(wave_file_path, 'rb') as wav:
+        riff = wav.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"[{wave_file_path}] is not a RIFF wave file")
+
+        while True:
+            chunk_header = wav.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"[{wave_file_path}] has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+            if chunk_id == b'fmt ':
+                fmt = wav.read(chunk_size)
+                format_tag, channels, sample_rate, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    format_tag = struct.unpack('<H', fmt[24:26])[0] # First two bytes of the sub format GUID
+                if chunk_size % 2:
+                    wav.seek(1, os.SEEK_CUR)
+
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"[{wave_file_path}] data chunk comes before the fmt chunk")
+                data_offset = wav.tell()
+                # Recorders that were stopped early can leave a bogus size, never read past the end of the file
+                data_size = min(chunk_size, file_size - data_offset)
+                break
+
+            else:
+                wav.seek(chunk_size + chunk_size % 2, os.SEEK_CUR) # Chunks are padded to an even size
+
+    num_frames = data_size // block_align
+    return WavInfo(sample_rate, channels, sample_dtype(format_tag, bits_per_sample), bits_per_sample,
+                   num_frames, num_frames / sample_rate, data_offset, block_align)
+
+def map_frames(wave_file_path, info=None):
+    '''Memory map the samples as a read only (num_frames, channels) array, 24 bit files map as raw bytes.'''
+    info = info or read_wav_header(wave_file_path)
+    if info.dtype is None:
+        return np.memmap(wave_file_path, dtype='u1', mode='r', offset=info.data_offset,
+                         shape=(info.num_frames, info.channels, 3))
+    return np.memmap(wave_file_path, dtype=info.dtype, mode='r', offset=info.data_offset,
+                     shape=(info.num_frames, info.channels))
+
+def decode_24bit(raw):
+    '''Turn (..., 3) little endian 24 bit samples into int32.'''
+    raw = raw.astype(np.int32)
+    samples = raw[..., 0] | (raw[..., 1] << 8) | (raw[..., 2] << 16)
+    return np.where(samples & 0x800000, samples - (1 << 24), samples).astype(np.int32)
+
+def read_channel(wave_file_path, channel=0, copy=True, start_frame=0, num_frames=None, info=None):
+    '''
+    Return (sample_rate, samples) for one channel of a wave file.
+    copy=True fills a contiguous array block by block, so only one channel is ever held in RAM.
+    copy=False returns a strided view of the memory map (nothing is read until it is used).
+    start_frame / num_frames select a section of the recording.
+    '''
+    info = info or read_wav_header(wave_file_path)
+    if not 0 <= channel < info.channels:
+        raise ValueError(f"Channel {channel} does not exist, [{wave_file_path}] has {info.channels} channel(s)")
+
+    stop_frame = info.num_frames if num_frames is None else min(info.num_frames, start_frame + num_frames)
+    if stop_frame <= start_frame:
+        return info.sample_rate, np.empty(0, dtype=info.dtype or np.int32)
+    frames = map_frames(wave_file_path, info)[start_frame:stop_frame, channel]
+
+    if info.dtype is None: # 24 bit
+        samples = np.empty(len(frames), dtype=np.int32)
+        for start in range(0, len(frames), block_frames):
+            samples[start:start + block_frames] = decode_24bit(frames[start:start + block_frames])
+        return info.sample_rate, samples
+
+    if not copy:
+        return info.sample_rate, frames
+
+    samples = np.empty(len(frames), dtype=info.dtype)
+    for start in range(0, len(frames), block_frames):
+        samples[start:start + block_frames] = frames[start:start + block_frames]
+    return info.sample_rate, samples
+
+def read_channels(wave_file_path, channels=None, start_frame=0, num_frames=None, info=None):
+    '''
+    Return (sample_rate, samples) for several channels of a wave file, samples is a (len(channels), frames)
+    array with one contiguous row per channel. None reads every channel. The file is read once,
+    a block of interleaved frames at a time, instead of once per channel.
+    '''
+    info = info or read_wav_header(wave_file_path)
+    channels = list(range(info.channels)) if channels is None else list(channels)
+    for channel in channels:
+        if not 0 <= channel < info.channels:
+            raise ValueError(f"Channel {channel} does not exist, [{wave_file_path}] has {info.channels} channel(s)")
+
+    stop_frame = info.num_frames if num_frames is None else min(info.num_frames, start_frame + num_frames)
+    samples = np.empty((len(channels), max(stop_frame - start_frame, 0)), dtype=info.dtype or np.int32)
+    if stop_frame <= start_frame:
+        return info.sample_rate, samples
+    frames = map_frames(wave_file_path, info)[start_frame:stop_frame]
+
+    for start in range(0, len(frames), block_frames):
+        block = frames[start:start + block_frames][:, channels]
+        samples[:, start:start + block_frames] = (decode_24bit(block) if info.dtype is None else block).T
+    return info.sample_rate, samples
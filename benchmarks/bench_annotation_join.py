@@ -0,0 +1,94 @@
+'''
+File:   bench_annotation_join.py
+
+Spec:   Time the PAMGuard annotation to spectrogram match in create_pamguard_annotations.py
+        (match_annotations(), sorted search) against the original nested loop
+        (every annotation row x every spectrogram) at cruise sized inputs.
+        Both produce the same matches; this is checked on every size the loop is run on.
+
+I/O:    Synthetic data: spectrograms every 30 seconds over consecutive recording days,
+        annotations at random times within those days. Nothing is written to disk.
+
+Usage:  python3 benchmarks/bench_annotation_join.py
+        python3 benchmarks/bench_annotation_join.py --max_loop_seconds 60
+'''
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from model_training.create_pamguard_annotations import match_annotations
+
+###################################################################
+# CONFIGURATION DEFAULTS
+sizes = [(1000, 1000), (10000, 10000), (50000, 100000), (100000, 500000)] # (spectrograms, annotations)
+max_loop_seconds = 20 # Estimated nested loop runs longer than this are skipped (and only estimated)
+###################################################################
+
+def synthetic_inputs(num_spectros, num_annotations, seed=0):
+    '''Spectrogram (name, start time) pairs 30 seconds apart and a PAMGuard like annotation table.'''
+    rng = np.random.default_rng(seed)
+    start = datetime(2017, 7, 9)
+    spectro_times = [(f"1706_{i:08}-0001.jpg", start + timedelta(seconds=30 * i)) for i in range(num_spectros)]
+    offsets = rng.uniform(0, 30 * num_spectros, num_annotations)
+    df = pd.DataFrame({
+        'UTC': pd.Timestamp(start) + pd.to_timedelta(offsets, unit='s'),
+        'duration': rng.uniform(0.2, 2.0, num_annotations),
+        'freqMin': rng.uniform(4000, 6000, num_annotations),
+        'freqMax': rng.uniform(6000, 9000, num_annotations),
+        'species': 33,
+    })
+    return df, spectro_times
+
+def nested_loop(df, spectro_times):
+    '''The original load_original_annotations() match loop.'''
+    matches = []
+    for _, row in df.iterrows():
+        annotation_time = row['UTC']
+        for fname, spectro_time in spectro_times:
+            time_diff = (annotation_time - spectro_time).total_seconds()
+            if 0 <= time_diff <= 30:
+                matches.append((fname, annotation_time))
+    return matches
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max_loop_seconds", type=float, default=max_loop_seconds,
+                        help="skip (and estimate) nested loop runs expected to take longer than this")
+    args = parser.parse_args()
+
+    # Cost of one annotation x spectrogram comparison in the nested loop
+    df, spectro_times = synthetic_inputs(200, 200)
+    start = time.perf_counter()
+    nested_loop(df, spectro_times)
+    pair_seconds = (time.perf_counter() - start) / (200 * 200)
+
+    print(f"{'spectrograms':>12} {'annotations':>12} {'matches':>9} {'sorted search':>14} {'nested loop':>14} {'speed up':>9}")
+    for num_spectros, num_annotations in sizes:
+        df, spectro_times = synthetic_inputs(num_spectros, num_annotations)
+
+        start = time.perf_counter()
+        matches = match_annotations(df, spectro_times)
+        join_seconds = time.perf_counter() - start
+
+        loop_estimate = pair_seconds * num_spectros * num_annotations
+        if loop_estimate <= args.max_loop_seconds:
+            start = time.perf_counter()
+            expected = nested_loop(df, spectro_times)
+            loop_seconds = time.perf_counter() - start
+            assert sorted(expected) == sorted(zip(matches['spectro_file'], matches['UTC'])), "matches differ!"
+            loop_text = f"{loop_seconds:13.2f}s"
+        else:
+            loop_seconds = loop_estimate
+            loop_text = f"~{loop_seconds:12.0f}s"
+
+        print(f"{num_spectros:>12} {num_annotations:>12} {len(matches):>9} {join_seconds:13.3f}s {loop_text} {loop_seconds / join_seconds:8.0f}x")
+    print("\n~ = estimated from the cost of one comparison, the nested loop was not run")
+
+if __name__ == '__main__':
+    main()
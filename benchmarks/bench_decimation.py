@@ -0,0 +1,90 @@
+'''
+File:   bench_decimation.py
+
+Spec:   Compare the full rate STFT with the decimated one (audio_to_spectro.py --decimate: polyphase
+        low pass and downsampling to the lowest rate that keeps freq_min - freq_max, then a
+        fft_size / D point FFT) on the same minute of audio. Reports the wall and CPU time of each
+        (the decimated time includes the filter) and how equivalent the outputs are: same frequency
+        bins and segment times, the dB difference inside the displayed band (plot_min - plot_max)
+        and the pixel difference of the raster images (raster_render.py).
+
+I/O:    Uses a wave file if one is given, otherwise one minute of synthetic audio
+        (noise plus an FM sweep, see bench_render.py) at --sample_rate.
+
+Usage:  python3 benchmarks/bench_decimation.py [path/to/audio.wav] -ch 5 -n <repeats>
+        python3 benchmarks/bench_decimation.py -sr 384000 --margin 1.25     (try another band_margin)
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform import audio_to_spectro
+from audio_transform.audio_to_spectro import (load_channels, load_header, file_channels, parse_channel, band_spectrogram,
+                                              decimation_factor, desired_channel, fft_size, plot_min, plot_max)
+from audio_transform.raster_render import render_strips
+from benchmarks.bench_render import synthetic_minute
+
+###################################################################
+# CONFIGURATION DEFAULTS
+repeats = 3
+sample_rate = 96000 # Sample rate of the synthetic audio
+###################################################################
+
+def time_spectrogram(data, rate, decimate, repeats):
+    '''Best of 'repeats' wall and CPU times of band_spectrogram(), plus its f, t, Sxx_db.'''
+    walls, cpus = [], []
+    for _ in range(repeats):
+        wall, cpu = time.perf_counter(), time.process_time()
+        f, t, Sxx_db = band_spectrogram(data, rate, decimate=decimate)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    return min(walls), min(cpus), (f, t, Sxx_db)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wave_file_path", nargs='?', help="optional wave file, synthetic audio is used otherwise")
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel, help="channel(s) of the wave file: 5 or 1,3,5")
+    parser.add_argument("-sr", "--sample_rate", type=int, default=sample_rate, help="sample rate of the synthetic audio")
+    parser.add_argument("--margin", type=float, default=audio_to_spectro.band_margin, help="band_margin of audio_to_spectro.py")
+    parser.add_argument("-n", "--repeats", type=int, default=repeats, help="number of timed runs of each STFT")
+    args = parser.parse_args()
+    audio_to_spectro.band_margin = args.margin
+
+    if args.wave_file_path:
+        info = load_header(args.wave_file_path)
+        rate, data = load_channels(args.wave_file_path, file_channels(args.channel, info), info)
+    else:
+        rate, data = args.sample_rate, synthetic_minute(args.sample_rate)[np.newaxis]
+
+    factor = decimation_factor(rate)
+    if factor == 1:
+        print(f"{rate} Hz audio is not decimated with a band margin of {args.margin} (see decimation_factor()), nothing to compare")
+        return
+
+    full_wall, full_cpu, (f, t, full) = time_spectrogram(data, rate, False, args.repeats)
+    dec_wall, dec_cpu, (f_dec, t_dec, decimated) = time_spectrogram(data, rate, True, args.repeats)
+
+    print(f"\n{data.shape[0]} channel(s) of {data.shape[-1] / rate:.0f} s at {rate} Hz, decimated by {factor} to {rate // factor} Hz "
+          f"({fft_size} -> {fft_size // factor} point FFT)")
+    print(f"full rate: {full_wall * 1000:8.1f} ms wall {full_cpu * 1000:8.1f} ms CPU")
+    print(f"decimated: {dec_wall * 1000:8.1f} ms wall {dec_cpu * 1000:8.1f} ms CPU ({full_cpu / dec_cpu:.1f}x less CPU)")
+
+    if not (np.allclose(f, f_dec) and np.allclose(t, t_dec) and full.shape == decimated.shape):
+        print(f"Outputs differ in shape: {full.shape} and {decimated.shape}")
+        sys.exit(1)
+
+    shown = (f >= plot_min) & (f <= plot_max)
+    difference = np.abs(full[..., shown, :] - decimated[..., shown, :])
+    print(f"same {len(f)} frequency bins and {len(t)} segments, dB difference in {plot_min} - {plot_max} Hz: "
+          f"mean {difference.mean():.3f}, 99th percentile {np.percentile(difference, 99):.3f}, max {difference.max():.3f}")
+
+    pixels = np.abs(render_strips(f, t, full[0][:10], plot_min, plot_max).astype(float)
+                    - render_strips(f, t, decimated[0][:10], plot_min, plot_max).astype(float))
+    print(f"raster image: mean abs difference {pixels.mean():.2f} / 255, {(pixels <= 4).mean() * 100:.2f}% of pixels within 4 levels")
+
+if __name__ == '__main__':
+    main()
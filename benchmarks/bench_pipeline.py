@@ -0,0 +1,246 @@
+'''
+File:   bench_pipeline.py
+
+Spec:   Time every stage of the pipeline on synthetic data (see synthetic_data.py) at several dataset
+        sizes and sample rates, so throughput can be compared across commits and machines.
+        Each stage is run as the same command line an analyst would type, in its own process,
+        and the operating system's resource usage for that process gives the wall time, CPU time
+        and peak memory (max RSS) of the stage:
+
+            spectrogram     audio_transform/analyze_dataset.py (once per renderer)
+            annotations     model_training/create_pamguard_annotations.py
+            split           model_training/split_dataset.py
+            inference       dataset_prediction/inference_dataset.py          (only with a model)
+            pipeline        dataset_prediction/audio_pipeline.py             (only with a model)
+
+        Times include starting Python and importing the stage's libraries. The 'marginal' column
+        of the summary (extra seconds per item between the smallest and largest size) leaves that out.
+        A stage whose input comes from a stage that failed (ex: split after annotations) is skipped, not timed.
+
+I/O:    Results are written as JSON: the commit, machine and one record per stage and dataset size.
+        Nothing is downloaded, inference uses a local model file (--model), or an untrained
+        YOLO11n built from its config with --tiny_model (speed only, it finds nothing useful).
+
+Usage:  python3 benchmarks/bench_pipeline.py
+        python3 benchmarks/bench_pipeline.py --sizes 2 8 --sample_rates 48000 96000 --tiny_model -o results.json
+        python3 benchmarks/bench_pipeline.py --compare benchmarks/results/<older commit>.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from benchmarks.synthetic_data import write_recordings, write_pamguard_csv
+
+###################################################################
+# CONFIGURATION DEFAULTS
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_directory = os.path.join(project_root, 'benchmarks', 'results')
+sizes = [2, 6]                  # Dataset sizes, in one minute recordings
+sample_rates = [48000, 96000]
+channels = 6
+renderers = ['raster', 'matplotlib']
+batch_size = 4
+###################################################################
+
+def git_commit():
+    '''(commit hash, True if the work tree has uncommitted changes), (None, None) outside a git checkout.'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=project_root,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+# Runs a script as __main__ and writes the peak RSS of its own process (VmHWM) to a file at exit.
+# Measured in the child, since the kernel's max RSS of a child process starts from the parent's.
+measure_wrapper = '''
+import sys, runpy
+script, peak_file = sys.argv[1], sys.argv[2]
+sys.argv = [script] + sys.argv[3:]
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    with open('/proc/self/status') as status, open(peak_file, 'w') as out:
+        out.write(next(line.split()[1] for line in status if line.startswith('VmHWM')))
+'''
+
+def run_stage(command, cwd):
+    '''
+    Run one stage's command line and measure it.
+    Returns (exit code, wall seconds, user seconds, system seconds, peak RSS in MB).
+    '''
+    peak_file = os.path.join(cwd, '.peak_rss')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', measure_wrapper, command[0], peak_file] + command[1:],
+                               cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read().decode(errors='replace')
+    _, status, usage = os.wait4(process.pid, 0) # CPU time of this child only
+    wall = time.perf_counter() - start
+    process.stdout.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        print(f"  [{' '.join(command)}] exited with {process.returncode}:\n{output[-2000:]}")
+    with open(peak_file) as file:
+        peak_rss = int(file.read()) / 1024 # VmHWM is in kB
+    os.remove(peak_file)
+    return process.returncode, wall, usage.ru_utime, usage.ru_stime, peak_rss
+
+def make_tiny_model(path):
+    '''An untrained YOLO11n built from its config (no download), for timing inference only.'''
+    from ultralytics import YOLO
+    YOLO('yolo11n.yaml').save(path)
+    return path
+
+def stage_commands(case_directory, minutes, model):
+    '''
+    (stage, command line, number of items the stage handles, directory the stage writes to, stages it needs)
+    in the order they have to run.
+    '''
+    script = lambda path: os.path.join(project_root, path)
+    images = os.path.join(case_directory, f'images_{renderers[0]}')
+    image_count = minutes * 2
+    commands = []
+    for renderer in renderers:
+        commands.append((f'spectrogram_{renderer}', [script('audio_transform/analyze_dataset.py'), 'wavs', '-o', f'images_{renderer}',
+                                                     '-c', str(minutes), '-r', renderer, '--no_logs'], minutes, f'images_{renderer}', []))
+    made_images = f'spectrogram_{renderers[0]}'
+    commands.append(('annotations', [script('model_training/create_pamguard_annotations.py'), images, 'pamguard.csv'], image_count, 'annotations',
+                     [made_images]))
+    commands.append(('split', [script('model_training/split_dataset.py'), 'annotations', images, '-o', 'split'], image_count, 'split',
+                     [made_images, 'annotations']))
+    if model:
+        commands.append(('inference', [script('dataset_prediction/inference_dataset.py'), images, '-c', str(image_count),
+                                       '-m', model, '-b', str(batch_size), '--no_logs'], image_count, 'runs', [made_images]))
+        commands.append(('pipeline', [script('dataset_prediction/audio_pipeline.py'), 'wavs', '-o', 'screened', '-c', str(minutes),
+                                      '-m', model, '-b', str(batch_size), '--no_logs'], minutes, 'screened', []))
+    return commands
+
+def benchmark(work_directory, sizes=sizes, sample_rates=sample_rates, model=None, repeat=1):
+    '''
+    Generate each dataset, run every stage on it and return one result record per (stage, sample rate, size).
+    A stage whose input stage failed is not run (its output would be timed on missing input), its record only says why.
+    '''
+    results = []
+    for sample_rate in sample_rates:
+        for minutes in sizes:
+            case_directory = os.path.join(work_directory, f'{sample_rate}_{minutes}')
+            print(f"Generating {minutes} minutes at {sample_rate} Hz...")
+            _, events = write_recordings(os.path.join(case_directory, 'wavs'), minutes, sample_rate, channels)
+            write_pamguard_csv(os.path.join(case_directory, 'pamguard.csv'), events)
+
+            failed = set()
+            for stage, command, items, output, needs in stage_commands(case_directory, minutes, model):
+                missing = [need for need in needs if need in failed]
+                if missing:
+                    failed.add(stage)
+                    results.append({'stage': stage, 'sample_rate': sample_rate, 'minutes': minutes, 'items': items,
+                                    'skipped': f"{missing[0]} failed"})
+                    print(f"  {stage:<22} skipped ({missing[0]} failed)")
+                    continue
+                best = None
+                for _ in range(repeat):
+                    # Start every run from an empty output directory (some stages expect it to exist)
+                    shutil.rmtree(os.path.join(case_directory, output), ignore_errors=True)
+                    os.makedirs(os.path.join(case_directory, output))
+                    run = run_stage(command, case_directory)
+                    if best is None or run[1] < best[1]:
+                        best = run
+                returncode, wall, user, system, peak_rss = best
+                if returncode != 0:
+                    failed.add(stage)
+                results.append({'stage': stage, 'sample_rate': sample_rate, 'minutes': minutes, 'items': items,
+                                'returncode': returncode, 'wall_s': round(wall, 4), 'user_s': round(user, 4),
+                                'sys_s': round(system, 4), 'peak_rss_mb': round(peak_rss, 1),
+                                'items_per_s': round(items / wall, 4)})
+                print(f"  {stage:<22} {wall:8.2f} s  {peak_rss:8.1f} MB")
+            shutil.rmtree(case_directory, ignore_errors=True)
+    return results
+
+def marginal_seconds(results, record):
+    '''Extra seconds per item between the smallest and largest dataset size of a stage, None with one size.'''
+    same = [r for r in results if r['stage'] == record['stage'] and r['sample_rate'] == record['sample_rate'] and r.get('returncode') == 0]
+    if record.get('returncode') != 0 or not same:
+        return None
+    smallest = min(same, key=lambda r: r['items'])
+    largest = max(same, key=lambda r: r['items'])
+    if largest['items'] == smallest['items']:
+        return None
+    return (largest['wall_s'] - smallest['wall_s']) / (largest['items'] - smallest['items'])
+
+def print_summary(results, previous=None):
+    '''One line per record, with the change in wall time against a previous results file if given.'''
+    old = {}
+    if previous is not None:
+        old = {(r['stage'], r['sample_rate'], r['minutes']): r for r in previous['results'] if 'wall_s' in r}
+    print(f"\n{'stage':<22} {'rate':>6} {'min':>4} {'items':>6} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'items/s':>8} {'marginal':>9}"
+          + (f" {'old wall':>9} {'change':>7}" if previous else ''))
+    for r in results:
+        if 'skipped' in r:
+            print(f"{r['stage']:<22} {r['sample_rate']:>6} {r['minutes']:>4} {r['items']:>6}  skipped ({r['skipped']})")
+            continue
+        marginal = marginal_seconds(results, r)
+        line = (f"{r['stage']:<22} {r['sample_rate']:>6} {r['minutes']:>4} {r['items']:>6} {r['wall_s']:>8.2f} "
+                f"{r['user_s'] + r['sys_s']:>8.2f} {r['peak_rss_mb']:>8.1f} {r['items_per_s']:>8.2f} "
+                + (f"{marginal:>8.3f}s" if marginal is not None else f"{'-':>9}"))
+        match = old.get((r['stage'], r['sample_rate'], r['minutes']))
+        if match:
+            line += f" {match['wall_s']:>8.2f}s {r['wall_s'] / match['wall_s']:>6.2f}x"
+        if r['returncode'] != 0:
+            line += '  FAILED'
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="results file (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--sizes", type=int, nargs='+', default=sizes, help="dataset sizes in one minute recordings")
+    parser.add_argument("--sample_rates", type=int, nargs='+', default=sample_rates, help="sample rates to generate")
+    parser.add_argument("-m", "--model", help="local YOLO model file, enables the inference and pipeline stages")
+    parser.add_argument("--tiny_model", action="store_true", help="time inference with an untrained YOLO11n (no download)")
+    parser.add_argument("--repeat", type=int, default=1, help="run each stage this many times and keep the fastest")
+    parser.add_argument("--work_dir", help="where the synthetic data is generated (default a temporary directory)")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    commit, dirty = git_commit()
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix='fkw_bench_')
+    os.makedirs(work_directory, exist_ok=True)
+    try:
+        model = os.path.abspath(args.model) if args.model else None
+        if args.tiny_model and not model:
+            model = make_tiny_model(os.path.join(work_directory, 'yolo11n_untrained.pt'))
+        results = benchmark(work_directory, args.sizes, args.sample_rates, model, args.repeat)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = {'commit': commit, 'dirty': dirty, 'date': datetime.now().isoformat(timespec='seconds'),
+              'machine': platform.node(), 'processor': platform.machine(), 'cpu_count': os.cpu_count(),
+              'python': platform.python_version(), 'channels': channels, 'model': args.model or ('tiny' if args.tiny_model else None),
+              'results': results}
+    output = args.output or os.path.join(results_directory, f"{(commit or 'unknown')[:10]}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print_summary(results, previous)
+    print(f"\nResults written to [{output}]")
+    if any(r.get('returncode') != 0 for r in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
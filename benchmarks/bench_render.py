@@ -0,0 +1,79 @@
+'''
+File:   bench_render.py
+
+Spec:   Compare the matplotlib (pcolormesh + savefig) and raster (raster_render.py) spectrogram
+        renderers on the same minute of audio. Reports the time to render and write one
+        ten strip image with each renderer and how similar the two images are.
+
+I/O:    Uses a wave file if one is given, otherwise one minute of synthetic audio
+        (noise plus an FM sweep) is generated. Images are written to a temporary directory.
+
+Usage:  python3 benchmarks/bench_render.py [path/to/audio.wav] -n <repeats>
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import load_audio, split_chunks, batch_spectrogram, make_spectro, spectro_path
+
+###################################################################
+# CONFIGURATION DEFAULTS
+repeats = 3
+sample_rate = 48000 # Sample rate of the synthetic audio
+###################################################################
+
+def synthetic_minute(sample_rate=sample_rate, seed=0):
+    '''One minute of noise with a whistle like FM sweep between 5 and 8 kHz.'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(60 * sample_rate) / sample_rate
+    freq = 6500 + 1500 * np.sin(2 * np.pi * 0.3 * t)
+    whistle = 2000 * np.sin(2 * np.pi * np.cumsum(freq) / sample_rate)
+    return (rng.normal(0, 300, t.size) + whistle).astype(np.int16)
+
+def time_renderer(f, t, Sxx_db, output_directory, renderer, repeats):
+    '''Best of 'repeats' wall times for rendering and writing one image, plus the image path.'''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image_name = make_spectro(f, t, Sxx_db[:10], spectro_path(f"bench_{renderer}", 0, output_directory), renderer)
+        times.append(time.perf_counter() - start)
+    return min(times), image_name
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wave_file_path", nargs='?', help="optional wave file to render, synthetic audio is used otherwise")
+    parser.add_argument("-n", "--repeats", type=int, default=repeats, help="number of timed renders per renderer")
+    args = parser.parse_args()
+
+    if args.wave_file_path:
+        rate, data = load_audio(args.wave_file_path)
+    else:
+        rate, data = sample_rate, synthetic_minute()
+    f, t, Sxx_db = batch_spectrogram(split_chunks(data, rate), rate)
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        mpl_time, mpl_image = time_renderer(f, t, Sxx_db, output_directory, 'matplotlib', args.repeats)
+        raster_time, raster_image = time_renderer(f, t, Sxx_db, output_directory, 'raster', args.repeats)
+
+        mpl = np.asarray(Image.open(mpl_image).convert('L'), dtype=float)
+        raster = Image.open(raster_image).convert('L')
+        if raster.size != mpl.shape[::-1]:
+            print(f"Image sizes differ: matplotlib {mpl.shape[::-1]}, raster {raster.size} (resizing raster to compare)")
+            raster = raster.resize(mpl.shape[::-1])
+        raster = np.asarray(raster, dtype=float)
+
+    difference = np.abs(mpl - raster)
+    correlation = np.corrcoef(mpl.ravel(), raster.ravel())[0, 1]
+    print(f"\nmatplotlib: {mpl_time * 1000:8.1f} ms per image")
+    print(f"raster:     {raster_time * 1000:8.1f} ms per image ({mpl_time / raster_time:.1f}x faster)")
+    print(f"pixel similarity: mean abs difference {difference.mean():.2f} / 255, "
+          f"{(difference <= 16).mean() * 100:.1f}% of pixels within 16 levels, correlation {correlation:.4f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+'''
+File:   compare_backends.py
+
+Spec:   Accuracy versus latency of the same detector run by different backends, on a held out
+        folder of spectrogram images: the PyTorch .pt model against its ONNX exports (float and
+        int8, see model_training/export_model.py) running on the CPU with onnxruntime.
+
+        Each model runs in its own process so its load time and peak memory are its own:
+            load            seconds to load the model
+            warmup          the first prediction (graph set up, allocations)
+            latency         per image with batch size 1: mean, median and 95th percentile
+            throughput      images per second at --batch
+            peak RSS        peak resident memory of the process
+
+        Accuracy is agreement with the first model (the reference, normally the .pt): detections
+        of the same class are matched at IoU >= 0.5, precision and recall count the matches from
+        each side, 'images' is the share of images both call positive or both call negative
+        (what decides whether an image is copied for the analyst). With --labels (YOLO label files
+        of the same images, ex: from create_pamguard_annotations.py) every model is also scored
+        against the ground truth.
+
+I/O:    Prints a table, --json saves every number.
+
+Usage:  python3 benchmarks/compare_backends.py <held/out/images> --models models/fkw_whistle_classifier_2.0.pt models/fkw_whistle_classifier_2.0.onnx models/fkw_whistle_classifier_2.0_int8.onnx
+        python3 benchmarks/compare_backends.py <held/out/images> --models a.pt a.onnx --labels <label/directory> -c 200 --json backends.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+
+###################################################################
+# CONFIGURATION DEFAULTS
+models = ["models/fkw_whistle_classifier_2.0.pt", "models/fkw_whistle_classifier_2.0.onnx"]
+image_count = 100               # Held out images used, 0 for all
+batch_size = 8                  # Batch size of the throughput run
+confidence = 0.25               # YOLO's default confidence threshold
+iou_match = 0.5                 # IoU for two detections (or a detection and a label) to count as the same
+###################################################################
+
+def list_images(image_directory, count=image_count):
+    image_paths = sorted(os.path.join(image_directory, f) for f in os.listdir(image_directory)
+                         if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    return image_paths[:count] if count else image_paths
+
+def run_model(model_path, image_paths, batch=batch_size, conf=confidence):
+    '''Time one model on the images (in this process) and collect its detections, see the Spec.'''
+    from ultralytics import YOLO
+    from dataset_prediction.inference_dataset import detection_boxes
+    from common.metrics import peak_rss_mb
+
+    start = time.perf_counter()
+    model = YOLO(model_path, task='detect')
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.predict(image_paths[0], conf=conf, verbose=False)
+    warmup = time.perf_counter() - start
+
+    latencies, boxes = [], {}
+    for image_path in image_paths:
+        start = time.perf_counter()
+        result = model.predict(image_path, conf=conf, verbose=False)[0]
+        latencies.append(time.perf_counter() - start)
+        boxes[os.path.basename(image_path)] = detection_boxes(result)
+
+    start = time.perf_counter()
+    for i in range(0, len(image_paths), batch):
+        for _ in model.predict(image_paths[i : i + batch], batch=batch, conf=conf, stream=True, verbose=False):
+            pass
+    throughput = len(image_paths) / (time.perf_counter() - start)
+
+    latencies_ms = np.array(latencies) * 1000
+    return {'model': model_path, 'load_s': round(load, 3), 'warmup_s': round(warmup, 3),
+            'latency_ms': {'mean': round(float(latencies_ms.mean()), 2), 'p50': round(float(np.percentile(latencies_ms, 50)), 2),
+                           'p95': round(float(np.percentile(latencies_ms, 95)), 2)},
+            'images_per_s': round(throughput, 2), 'batch': batch, 'peak_rss_mb': round(peak_rss_mb(), 1), 'boxes': boxes}
+
+def run_model_process(model_path, image_paths, batch=batch_size, conf=confidence):
+    '''run_model() in a fresh Python process, so imports, load time and memory are not shared between models.'''
+    with tempfile.TemporaryDirectory() as temporary:
+        images_file, result_file = os.path.join(temporary, 'images.json'), os.path.join(temporary, 'result.json')
+        with open(images_file, 'w') as file:
+            json.dump(image_paths, file)
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--run_one', model_path, '--images_file', images_file,
+                        '--out', result_file, '-b', str(batch), '--conf', str(conf)], check=True)
+        with open(result_file) as file:
+            return json.load(file)
+
+def iou(a, b):
+    '''IoU of two [x, y, width, height] center boxes.'''
+    overlap_w = min(a[0] + a[2] / 2, b[0] + b[2] / 2) - max(a[0] - a[2] / 2, b[0] - b[2] / 2)
+    overlap_h = min(a[1] + a[3] / 2, b[1] + b[3] / 2) - max(a[1] - a[3] / 2, b[1] - b[3] / 2)
+    if overlap_w <= 0 or overlap_h <= 0:
+        return 0.0
+    overlap = overlap_w * overlap_h
+    return overlap / (a[2] * a[3] + b[2] * b[3] - overlap)
+
+def match_count(detections, references, threshold=iou_match):
+    '''Greedy one to one matching, most confident detection first: number of detections matching a reference of the same class.'''
+    unmatched = list(references)
+    matched = 0
+    for detection in sorted(detections, key=lambda box: -box[1]):
+        best, best_iou = None, threshold
+        for reference in unmatched:
+            if reference[0] == detection[0]:
+                overlap = iou(detection[2:], reference[2:])
+                if overlap >= best_iou:
+                    best, best_iou = reference, overlap
+        if best is not None:
+            unmatched.remove(best)
+            matched += 1
+    return matched
+
+def agreement(boxes, reference_boxes):
+    '''Precision and recall of 'boxes' against 'reference_boxes' (image name -> boxes), and the share of images with the same positive / negative call.'''
+    matched = found = expected = same_call = 0
+    for name, references in reference_boxes.items():
+        detections = boxes.get(name, [])
+        matched += match_count(detections, references)
+        found += len(detections)
+        expected += len(references)
+        same_call += bool(detections) == bool(references)
+    return {'precision': round(matched / found, 4) if found else 1.0, 'recall': round(matched / expected, 4) if expected else 1.0,
+            'images': round(same_call / len(reference_boxes), 4) if reference_boxes else 1.0, 'detections': found}
+
+def read_labels(label_directory, image_names):
+    '''YOLO label files of the images as boxes like detection_boxes() (confidence 1), a missing file means no whistles.'''
+    labels = {}
+    for name in image_names:
+        label_path = os.path.join(label_directory, os.path.splitext(name)[0] + '.txt')
+        boxes = []
+        if os.path.exists(label_path):
+            with open(label_path) as file:
+                for line in file:
+                    values = line.split()
+                    if len(values) == 5:
+                        boxes.append([int(values[0]), 1.0] + [float(v) for v in values[1:]])
+        labels[name] = boxes
+    return labels
+
+def print_table(results):
+    print(f"\n{'model':<40} {'load s':>7} {'warmup s':>9} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>7} {'RSS MB':>7}")
+    for result in results:
+        latency = result['latency_ms']
+        print(f"{os.path.basename(result['model']):<40} {result['load_s']:>7.2f} {result['warmup_s']:>9.2f} {latency['mean']:>8.1f} "
+              f"{latency['p50']:>8.1f} {latency['p95']:>8.1f} {result['images_per_s']:>7.1f} {result['peak_rss_mb']:>7.0f}")
+
+    for key, title in (('agreement', f"agreement with {os.path.basename(results[0]['model'])}"), ('ground_truth', 'against the labels')):
+        if key not in results[-1]:
+            continue
+        print(f"\n{title:<40} {'precision':>9} {'recall':>7} {'images':>7} {'boxes':>7}")
+        for result in results:
+            scores = result[key]
+            print(f"{os.path.basename(result['model']):<40} {scores['precision']:>9.3f} {scores['recall']:>7.3f} "
+                  f"{scores['images']:>7.3f} {scores['detections']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_directory", nargs='?', help="held out spectrogram images")
+    parser.add_argument("--models", nargs='+', default=models, help="models to compare (.pt or .onnx), the first is the reference")
+    parser.add_argument("-c", "--count", type=int, default=image_count, help="number of images used, 0 for all")
+    parser.add_argument("-b", "--batch", type=int, default=batch_size, help="batch size of the throughput run")
+    parser.add_argument("--conf", type=float, default=confidence, help="confidence threshold, the same for every model")
+    parser.add_argument("--labels", help="YOLO label directory of the images, to score every model against the ground truth")
+    parser.add_argument("--json", help="save every result to this file")
+    parser.add_argument("--run_one", help=argparse.SUPPRESS) # Child process: one model, see run_model_process()
+    parser.add_argument("--images_file", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        with open(args.images_file) as file:
+            image_paths = json.load(file)
+        with open(args.out, 'w') as file:
+            json.dump(run_model(args.run_one, image_paths, args.batch, args.conf), file)
+        return
+
+    if not args.image_directory:
+        parser.error("Please specify a directory of held out images")
+    image_paths = list_images(args.image_directory, args.count)
+    if not image_paths:
+        print(f"No images in [{args.image_directory}]")
+        sys.exit(1)
+    missing = [model_path for model_path in args.models if not os.path.exists(model_path)]
+    if missing:
+        print(f"Models not found: {', '.join(missing)} (export ONNX models with model_training/export_model.py)")
+        sys.exit(1)
+
+    results = []
+    for model_path in args.models:
+        print(f"Running [{model_path}] on {len(image_paths)} images")
+        results.append(run_model_process(model_path, image_paths, args.batch, args.conf))
+
+    reference = results[0]['boxes']
+    labels = read_labels(args.labels, reference.keys()) if args.labels else None
+    for result in results:
+        result['agreement'] = agreement(result['boxes'], reference)
+        if labels is not None:
+            result['ground_truth'] = agreement(result['boxes'], labels)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'images': len(image_paths), 'conf': args.conf, 'results': results}, file, indent=1)
+
+if __name__ == '__main__':
+    main()
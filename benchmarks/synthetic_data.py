@@ -0,0 +1,113 @@
+'''
+File:   synthetic_data.py
+
+Spec:   Make a synthetic survey for benchmarks: consecutive one minute multichannel wave files
+        with whistle like FM sweeps buried in noise, plus a PAMGuard style CSV that annotates
+        every sweep (same columns as the R cruise export create_pamguard_annotations.py expects).
+        Everything is generated from a seed, so two runs give the same data.
+
+Usage:  python3 benchmarks/synthetic_data.py <output/directory> -n <number of minutes> -sr <sample rate> -ch <channels>
+'''
+
+import os
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+
+###################################################################
+# CONFIGURATION DEFAULTS
+sample_rate = 48000
+channels = 6
+minutes = 2
+whistles_per_minute = 8
+empty_share = 0.0                       # Share of minutes without whistles (ex: to tune audio_transform/prescreen.py)
+survey_start = datetime(2017, 7, 9, 3, 0, 0)
+pamguard_columns = ["UID","UTC","freqBeg","freqEnd","freqMean","freqStdDev","duration","freqSlopeMean","freqAbsSlopeMean",
+    "freqPosSlopeMean","freqNegSlopeMean","freqSlopeRatio","freqStepUp","freqStepDown","numSweepsDwnFlat","numSweepsDwnUp",
+    "numSweepsFlatDwn","numSweepsFlatUp","numSweepsUpDwn","numSweepsUpFlat","numInflections","freqCofm","freqQuarter1",
+    "freqQuarter2","freqQuarter3","freqSpread","freqMin","freqMax","freqRange","freqMedian","freqCenter","freqRelBw",
+    "freqMaxMinRatio","freqBegEndRatio","freqNumSteps","stepDur","freqBegSweep","freqBegUp","freqBegDwn","freqEndSweep",
+    "freqEndUp","freqEndDwn","freqSweepUpPercent","freqSweepDwnPercent","freqSweepFlatPercent","inflMaxDelta","inflMinDelta",
+    "inflMaxMinDelta","inflMeanDelta","inflStdDevDelta","inflMedianDelta","inflDur","BinaryFile","eventId","detectorName","db","species"]
+###################################################################
+
+def whistle_events(minute_start, rng, count=whistles_per_minute):
+    '''Random whistles inside one minute: start time, duration and the sweep's start / end frequency.'''
+    # Kept 1 s clear of the starts of the 30 s images, also once the CSV drops the fractional seconds (see write_pamguard_csv()),
+    # an annotation right on a boundary would be matched to the end of the image before it
+    offsets = rng.uniform(0, 54, count)
+    offsets = np.sort(np.where(offsets < 27, offsets + 1, offsets + 4)) # 1 - 28 s and 31 - 58 s
+    durations = rng.uniform(0.3, 2.0, count)
+    freq_begin = rng.uniform(4500, 8500, count)
+    freq_end = np.clip(freq_begin + rng.uniform(-2500, 2500, count), 4200, 8800)
+    return [(minute_start + timedelta(seconds=float(o)), float(d), float(b), float(e))
+            for o, d, b, e in zip(offsets, durations, freq_begin, freq_end)]
+
+def minute_of_audio(events, minute_start, sample_rate, channels, rng):
+    '''(samples, channels) int16 noise with every whistle added to every channel (at different levels).'''
+    samples = int(60 * sample_rate)
+    audio = rng.normal(0, 300, (samples, channels))
+    for start, duration, freq_begin, freq_end in events:
+        first = int((start - minute_start).total_seconds() * sample_rate)
+        t = np.arange(min(int(duration * sample_rate), samples - first)) / sample_rate
+        freq = freq_begin + (freq_end - freq_begin) * t / duration
+        sweep = np.sin(2 * np.pi * np.cumsum(freq) / sample_rate) * np.hanning(len(t))
+        audio[first:first + len(t)] += 1500 * sweep[:, None] * rng.uniform(0.3, 1.0, channels)
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+def write_recordings(directory, minutes=minutes, sample_rate=sample_rate, channels=channels, seed=0, empty_share=empty_share):
+    '''
+    Write consecutive one minute recordings named like the HICEAS files (1706_YYYYMMDD_HHMMSS_000.wav),
+    a share of them (empty_share) without whistles. Returns (wave file paths, whistle events).
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths, events = [], []
+    for minute in range(minutes):
+        minute_start = survey_start + timedelta(minutes=minute)
+        minute_events = whistle_events(minute_start, rng)
+        if empty_share and rng.random() < empty_share:
+            minute_events = []
+        path = os.path.join(directory, minute_start.strftime("1706_%Y%m%d_%H%M%S_000.wav"))
+        wavfile.write(path, sample_rate, minute_of_audio(minute_events, minute_start, sample_rate, channels, rng))
+        paths.append(path)
+        events.extend(minute_events)
+    return paths, events
+
+def write_pamguard_csv(path, events, seed=0):
+    '''A PAMGuard export with one row per whistle, half of the UTC times have no fractional seconds.'''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.uniform(0, 1, (len(events), len(pamguard_columns))), columns=pamguard_columns)
+    df['UID'] = np.arange(len(events)) + 1000
+    df['UTC'] = [start.strftime("%Y-%m-%d %H:%M:%S") if i % 2 else start.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                 for i, (start, _, _, _) in enumerate(events)]
+    df['duration'] = [duration for _, duration, _, _ in events]
+    df['freqBeg'] = [freq_begin for _, _, freq_begin, _ in events]
+    df['freqEnd'] = [freq_end for _, _, _, freq_end in events]
+    df['freqMin'] = np.minimum(df['freqBeg'], df['freqEnd'])
+    df['freqMax'] = np.maximum(df['freqBeg'], df['freqEnd'])
+    df['BinaryFile'] = 'WhistlesMoans_Whistle_and_Moan_Detector_Contours_20170709_030000.pgdf'
+    df['eventId'] = 1
+    df['detectorName'] = 'Whistle_and_Moan_Detector'
+    df['species'] = 33
+    df.to_csv(path) # The R export has an unnamed index column first
+    return path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="directory for the wave files and pamguard.csv")
+    parser.add_argument("-n", "--minutes", type=int, default=minutes, help="number of one minute recordings")
+    parser.add_argument("-sr", "--sample_rate", type=int, default=sample_rate, help="sample rate of the recordings")
+    parser.add_argument("-ch", "--channels", type=int, default=channels, help="number of channels per recording")
+    parser.add_argument("--empty", type=float, default=empty_share, help="share of minutes without whistles")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    paths, events = write_recordings(args.output, args.minutes, args.sample_rate, args.channels, args.seed, args.empty)
+    write_pamguard_csv(os.path.join(args.output, 'pamguard.csv'), events, args.seed)
+    print(f"Wrote {len(paths)} recordings with {len(events)} whistles to [{args.output}]")
+
+if __name__ == '__main__':
+    main()
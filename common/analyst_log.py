@@ -0,0 +1,167 @@
+'''
+File:   analyst_log.py
+
+Spec:   Analyst logs remember which files have already been analyzed (spectrogram_logs.csv,
+        inference_logs.csv). Each row is a file path followed by optional fields, ex:
+            /path/to/image.jpg,5,Copied
+        The log is loaded ONCE into a hash index so "has this file been analyzed?" is a
+        dictionary lookup instead of a rescan of the whole log for every file. New rows are
+        buffered and written in batches; callers should only record a file after its work succeeded.
+
+        Two backends share the same interface, picked by the log's file extension:
+            .csv                CSV file, same format as the existing logs (appended to)
+            .db / .sqlite       SQLite database with the path as a unique key
+
+Usage:  from common.analyst_log import open_log
+        with open_log('dataset_prediction/analyst_logs/inference_logs.csv') as log:
+            if image_path not in log:
+                ...
+                log.record(image_path, detection_count, 'Copied')
+
+        Import an existing CSV log into SQLite (lossless, export gives back the same rows):
+            python3 common/analyst_log.py import <path/to/log.csv> <path/to/log.db>
+            python3 common/analyst_log.py export <path/to/log.db> <path/to/log.csv>
+'''
+
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+batch_size = 50 # Number of new rows held in memory before they are written
+###################################################################
+
+class AnalystLog:
+    '''Common interface: a path -> fields index plus a buffer of rows waiting to be written.'''
+
+    def __init__(self, path, batch_size=batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.index = {}     # path -> list of fields (strings)
+        self.pending = []   # rows recorded but not yet written
+        self.flush_first = []   # flushed before every write of this log, see flush_before()
+        with metrics.stage('log_read'):
+            self.load()
+
+    def __contains__(self, file_path):
+        return file_path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, file_path):
+        '''Fields logged for a path (without the path), None if the path was never logged.'''
+        return self.index.get(file_path)
+
+    def record(self, file_path, *fields):
+        '''Log a file as analyzed, written once batch_size rows are waiting (or on flush/close).'''
+        fields = [str(field) for field in fields]
+        self.index[file_path] = fields
+        self.pending.append([file_path] + fields)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def rows(self):
+        '''Every logged row, oldest first, as [path, field, ...].'''
+        return [[file_path] + fields for file_path, fields in self.index.items()]
+
+    def flush_before(self, other):
+        '''
+        Flush 'other' (anything with a flush(), ex: the detection index or another log) before every write of
+        this log, so after a crash no file is logged as analyzed without its results saved there.
+        '''
+        self.flush_first.append(other)
+
+    def flush(self):
+        if self.pending:
+            for other in self.flush_first:
+                other.flush()
+            with metrics.stage('log_write'):
+                self.write(self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class CsvLog(AnalystLog):
+    '''The existing analyst_logs/*.csv format, read once and appended to.'''
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='r', newline='') as log_file:
+            for row in csv.reader(log_file):
+                if len(row) > 0:
+                    self.index[row[0]] = row[1:]
+
+    def write(self, rows):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, mode='a+', newline='') as log_file:
+            # Some existing logs do not end with a newline, don't glue the first new row onto the last old one
+            if log_file.tell() > 0:
+                log_file.seek(log_file.tell() - 1)
+                if log_file.read(1) not in ('\n', '\r'):
+                    log_file.write('\n')
+            csv.writer(log_file).writerows(rows)
+
+class SqliteLog(AnalystLog):
+    '''SQLite log, the path is the primary key and the remaining fields are stored as a JSON list.'''
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS log (path TEXT PRIMARY KEY, fields TEXT NOT NULL)")
+        for file_path, fields in self.connection.execute("SELECT path, fields FROM log ORDER BY rowid"):
+            self.index[file_path] = json.loads(fields)
+
+    def write(self, rows):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO log (path, fields) VALUES (?, ?)",
+                                        [(row[0], json.dumps(row[1:])) for row in rows])
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+def open_log(path, batch_size=batch_size):
+    '''Open an analyst log, the backend is chosen by the file extension (.csv, .db or .sqlite).'''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return CsvLog(path, batch_size)
+    if extension in ('.db', '.sqlite', '.sqlite3'):
+        return SqliteLog(path, batch_size)
+    raise ValueError(f"Unknown analyst log type [{path}], use .csv, .db or .sqlite")
+
+def copy_log(source_path, destination_path):
+    '''Copy every row of one analyst log into another (ex: CSV -> SQLite), returns the number of rows.'''
+    with open_log(source_path) as source, open_log(destination_path) as destination:
+        rows = source.rows()
+        for row in rows:
+            destination.record(*row)
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['import', 'export'], help="import a CSV log into SQLite or export SQLite to CSV")
+    parser.add_argument("source", help="log to read from")
+    parser.add_argument("destination", help="log to write to (rows are added to it)")
+    args = parser.parse_args()
+
+    count = copy_log(args.source, args.destination)
+    print(f"Copied {count} rows from [{args.source}] to [{args.destination}]")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+'''
+File:   detection_index.py
+
+Spec:   One index of every detection, keyed by absolute time, so questions like "which minutes on
+        Sette AC 44 had whistles between 03:00 and 05:00" are answered without walking thousands of
+        YOLO label files or opening any image.
+
+        Each box is mapped back to the audio it came from with the strip geometry the spectrograms
+        are drawn with (common/strip_geometry.py, the same numbers create_pamguard_annotations.py
+        uses the other way): the image name gives the UTC start of its first strip, the box's
+        y gives its strip and frequency range, its x the seconds into that strip.
+
+        The index is one .npz file of columns sorted by start time, so a time range is found with a
+        binary search. Every inferenced image is kept too (with or without detections), so the
+        minutes that were screened are known as well as the ones with whistles. Inferencing an image
+        again replaces its detections. The tools flush it before every write of their inference log
+        (flush_before() in common/analyst_log.py), so an image logged as analyzed is always in the index,
+        even after a crash. A flush only writes the images added since the last one, as a small part
+        file in <index>.parts/ (named by time, so later parts replace the images of earlier ones).
+        Loading the index merges its part files in memory, close() (or merge_parts flushes piling up)
+        rewrites the index file with them merged in and removes them. Every file is written to a
+        temporary name and renamed into place, so a reader never sees half a file.
+
+I/O:    Columns (one row per detection): start_ms, end_ms (UTC, milliseconds since 1970),
+        freq_low, freq_high (Hz), conf, cls, strip (0 - 9), image (row in the image table).
+        Image table: images (absolute paths), image_start_ms.
+
+Usage:  from common.detection_index import DetectionIndex
+        with DetectionIndex('dataset_prediction/analyst_logs/detections.npz') as index:
+            index.add(image_path, boxes)     # boxes: [class, confidence, x, y, width, height] normalized, per detection
+
+        Query it (times are UTC, --match keeps images whose path contains the text, ex: a recorder folder):
+            python3 common/detection_index.py --start 2017-07-09T03:00 --end 2017-07-09T05:00 --match AC_44 --minutes
+            python3 common/detection_index.py --encounters --conf 0.5
+        Add detections saved as YOLO label files before the index existed:
+            python3 common/detection_index.py --add_labels runs/detect/predict/labels --images <inferenced/image/directory>
+'''
+
+import os
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common.strip_geometry import (strip_duration, frequency_range, top_of_spectrogram_freq, normalized_strip_height,
+                                   normalized_stripe_ys)
+from common.file_names import recording_start_time, image_offset_seconds
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+index_path = 'dataset_prediction/analyst_logs/detections.npz'
+time_correction = 0.0           # Seconds added to every box time (create_pamguard_annotations.py draws PAMGuard annotations 1 s early, see its TODO)
+encounter_gap = 15              # Minutes without detections that end an encounter
+merge_parts = 64                # Part files (one per flush) merged into the index file once there are this many
+###################################################################
+
+epoch = datetime(1970, 1, 1)
+stripe_tops = np.array(list(normalized_stripe_ys.values()))
+columns = {'start_ms': np.int64, 'end_ms': np.int64, 'freq_low': np.float32, 'freq_high': np.float32,
+           'conf': np.float32, 'cls': np.int16, 'strip': np.int8, 'image': np.int32}
+
+def to_ms(time):
+    return int(round((time - epoch).total_seconds() * 1000))
+
+def from_ms(ms):
+    return epoch + timedelta(milliseconds=int(ms))
+
+def image_start_ms(image_path):
+    '''UTC start of an image's first strip (ms since 1970) from its name, None if the name carries no time.'''
+    try:
+        start = recording_start_time(image_path, milliseconds=True) + timedelta(seconds=image_offset_seconds(image_path))
+    except ValueError:
+        return None
+    return to_ms(start)
+
+def box_times_frequencies(start_ms, boxes):
+    '''
+    Map [class, confidence, x, y, width, height] boxes of an image starting at start_ms to
+    (start_ms, end_ms, freq_low, freq_high, strip) arrays, see strip_geometry.py.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 6)
+    x, y, width, height = boxes[:, 2:].T
+    strip = np.clip(np.searchsorted(stripe_tops, y, side='right') - 1, 0, len(stripe_tops) - 1)
+
+    # A strip spans the full image width, strip_duration seconds
+    strip_start = start_ms + (strip * strip_duration + time_correction) * 1000
+    start = strip_start + np.clip(x - width / 2, 0, 1) * strip_duration * 1000
+    end = strip_start + np.clip(x + width / 2, 0, 1) * strip_duration * 1000
+
+    # y grows down the strip, from top_of_spectrogram_freq at its top
+    hz_per_height = frequency_range / normalized_strip_height
+    top = np.clip(y - height / 2 - stripe_tops[strip], 0, normalized_strip_height)
+    bottom = np.clip(y + height / 2 - stripe_tops[strip], 0, normalized_strip_height)
+    return (np.round(start).astype(np.int64), np.round(end).astype(np.int64),
+            top_of_spectrogram_freq - bottom * hz_per_height, top_of_spectrogram_freq - top * hz_per_height, strip)
+
+def parts_directory(path):
+    '''Directory of the part files of an index file (one per flush, not merged into the index file yet).'''
+    return f"{path}.parts"
+
+def empty_table():
+    return {'images': np.empty(0, dtype=str), 'image_start_ms': np.empty(0, dtype=np.int64),
+            **{name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}}
+
+def read_table(path):
+    '''Image table and detection columns of an index or part file.'''
+    with np.load(path) as data:
+        return {name: data[name] for name in ('images', 'image_start_ms', *columns)}
+
+def write_table(path, table):
+    '''Save an index or part file (to a temporary file renamed into place).'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as file:
+        np.savez(file, **table)
+    os.replace(temporary_path, path)
+
+def pending_table(pending):
+    '''Table of the added images ({absolute image path: (image start ms, boxes)}), in the order they were added.'''
+    images, image_start = [], []
+    added = {name: [] for name in columns}
+    for image_path, (start, boxes) in pending.items():
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 6)
+        start_ms, end_ms, freq_low, freq_high, strip = box_times_frequencies(start, boxes)
+        for name, values in (('start_ms', start_ms), ('end_ms', end_ms), ('freq_low', freq_low), ('freq_high', freq_high),
+                             ('conf', boxes[:, 1]), ('cls', boxes[:, 0]), ('strip', strip),
+                             ('image', np.full(len(boxes), len(images)))):
+            added[name].append(values)
+        images.append(image_path)
+        image_start.append(start)
+    return {'images': np.array(images, dtype=str), 'image_start_ms': np.array(image_start, dtype=np.int64),
+            **{name: np.concatenate(values).astype(columns[name]) for name, values in added.items()}}
+
+def merge_tables(tables):
+    '''
+    One table of several: an image in a later table replaces the same image (and its detections) in the earlier ones.
+    Images and detections come out sorted by time, every detection pointing at its image's new row.
+    '''
+    images = np.concatenate([table['images'] for table in tables])
+    image_start = np.concatenate([table['image_start_ms'] for table in tables])
+    first_image = np.cumsum([0] + [len(table['images']) for table in tables[:-1]])
+    detection_image = np.concatenate([table['image'].astype(np.int64) + first for table, first in zip(tables, first_image)])
+
+    # Only the last copy of every image is kept
+    _, last = np.unique(images[::-1], return_index=True)
+    keep_image = np.zeros(len(images), dtype=bool)
+    keep_image[len(images) - 1 - last] = True
+    keep_row = keep_image[detection_image]
+    new_image_number = np.cumsum(keep_image) - 1
+    images, image_start = images[keep_image], image_start[keep_image]
+
+    # Images and detections both sorted by time, detections point at their image's new row
+    image_order = np.argsort(image_start, kind='stable')
+    image_row = np.empty_like(image_order)
+    image_row[image_order] = np.arange(len(image_order))
+    merged = {name: np.concatenate([table[name] for table in tables])[keep_row].astype(dtype) for name, dtype in columns.items()}
+    merged['image'] = image_row[new_image_number[detection_image[keep_row]]].astype(np.int32)
+    order = np.argsort(merged['start_ms'], kind='stable')
+    return {'images': images[image_order], 'image_start_ms': image_start[image_order],
+            **{name: column[order] for name, column in merged.items()}}
+
+class DetectionIndex:
+    '''
+    The detection columns and image table of one index file and its part files (as of the last load or merge),
+    plus the images added since the last flush.
+    '''
+
+    def __init__(self, path=index_path, merge_parts=merge_parts):
+        self.path = path
+        self.merge_parts = merge_parts
+        self.pending = {}   # absolute image path -> (image start ms, boxes)
+        self.flushes = 0
+        self.lock = threading.Lock() # add() and flush() can run on different threads (inference_dataset.py --prefetch)
+        self.load()
+
+    def part_paths(self):
+        '''Part files of the index, oldest first.'''
+        directory = parts_directory(self.path)
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.npz'))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    def read(self):
+        '''(the index file with its part files merged in, paths of those part files).'''
+        while True:
+            part_paths = self.part_paths()
+            try:
+                tables = [read_table(self.path)] if os.path.exists(self.path) else []
+                tables += [read_table(part_path) for part_path in part_paths]
+            except FileNotFoundError:
+                continue # Another run merged the parts into the index file meanwhile, read it again
+            if not part_paths:
+                return (tables[0] if tables else empty_table()), part_paths
+            return merge_tables(tables), part_paths
+
+    def use_table(self, table):
+        self.columns = {name: table[name] for name in columns}
+        self.images, self.image_start = table['images'], table['image_start_ms']
+
+    def load(self):
+        '''Read the index file and its part files (empty if there are none yet).'''
+        with metrics.stage('index_read'):
+            table, _ = self.read()
+        self.use_table(table)
+
+    def __len__(self):
+        return len(self.columns['start_ms'])
+
+    def add(self, image_path, boxes):
+        '''Remember the detections of an inferenced image (none is fine, the image still counts as screened).'''
+        start = image_start_ms(image_path)
+        if start is None:
+            print(f"[{image_path}] has no recording time in its name, not indexed")
+            return
+        with self.lock:
+            self.pending[os.path.abspath(image_path)] = (start, boxes)
+
+    def flush(self):
+        '''Save the images added since the last flush as a new part file, the index file itself is not rewritten.'''
+        with self.lock:
+            if not self.pending:
+                return
+            with metrics.stage('index_write'):
+                part_path = os.path.join(parts_directory(self.path), f"{time.time_ns():020d}-{os.getpid()}-{self.flushes}.npz")
+                write_table(part_path, pending_table(self.pending))
+            self.flushes += 1
+            self.pending = {}
+        if len(self.part_paths()) >= self.merge_parts:
+            self.merge()
+
+    def merge(self):
+        '''
+        Rewrite the index file with every part file merged in (re-read first, so detections other runs wrote are kept),
+        then remove those part files. This object's columns are the merged index afterwards.
+        '''
+        with self.lock:
+            with metrics.stage('index_read'):
+                table, part_paths = self.read()
+            self.use_table(table)
+            if not part_paths:
+                return
+            with metrics.stage('index_write'):
+                write_table(self.path, table)
+                for part_path in part_paths: # Only once the index file holding them is in place
+                    try:
+                        os.remove(part_path)
+                    except FileNotFoundError:
+                        pass
+
+    def close(self):
+        self.flush()
+        self.merge()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def image_mask(self, match=None):
+        '''True for every image whose path contains 'match' (every image without one).'''
+        if not match:
+            return np.ones(len(self.images), dtype=bool)
+        return np.char.find(self.images, match) >= 0
+
+    def query(self, start_ms=None, end_ms=None, match=None, min_conf=0.0):
+        '''Rows (in time order) of the detections overlapping [start_ms, end_ms) on images matching 'match' with conf >= min_conf.'''
+        starts = self.columns['start_ms']
+        # A box never outlasts its strip, so only starts up to one strip before the range can overlap it
+        first = 0 if start_ms is None else np.searchsorted(starts, start_ms - strip_duration * 1000, side='left')
+        last = len(starts) if end_ms is None else np.searchsorted(starts, end_ms, side='left')
+        rows = np.arange(first, last)
+        keep = self.columns['conf'][rows] >= min_conf if min_conf > 0 else np.ones(len(rows), dtype=bool) # Imported labels may have no conf (NaN)
+        if start_ms is not None:
+            keep &= self.columns['end_ms'][rows] > start_ms
+        if match:
+            keep &= self.image_mask(match)[self.columns['image'][rows]]
+        return rows[keep]
+
+    def screened(self, start_ms=None, end_ms=None, match=None):
+        '''Image table rows of the images inferenced in [start_ms, end_ms) (by the start of their first strip).'''
+        first = 0 if start_ms is None else np.searchsorted(self.image_start, start_ms, side='left')
+        last = len(self.image_start) if end_ms is None else np.searchsorted(self.image_start, end_ms, side='left')
+        rows = np.arange(first, last)
+        return rows[self.image_mask(match)[rows]] if match else rows
+
+    def minutes(self, rows):
+        '''(UTC minute, detections, highest confidence) of every minute with detections among 'rows'.'''
+        minute = self.columns['start_ms'][rows] // 60000
+        unique, first, counts = np.unique(minute, return_index=True, return_counts=True)
+        highest = np.fmax.reduceat(self.columns['conf'][rows], first) if len(rows) else np.empty(0)
+        return [(from_ms(m * 60000), int(n), float(c)) for m, n, c in zip(unique, counts, highest)]
+
+    def encounters(self, rows, gap_minutes=encounter_gap):
+        '''Detections among 'rows' grouped into encounters: a quiet gap longer than gap_minutes starts a new one.'''
+        starts, ends = self.columns['start_ms'][rows], self.columns['end_ms'][rows]
+        if not len(rows):
+            return []
+        latest_end = np.maximum.accumulate(ends)
+        breaks = np.flatnonzero(starts[1:] - latest_end[:-1] > gap_minutes * 60000) + 1
+        summaries = []
+        for group in np.split(np.arange(len(rows)), breaks):
+            group_rows = rows[group]
+            summaries.append({'start': from_ms(starts[group[0]]), 'end': from_ms(latest_end[group[-1]]), 'detections': len(group),
+                              'minutes': len(np.unique(starts[group] // 60000)),
+                              'images': len(np.unique(self.columns['image'][group_rows])),
+                              'freq_low': float(self.columns['freq_low'][group_rows].min()),
+                              'freq_high': float(self.columns['freq_high'][group_rows].max()),
+                              'max_conf': float(np.fmax.reduce(self.columns['conf'][group_rows]))})
+        return summaries
+
+def add_label_files(index, label_directory, image_directory=None, image_extension='.jpg'):
+    '''Index YOLO label files (class x y w h [conf], as written by save_txt), each one's image is the same name in image_directory.'''
+    added = 0
+    for entry in os.scandir(label_directory):
+        if not entry.name.endswith('.txt'):
+            continue
+        boxes = []
+        with open(entry.path) as file:
+            for line in file:
+                values = [float(value) for value in line.split()]
+                if len(values) >= 5:
+                    boxes.append([values[0], values[5] if len(values) > 5 else np.nan] + values[1:5]) # No conf without save_conf
+        index.add(os.path.join(image_directory or label_directory, os.path.splitext(entry.name)[0] + image_extension), boxes)
+        added += 1
+    return added
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index", nargs='?', default=index_path, help="detection index file")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="UTC, ex: 2017-07-09T03:00")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="UTC, ex: 2017-07-09T05:00")
+    parser.add_argument("--match", help="only images whose path contains this text (ex: a recorder folder like AC_44)")
+    parser.add_argument("--conf", type=float, default=0.0, help="minimum detection confidence")
+    parser.add_argument("--minutes", action="store_true", help="list the minutes with detections")
+    parser.add_argument("--encounters", action="store_true", help=f"summarize encounters (detections less than --gap minutes apart)")
+    parser.add_argument("--gap", type=float, default=encounter_gap, help="minutes without detections that end an encounter")
+    parser.add_argument("--limit", type=int, default=50, help="detections listed without --minutes or --encounters")
+    parser.add_argument("--add_labels", help="add the YOLO label files in this directory to the index")
+    parser.add_argument("--images", help="with --add_labels: directory of the labelled images (default: the label directory)")
+    args = parser.parse_args()
+
+    index = DetectionIndex(args.index)
+    if args.add_labels:
+        added = add_label_files(index, args.add_labels, args.images)
+        index.close()
+        print(f"Indexed {added} label files from [{args.add_labels}], {len(index)} detections in [{args.index}]")
+        return
+
+    query_start = time.perf_counter()
+    start_ms = to_ms(args.start) if args.start else None
+    end_ms = to_ms(args.end) if args.end else None
+    rows = index.query(start_ms, end_ms, args.match, args.conf)
+    screened = index.screened(start_ms, end_ms, args.match)
+    screened_minutes = len(np.unique(index.image_start[screened] // 60000))
+    results = index.minutes(rows) if args.minutes else index.encounters(rows, args.gap) if args.encounters else None
+    elapsed_ms = (time.perf_counter() - query_start) * 1000
+
+    print(f"{len(rows)} detections in {len(np.unique(index.columns['image'][rows]))} of {len(screened)} screened images "
+          f"({screened_minutes} minutes screened), query {elapsed_ms:.1f} ms")
+    if args.minutes:
+        for minute, detections, highest in results:
+            print(f"{minute:%Y-%m-%d %H:%M}  {detections:>5} detections  (highest confidence {highest:.2f})")
+    elif args.encounters:
+        for n, encounter in enumerate(results, start=1):
+            print(f"Encounter {n}: {encounter['start']:%Y-%m-%d %H:%M:%S} - {encounter['end']:%H:%M:%S}  "
+                  f"{encounter['detections']} detections in {encounter['minutes']} minutes ({encounter['images']} images), "
+                  f"{encounter['freq_low']:.0f} - {encounter['freq_high']:.0f} Hz, highest confidence {encounter['max_conf']:.2f}")
+    else:
+        for row in rows[:args.limit]:
+            print(f"{from_ms(index.columns['start_ms'][row]):%Y-%m-%d %H:%M:%S.%f}"[:-3] +
+                  f"  {(index.columns['end_ms'][row] - index.columns['start_ms'][row]) / 1000:5.2f} s  "
+                  f"{index.columns['freq_low'][row]:5.0f} - {index.columns['freq_high'][row]:5.0f} Hz  "
+                  f"conf {index.columns['conf'][row]:.2f}  [{index.images[index.columns['image'][row]]}]")
+        if len(rows) > args.limit:
+            print(f"... {len(rows) - args.limit} more (--limit)")
+
+if __name__ == '__main__':
+    main()
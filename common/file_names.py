@@ -0,0 +1,42 @@
+'''
+File:   file_names.py
+
+Spec:   Helpers for the recording and spectrogram image naming scheme.
+        Recordings are named <cruise>_<YYYYMMDD>_<HHMMSS>_<mmm>.wav, ex: 1706_20170709_034442_942.wav
+        Images are named <recording>-<NNNN>.jpg where NNNN is the (1 based) number of the
+        first strip in the image counted from the start of the recording,
+        ex: -0001 starts at 0 seconds, -0011 at 30 seconds, -0021 at 60 seconds.
+'''
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common.strip_geometry import strip_duration
+
+def recording_start_time(file_name, milliseconds=False):
+    '''
+    Start time of a recording (or image made from one) from its file name.
+    Raises ValueError if the name does not follow the naming scheme.
+    '''
+    base = os.path.splitext(os.path.basename(file_name))[0].split('-')[0]  # '1706_20170709_034442_942'
+    parts = base.split('_')  # ['1706', '20170709', '034442', '942']
+    if len(parts) < 3:
+        raise ValueError(f"[{file_name}] does not look like <cruise>_<date>_<time>_<ms>")
+
+    dt = datetime.strptime(f"{parts[1]}_{parts[2]}", "%Y%m%d_%H%M%S")
+    if milliseconds and len(parts) > 3 and parts[3].isdigit():
+        dt += timedelta(milliseconds=int(parts[3]))
+    return dt
+
+def image_offset_seconds(file_name):
+    '''Seconds between the start of the recording and the first strip of an image, 0 if there is no -NNNN suffix.'''
+    base = os.path.splitext(os.path.basename(file_name))[0]
+    if '-' not in base:
+        return 0
+    return (int(base.split('-')[-1]) - 1) * strip_duration
+
+def image_name(audio_file_name, first_strip):
+    '''Name (without extension) of the image whose first strip is strip number 'first_strip' (0 based).'''
+    return audio_file_name + '-' + str("{:04}".format(first_strip + 1))
@@ -0,0 +1,259 @@
+'''
+File:   metrics.py
+
+Spec:   Per stage timing shared by every script, so a slow run (ex: on the Pi) can be traced to
+        the stage that is actually slow. Code marks its stages with
+            with metrics.stage('stft'):
+                ...
+        and counts the things it finished with metrics.count('files'). Wall time and CPU time
+        (of the thread running the stage) are added up per stage for the whole process.
+        Stage names used across the tools:
+
+            wav_header      reading and checking a wave file's header
+            wav_read        reading the selected channel's samples (the channel is picked out while
+                            reading, only its samples are copied, so channel selection is part of this stage)
+            decimate        audio_to_spectro.py --decimate: polyphase low pass and downsampling before the FFT
+            stft            batched spectrogram of every strip (of every channel with -ch 1,3,5 or auto)
+            channel_select  -ch auto: band SNR of every channel and picking the best
+            prescreen       audio_transform/prescreen.py: band energy and tonal score of every chunk of an image
+            render          drawing the strips (matplotlib figure or raster image)
+            encode          JPEG encoding (matplotlib's savefig also rasterizes the figure here)
+            write           writing encoded images to disk
+            model_load      loading the YOLO model
+            decode          reading images back for inference (inference_dataset.py --prefetch)
+            inference       YOLO prediction
+            copy            copying positive images
+            label_write     writing YOLO label files
+            log_read        loading an analyst log
+            log_write       writing analyst log rows
+            index_read, index_write
+                            reading the detection index with its part files merged in / saving a part file (each flush)
+                            or the merged index file (common/detection_index.py)
+            threshold       noise_reduction_audio_to_spectro.py's dB threshold
+            place           hard linking, symlinking or copying dataset files (split_dataset.py)
+            resize          train_model.py --preprocess: resizing images to the training resolution
+            train_epoch, data_wait
+                            train_model.py: training part of each epoch, and the time in it spent waiting on the data loader
+            cache_read, cache_write
+                            reading / saving spectrogram arrays in the cache (audio_transform/spectro_cache.py)
+            manifest_list, manifest_headers, manifest_read, manifest_write
+                            audio_transform/recording_manifest.py: listing folders, reading the headers of new or changed
+                            wave files, loading and saving the manifest
+            spectrogram_list, annotation_read, match
+                            create_pamguard_annotations.py: listing the images, reading the PAMGuard CSV, matching
+            annotation_cache
+                            reading / saving the parsed PAMGuard columns (common/pamguard_csv.py)
+
+        Recording is always on (it costs a few microseconds per stage). With a metrics file
+        every stage is written as one JSON line, followed by a summary line at the end of the run
+        (stage totals, files per second and peak RSS), and the summary can be printed as a table.
+
+I/O:    JSON lines, appended so many runs can share a file, every line has a 'type' and a 'run':
+            {"type": "start", "run": ..., "script": ..., "host": ..., "argv": [...], "time": ...}
+            {"type": "stage", "run": ..., "stage": "stft", "start_s": 1.234, "wall_s": 0.052, "cpu_s": 0.051}
+            {"type": "summary", "run": ..., "wall_s": ..., "cpu_s": ..., "peak_rss_mb": ...,
+             "counts": {"files": 10}, "rates": {"files_per_s": 1.2}, "stages": {"stft": {"calls": ..., "wall_s": ..., "cpu_s": ...}}}
+
+Usage:  from common import metrics
+        metrics.add_arguments(parser)               # --metrics <file.jsonl> and --summary
+        args = parser.parse_args()
+        metrics.start('analyze_dataset', args.metrics, args.summary)
+        try:
+            ...
+        finally:
+            metrics.finish()
+
+        Summarize an existing metrics file (the last run, or every run with --all):
+            python3 common/metrics.py <metrics.jsonl>
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+###################################################################
+# CONFIGURATION DEFAULTS
+flush_every = 200 # Number of stage lines held in memory before they are written
+###################################################################
+
+def peak_rss_mb():
+    '''Peak resident memory of this process in MB.'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, kB elsewhere
+
+class Metrics:
+    '''Thread safe running totals per stage, plus the stage lines waiting to be written to the metrics file.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        self.path = None
+        self.show_summary = False
+        self.run = None
+        self.worker_peak_rss_mb = 0.0
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+
+    def reset(self):
+        self.totals = defaultdict(lambda: [0, 0.0, 0.0]) # stage -> [calls, wall seconds, cpu seconds]
+        self.counts = defaultdict(int)
+        self.pending = []
+
+    @contextmanager
+    def stage(self, name):
+        '''Time the code inside the with block as one call of stage 'name'.'''
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, time.thread_time() - start_cpu, start)
+
+    def add(self, name, wall, cpu=0.0, start=None, calls=1):
+        '''Add 'calls' calls of a stage that were timed elsewhere.'''
+        with self.lock:
+            total = self.totals[name]
+            total[0] += calls
+            total[1] += wall
+            total[2] += cpu
+            if self.path is not None:
+                offset = (start if start is not None else time.perf_counter() - wall) - self.started
+                line = {'type': 'stage', 'run': self.run, 'stage': name, 'start_s': round(offset, 6),
+                        'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6)}
+                if calls != 1:
+                    line['calls'] = calls
+                self.pending.append(line)
+                if len(self.pending) >= flush_every:
+                    self.write(self.pending)
+                    self.pending = []
+
+    def count(self, name, n=1):
+        '''Count finished work (ex: 'files', 'images'), reported per second in the summary.'''
+        with self.lock:
+            self.counts[name] += n
+
+    def take(self):
+        '''Totals recorded since the last take() (for worker processes to send back), then start over.'''
+        with self.lock:
+            totals = {name: list(total) for name, total in self.totals.items()}
+            counts = dict(self.counts)
+            self.reset()
+        return totals, counts, peak_rss_mb()
+
+    def merge(self, taken):
+        '''Add the totals of a worker process (from its take()) to this process's totals.'''
+        totals, counts, worker_peak = taken
+        self.worker_peak_rss_mb = max(self.worker_peak_rss_mb, worker_peak)
+        for name, (calls, wall, cpu) in totals.items():
+            self.add(name, wall, cpu, calls=calls)
+        for name, n in counts.items():
+            self.count(name, n)
+
+    def init_worker(self):
+        '''Pool initializer: a forked worker starts with the parent's totals, forget them (the parent writes the metrics file).'''
+        self.path = None
+        self.show_summary = False
+        self.reset()
+
+    def start(self, script, path=None, show_summary=False):
+        '''Begin a run, with a path every stage and the summary are appended to that JSONL file.'''
+        self.path = path
+        self.show_summary = show_summary
+        self.run = f"{script}-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        if path is not None:
+            self.write([{'type': 'start', 'run': self.run, 'script': script, 'host': socket.gethostname(),
+                         'argv': sys.argv, 'time': datetime.now().isoformat(timespec='seconds')}])
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        with self.lock:
+            stages = {name: {'calls': calls, 'wall_s': round(stage_wall, 6), 'cpu_s': round(cpu, 6)}
+                      for name, (calls, stage_wall, cpu) in self.totals.items()}
+            counts = dict(self.counts)
+        summary = {'type': 'summary', 'run': self.run, 'wall_s': round(wall, 6),
+                   'cpu_s': round(time.process_time() - self.started_cpu, 6), 'peak_rss_mb': round(peak_rss_mb(), 1),
+                   'counts': counts, 'rates': {f'{name}_per_s': round(n / wall, 4) for name, n in counts.items() if wall > 0},
+                   'stages': stages}
+        if self.worker_peak_rss_mb:
+            summary['worker_peak_rss_mb'] = round(self.worker_peak_rss_mb, 1) # Largest peak of any worker process
+        return summary
+
+    def finish(self):
+        '''End the run: write what is left and the summary line, print the table if asked for.'''
+        summary = self.summary()
+        if self.path is not None:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            self.write(pending + [summary])
+        if self.show_summary:
+            print_summary(summary)
+        return summary
+
+    def write(self, records):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as file:
+            file.writelines(json.dumps(record) + '\n' for record in records)
+
+def print_summary(summary):
+    '''Print a summary record as a table, slowest stage first.'''
+    wall = summary['wall_s']
+    print(f"\n{'stage':<18} {'calls':>7} {'wall s':>9} {'cpu s':>9} {'% of run':>9}")
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_s']):
+        print(f"{name:<18} {stage['calls']:>7} {stage['wall_s']:>9.2f} {stage['cpu_s']:>9.2f} {100 * stage['wall_s'] / wall if wall else 0:>8.1f}%")
+    busy = sum(stage['wall_s'] for stage in summary['stages'].values())
+    print(f"{'run':<18} {'':>7} {wall:>9.2f} {summary['cpu_s']:>9.2f} "
+          f"({max(busy - wall, 0):.2f} s of stage time overlapped)")
+    for name, rate in summary['rates'].items():
+        print(f"{name.replace('_per_s', ''):<18} {summary['counts'][name[:-6]]:>7} ({rate:.2f} per second)")
+    print(f"{'peak RSS':<18} {summary['peak_rss_mb']:.1f} MB"
+          + (f" (workers {summary['worker_peak_rss_mb']:.1f} MB each at most)" if 'worker_peak_rss_mb' in summary else ''))
+
+# One recorder per process, shared by every module
+recorder = Metrics()
+stage = recorder.stage
+add = recorder.add
+count = recorder.count
+take = recorder.take
+merge = recorder.merge
+init_worker = recorder.init_worker
+start = recorder.start
+finish = recorder.finish
+
+def add_arguments(parser):
+    '''The --metrics and --summary options every script accepts.'''
+    parser.add_argument("--metrics", help="append per stage timing to this JSON lines file (see common/metrics.py)")
+    parser.add_argument("--summary", action="store_true", help="print time spent per stage at the end of the run")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("metrics_file", help="JSON lines file written with --metrics")
+    parser.add_argument("--all", action="store_true", help="summarize every run in the file, not only the last one")
+    args = parser.parse_args()
+
+    with open(args.metrics_file) as file:
+        summaries = [record for record in map(json.loads, file) if record.get('type') == 'summary']
+    if not summaries:
+        print(f"No finished runs in [{args.metrics_file}]")
+        sys.exit(1)
+    for summary in (summaries if args.all else summaries[-1:]):
+        print(f"\nRun [{summary['run']}]")
+        print_summary(summary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+File:   pamguard_csv.py
+
+Spec:   Fast loader of PAMGuard whistle exports (the CSV create_pamguard_annotations.py and prescreen.py read).
+        An export has ~60 feature columns, but only UTC, duration, freqMin, freqMax and species are used:
+            - only those columns are parsed, with fixed dtypes (no type guessing)
+            - the file is read chunk_rows rows at a time and only the five columns of each chunk are kept,
+              so a multi gigabyte cruise export never has to fit in memory as a whole
+            - UTC is parsed as ISO 8601, which takes times with and without fractional seconds
+              (2017-07-09 03:04:08.443 and 2017-07-09 03:04:15) in one vectorized pass, times that
+              cannot be parsed become NaT (create_pamguard_annotations.py skips those)
+        The parsed columns are cached as one .npz per CSV in cache_directory, checked against the CSV's
+        size and modification time, so every later run against the same export skips the CSV entirely.
+
+I/O:    Returns a DataFrame with columns UTC (datetime64[ns]), duration, freqMin, freqMax (float64) and
+        species (int64, or float64 if some rows have no species), one row per CSV row in file order.
+
+Usage:  from common.pamguard_csv import load_pamguard_csv
+        df = load_pamguard_csv('path/to/pamguard.csv')
+
+        Parse (or refresh the cache of) an export and print how long it took:
+            python3 common/pamguard_csv.py <path/to/pamguard.csv> [--no_cache]
+'''
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+cache_directory = 'model_training/annotation_cache' # None turns the cache off
+chunk_rows = 200000             # CSV rows parsed at a time
+###################################################################
+
+columns = {'UTC': str, 'duration': np.float64, 'freqMin': np.float64, 'freqMax': np.float64, 'species': np.float64}
+cache_version = 1               # Bump when the cached columns change, older cache files are then parsed again
+
+def cache_path(csv_path, directory=cache_directory):
+    '''Cache file of one CSV (by its absolute path, the file's size and modification time are checked inside).'''
+    csv_name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(directory, f"{csv_name}_{hashlib.sha1(os.path.abspath(csv_path).encode()).hexdigest()[:16]}.npz")
+
+def source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return np.array([cache_version, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def parse_utc(values):
+    '''ISO 8601 times with or without fractional seconds to datetime64[ns], NaT for anything else.'''
+    return pd.to_datetime(values, format='ISO8601', errors='coerce')
+
+def read_csv_columns(csv_path, chunk_rows=chunk_rows):
+    '''Parse the used columns of the CSV a chunk at a time, returns a dict of numpy arrays (UTC as datetime64[ns]).'''
+    parts = {name: [] for name in columns}
+    with metrics.stage('annotation_read'):
+        for chunk in pd.read_csv(csv_path, usecols=list(columns), dtype=columns, chunksize=chunk_rows):
+            parts['UTC'].append(parse_utc(chunk['UTC']).to_numpy(dtype='datetime64[ns]'))
+            for name in columns:
+                if name != 'UTC':
+                    parts[name].append(chunk[name].to_numpy())
+            metrics.count('annotation_rows', len(chunk))
+    return {name: np.concatenate(arrays) if arrays else np.empty(0, dtype='datetime64[ns]' if name == 'UTC' else dtype)
+            for (name, arrays), dtype in zip(parts.items(), columns.values())}
+
+def to_frame(data):
+    '''DataFrame of the columns, species as integers unless some rows have none.'''
+    df = pd.DataFrame(data)
+    species = df['species'].to_numpy()
+    if np.all(np.isfinite(species)) and np.all(species == np.round(species)):
+        df['species'] = species.astype(np.int64)
+    return df
+
+def load_pamguard_csv(csv_path, cache_directory=cache_directory, chunk_rows=chunk_rows):
+    '''
+    UTC, duration, freqMin, freqMax and species of every row of a PAMGuard export (see above).
+    Read from the cache when it was made from this exact file, otherwise parsed and cached (cache_directory None: never cached).
+    '''
+    stamp = source_stamp(csv_path)
+    path = cache_path(csv_path, cache_directory) if cache_directory else None
+    if path is not None:
+        try:
+            with metrics.stage('annotation_cache'):
+                with np.load(path) as cached:
+                    if np.array_equal(cached['source'], stamp):
+                        return to_frame({name: cached[name] for name in columns})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Annotation cache [{path}] could not be read ({e}), parsing the CSV again")
+
+    data = read_csv_columns(csv_path, chunk_rows)
+    if path is not None:
+        with metrics.stage('annotation_cache'):
+            os.makedirs(cache_directory, exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, source=stamp, **data)
+            os.replace(temporary_path, path)
+    return to_frame(data)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_filepath", help="PAMGuard export")
+    parser.add_argument("--cache", default=cache_directory, help="directory of the parsed column cache")
+    parser.add_argument("--no_cache", action="store_true", help="parse the CSV without reading or writing the cache")
+    parser.add_argument("--chunk_rows", type=int, default=chunk_rows, help="CSV rows parsed at a time")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start('pamguard_csv', args.metrics, args.summary)
+    try:
+        start = time.perf_counter()
+        df = load_pamguard_csv(args.csv_filepath, None if args.no_cache else args.cache, args.chunk_rows)
+        elapsed = time.perf_counter() - start
+    finally:
+        metrics.finish()
+
+    times = df['UTC'].dropna()
+    print(f"{len(df)} annotations in {elapsed:.2f} s, {len(df) - len(times)} without a readable UTC"
+          + (f", {times.min()} - {times.max()}" if len(times) else ''))
+    print(df['species'].value_counts().rename('annotations').to_string())
+
+if __name__ == '__main__':
+    main()
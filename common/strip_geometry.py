@@ -0,0 +1,33 @@
+'''
+File:   strip_geometry.py
+
+Spec:   Where the ten spectrogram strips sit inside a spectrogram image.
+        The spectrogram renderers (audio_transform/) draw the strips here and
+        create_pamguard_annotations.py (model_training/) uses the same numbers to
+        turn PAMGuard annotations into YOLO boxes, so both must read them from this file.
+
+Note:   All y values are normalized to the image height, y=0.0 is the TOP of the image.
+'''
+
+###################################################################
+# CONFIGURATION DEFAULTS
+strips_per_image = 10 # Number of spectrogram strips stacked in one image
+strip_duration = 3 # Number of seconds represented in each strip
+frequency_range = 5000 # The difference between the minimum and maximum frequencies shown in the spectrograms
+top_of_spectrogram_freq = 9000 # The frequency at the very top of the spectrogram strip
+normalized_strip_height = 0.08394736909 # The vertical heigh of each strip (how thicc it is)
+normalized_stripe_ys = {
+    "y0": 0.00000000000000000,
+    "y1": 0.10163253864469451,
+    "y2": 0.20314887407501037,
+    "y3": 0.3059226305752359,
+    "y4": 0.4067793229338596,
+    "y5": 0.5089243688991303,
+    "y6": 0.6102942321889212,
+    "y7": 0.712957875364088,
+    "y8": 0.8144914649867669,
+    "y9": 0.9160526309037224
+
+} # Each number represents the normalized top of each strip
+image_size = (2374, 1474) # (width, height) in pixels of a 300 dpi matplotlib spectrogram image
+###################################################################
@@ -0,0 +1,222 @@
+'''
+File:   audio_pipeline.py
+
+Spec:   Screen audio for whistles in one step: wave files are turned into ten strip spectrogram
+        images in memory and the images are handed straight to the YOLO model. Nothing is written
+        to disk and read back unless it is wanted: an image is only saved when it has detections
+        (or always with --save_all).
+
+        Images are drawn with matplotlib by default, encoded to JPEG in memory and decoded for the
+        model, so the model sees the images it was trained on (made by audio_to_spectro.py, which
+        draws with matplotlib unless told otherwise). A saved image is exactly those JPEG bytes.
+        -r raster draws with NumPy (audio_transform/raster_render.py) and skips the JPEG, which is
+        much faster, but its shading and anti-aliasing are not matplotlib's. Only use it with a model
+        trained on raster images, or after checking that it gives the model's detections on your data
+        (run inference_dataset.py on both renderers' images of the same audio).
+
+        Detections are logged in the same format inference_dataset.py uses
+        (image path, number detections, 'Copied' if the image was saved), where the image path
+        is where the image is (or would be) saved. Wave files are logged in the spectrogram log
+        once all of their images have been inferenced, so reruns pick up where they left off.
+        Every box also goes to the detection index (common/detection_index.py) as a UTC time and frequency range.
+
+I/O:    Audio of any length is accepted, one image per 30 seconds (see stream_blocks() in audio_to_spectro.py).
+        -ch auto screens the channel with the best band SNR of each 30 seconds, several channels
+        (-ch 1,3,5) are all screened, their images are saved in ch<N> sub directories.
+        -d downsamples the audio to the lowest rate that keeps the band before the FFT (see audio_to_spectro.py).
+        --prescreen pre-screens every image: images without band energy or tonal contours are neither rendered nor
+        inferenced, they are recorded in the prescreen log instead (see audio_transform/prescreen.py).
+        --manifest picks the wave files from a manifest of their headers, only new or changed files are looked at
+        and files without a readable header are left out (see audio_transform/recording_manifest.py).
+
+Usage:  python3 dataset_prediction/audio_pipeline.py <dataset/path> -o <output/directory> -c <number of wave files>
+
+        --metrics <file.jsonl> / --summary record and print the time spent per stage (see common/metrics.py).
+'''
+
+import os
+import io
+import argparse
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import (stream_blocks, block_spectrograms, spectro_path, image_directory, parse_channel,
+                                              encode_spectro, desired_channel, plot_min, plot_max, decimate, renderer)
+from audio_transform.analyze_dataset import select_files
+from audio_transform.prescreen import Prescreen, record_screened_out, prescreen_logs_path
+from audio_transform.recording_manifest import RecordingManifest, manifest_path
+from audio_transform.raster_render import render_strips, save_image
+from dataset_prediction.inference_dataset import load_model, detection_boxes, backend
+from common.analyst_log import open_log
+from common.detection_index import DetectionIndex, index_path
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+model_path = "models/fkw_whistle_classifier_2.0.pt"
+spectrogram_logs_path = 'audio_transform/analyst_logs/spectrogram_logs.csv'
+inference_logs_path = 'dataset_prediction/analyst_logs/inference_logs.csv'
+file_count = 1                  # Number of wave files to screen
+batch_size = 4                  # Number of images run through the model at once
+###################################################################
+
+def render_image(f, t, Sxx_db, image_path, renderer=renderer):
+    '''
+    (RGB array, encoded image or None) of one ten strip image: with matplotlib the JPEG bytes savefig writes,
+    decoded for the model, with raster the NumPy image (encoded only if it is saved).
+    '''
+    if renderer == 'raster':
+        with metrics.stage('render'):
+            return render_strips(f, t, Sxx_db, plot_min, plot_max), None
+    encoded = encode_spectro(f, t, Sxx_db, os.path.splitext(image_path)[1][1:])
+    with metrics.stage('decode'):
+        image = np.asarray(Image.open(io.BytesIO(encoded)).convert('RGB'))
+    return image, encoded
+
+def infer_images(model, images, output_dir, save_all=False, index=None):
+    '''
+    Run YOLO on a batch of in memory images, images is a list of (image path, RGB array, encoded image or None).
+    Images with detections (or every image with save_all) are saved to their path, boxes go to the index if given.
+    Returns one inference log entry per image: image path, number detections, 'Copied' if saved.
+    '''
+    with metrics.stage('inference'):
+        results = model.predict([image for _, image, _ in images], batch=len(images), verbose=False)
+    metrics.count('images_inferenced', len(images))
+    entries = []
+    for (image_path, image, encoded), result in zip(images, results):
+        detection_count = len(result.boxes)
+        csv_entry = [image_path, detection_count]
+        if index is not None:
+            index.add(image_path, detection_boxes(result))
+        if detection_count >= 1 or save_all:
+            if encoded is None:
+                save_image(image, image_path)
+            else:
+                with metrics.stage('write'):
+                    with open(image_path, 'wb') as image_file:
+                        image_file.write(encoded)
+            print(f"Saved {image_path} ({detection_count} detections)")
+            if detection_count >= 1:
+                csv_entry.append('Copied')
+        entries.append(csv_entry)
+    return entries
+
+def screen_files(model, wave_file_paths, output_dir, channel=desired_channel, batch=batch_size, save_all=False,
+                 spectrogram_log=None, inference_log=None, index=None, decimate=decimate, prescreen=None, prescreen_log=None,
+                 renderer=renderer):
+    '''
+    Stream wave files through spectrogram generation and inference (decimate: see band_spectrogram() in audio_to_spectro.py),
+    images are drawn with renderer (see render_image()).
+    Images a Prescreen (audio_transform/prescreen.py) screens out are skipped and recorded in prescreen_log (if given).
+    A wave file that cannot be read is reported and skipped (not logged, so it is tried again on the next run).
+    Returns the number of images inferenced and the number of wave files that failed.
+    '''
+    pending = []            # (image path, image, encoded image or None) waiting for a full batch
+    finished_files = []     # Wave files whose images are all in 'pending' or already inferenced
+    image_total = 0
+    failures = 0
+
+    def run_batch():
+        nonlocal pending, finished_files, image_total
+        if pending:
+            for csv_entry in infer_images(model, pending, output_dir, save_all, index):
+                if inference_log is not None:
+                    inference_log.record(*csv_entry)
+            image_total += len(pending)
+        if prescreen is not None and prescreen_log is not None:
+            record_screened_out(prescreen_log, prescreen.take())
+        for wave_file_path in finished_files:
+            if spectrogram_log is not None:
+                spectrogram_log.record(wave_file_path)
+                print(f"Logged [{wave_file_path}] as analyzed")
+        pending, finished_files = [], []
+
+    for block in stream_blocks(wave_file_paths, channel):
+        if block.samples is None:
+            if block.error is not None:
+                failures += 1
+                print(f"Failed to screen [{block.wave_file_path}]: {block.error}")
+                continue
+            finished_files.append(block.wave_file_path)
+            metrics.count('files')
+            continue
+
+        f, t, spectrograms = block_spectrograms(block, channel, decimate=decimate)
+        for Sxx_db, subdirectory in spectrograms:
+            image_path = spectro_path(block.audio_file_name, block.first_strip, image_directory(output_dir, subdirectory))
+            if prescreen is not None and not prescreen.keep(f, Sxx_db, image_path):
+                continue
+            pending.append((image_path, *render_image(f, t, Sxx_db, image_path, renderer)))
+        if len(pending) >= batch:
+            run_batch()
+
+    run_batch()
+    return image_total, failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", help="screen audio in this directory")
+    parser.add_argument("-o", "--output", help="where images with detections are saved")
+    parser.add_argument("-c", "--count", type=int, default=file_count, help="number of wave files to screen")
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to transform: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)")
+    parser.add_argument("-r", "--renderer", choices=['matplotlib', 'raster'], default=renderer,
+                        help="how images are drawn: matplotlib like the training images, raster is much faster (see above)")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample to the lowest rate that keeps the band before the FFT")
+    parser.add_argument("--prescreen", action="store_true", help="skip images without band energy or tonal contours")
+    parser.add_argument("-m", "--model", default=model_path, help="YOLO model to run")
+    parser.add_argument("--backend", choices=['pytorch', 'onnx'], default=backend, help="run the .pt with PyTorch or the exported .onnx with onnxruntime")
+    parser.add_argument("-b", "--batch", type=int, default=batch_size, help="number of images run through the model at once")
+    parser.add_argument("--save_all", action="store_true", help="save every image, not only the ones with detections")
+    parser.add_argument("--spectrogram_log", default=spectrogram_logs_path, help="analyst log of screened wave files")
+    parser.add_argument("--inference_log", default=inference_logs_path, help="analyst log of image detections")
+    parser.add_argument("--prescreen_log", default=prescreen_logs_path, help="analyst log of the images the prescreen skipped")
+    parser.add_argument("--no_logs", action="store_true", help="ignore existing analyst logs and do not write new logs.")
+    parser.add_argument("--manifest", nargs='?', const=manifest_path,
+                        help=f"pick wave files from a header manifest (default {manifest_path}), see audio_transform/recording_manifest.py")
+    parser.add_argument("--index", default=index_path, help="detection index the boxes are added to (see common/detection_index.py)")
+    parser.add_argument("--no_index", action="store_true", help="do not add the boxes to the detection index")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.output):
+        parser.error("Please specify output directory")
+    os.makedirs(args.output, exist_ok=True)
+
+    metrics.start('audio_pipeline', args.metrics, args.summary)
+    spectrogram_log = None if args.no_logs else open_log(args.spectrogram_log)
+    inference_log = None if args.no_logs else open_log(args.inference_log)
+    prescreen = Prescreen() if args.prescreen else None
+    prescreen_log = open_log(args.prescreen_log) if args.prescreen and not args.no_logs else None
+    index = None if args.no_index else DetectionIndex(args.index)
+    # Nothing is logged before what it depends on is saved: a wave file after its images, an image after its detections
+    if spectrogram_log is not None and inference_log is not None:
+        spectrogram_log.flush_before(inference_log)
+    if inference_log is not None and index is not None:
+        inference_log.flush_before(index)
+    try:
+        manifest = RecordingManifest(args.manifest) if args.manifest else None
+        wave_file_paths = select_files(args.input_directory, args.count, spectrogram_log, manifest)
+        model = load_model(args.model, args.backend)
+
+        start = time.perf_counter()
+        image_total, failures = screen_files(model, wave_file_paths, args.output, args.channel, args.batch, args.save_all,
+                                             spectrogram_log, inference_log, index, args.decimate, prescreen, prescreen_log,
+                                             args.renderer)
+        elapsed = time.perf_counter() - start
+        print(f"Screened {len(wave_file_paths)} wave files ({image_total} images) in {elapsed:.2f} s")
+    finally:
+        for log in (spectrogram_log, inference_log, prescreen_log, index):
+            if log is not None:
+                log.close()
+        metrics.finish()
+
+    if failures:
+        print(f"{failures} of {len(wave_file_paths)} files failed")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
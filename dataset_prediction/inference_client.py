@@ -0,0 +1,101 @@
+'''
+File:   inference_client.py
+
+Spec:   Thin client for inference_server.py. Takes the same arguments as inference_dataset.py,
+        but instead of importing ultralytics and loading the model itself it sends the job to the
+        server, which already has the model loaded, so a run starts inferencing immediately.
+        Only the standard library is imported here.
+
+        The server selects the images, runs YOLO, copies positives and writes the analyst log
+        exactly like inference_dataset.py would from the directory this client is run in
+        (the boxes are added to the detection index too, see common/detection_index.py).
+        It answers with the detections of every image: count and boxes (class, confidence,
+        x, y, width, height normalized like YOLO labels), printed here or saved with --json.
+
+Usage:  python3 dataset_prediction/inference_server.py &                      (once, loads the model)
+        python3 dataset_prediction/inference_client.py <input/directory> -o <output/directory> -c <# of images> -b <batch size>
+        python3 dataset_prediction/inference_client.py --images a.jpg b.jpg   (specific images)
+        python3 dataset_prediction/inference_client.py --ping                 (is a server running, which model)
+        python3 dataset_prediction/inference_client.py --shutdown
+'''
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+###################################################################
+# CONFIGURATION DEFAULTS
+socket_path = '/tmp/fkw_inference.sock'     # Where the server listens
+image_count = 1
+batch_size = 1
+inference_logs_path = 'dataset_prediction/analyst_logs/inference_logs.csv'
+index_path = 'dataset_prediction/analyst_logs/detections.npz'
+###################################################################
+
+def send_job(request, path=socket_path):
+    '''Send one request to the server and wait for its answer (a dict, with 'error' if the job failed).'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall((json.dumps(request) + '\n').encode())
+        with connection.makefile('rb') as answer:
+            line = answer.readline()
+    if not line:
+        raise ConnectionError("The inference server closed the connection without answering")
+    return json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", nargs='?', help="process images in this directory")
+    parser.add_argument("--images", nargs='+', help="process these images instead of a directory")
+    parser.add_argument("-o", "--output", help="choose a location for image outputs")
+    parser.add_argument("-c", "--count", type=int, default=image_count, help="choose number of images to analyze")
+    parser.add_argument("-b", "--batch", type=int, default=batch_size, help="number of images run through the model at once")
+    parser.add_argument("--log", default=inference_logs_path, help="analyst log to check and write (.csv or .db/.sqlite)")
+    parser.add_argument("--no_logs", action="store_true", help="do not log image files to analyst logs or check existing logs.")
+    parser.add_argument("--index", default=index_path, help="detection index the boxes are added to (see common/detection_index.py)")
+    parser.add_argument("--no_index", action="store_true", help="do not add the boxes to the detection index")
+    parser.add_argument("--json", help="save the full answer (detections and boxes of every image) to this file")
+    parser.add_argument("--socket", default=socket_path, help="the server's Unix socket")
+    parser.add_argument("--ping", action="store_true", help="check that a server is running")
+    parser.add_argument("--shutdown", action="store_true", help="stop the server")
+    args = parser.parse_args()
+
+    if args.ping:
+        request = {'job': 'ping'}
+    elif args.shutdown:
+        request = {'job': 'shutdown'}
+    elif args.input_directory or args.images:
+        request = {'job': 'infer', 'cwd': os.getcwd(), 'input_directory': args.input_directory, 'images': args.images,
+                   'count': args.count, 'output': args.output, 'batch': args.batch,
+                   'log': None if args.no_logs else args.log, 'index': None if args.no_index else args.index}
+    else:
+        parser.error("Please specify an input directory or --images")
+
+    try:
+        answer = send_job(request, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No inference server at [{args.socket}], start one with: python3 dataset_prediction/inference_server.py")
+        sys.exit(1)
+
+    if 'error' in answer:
+        print(f"Job failed: {answer['error']}")
+        sys.exit(1)
+    if request['job'] != 'infer':
+        print(json.dumps(answer))
+        return
+
+    for image in answer['results']:
+        print(f"Image path = [{image['path']}] {image['detections']} detections{' (copied)' if image['copied'] else ''}")
+    if answer['results']:
+        print(f"Analyzed {len(answer['results'])} images in {answer['seconds']:.2f} s "
+              f"({len(answer['results']) / answer['seconds']:.2f} images per second, batch size {args.batch})")
+    else:
+        print("No images to analyze")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(answer, file, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,32 @@
 '''
 File:   inference_dataset.py
 
-Spec:   Inference dataset is designed to inference images in a directory 
-        and copy positive instances to a new location. 
-        
+Spec:   Inference dataset is designed to inference images in a directory
+        and copy positive instances to a new location.
+        The analyst log is read once per run (see common/analyst_log.py) and an image
+        is only logged once its inference has finished.
+
 Note:   Right now the program is only setup to handle one class.
 
-Usage:  python3 dataset_prediction/inference_dataset.py <input/directory> -o <output/directory> -c <# of images>
+Usage:  python3 dataset_prediction/inference_dataset.py <input/directory> -o <output/directory> -c <# of images> -b <batch size>
+
+        -p <threads> decodes the next images while the model runs and moves copies and log
+        writes to a background thread, the time spent in each stage is printed at the end.
+
+        Every box is also added to the detection index (common/detection_index.py) as a UTC time and
+        frequency range, so detections can be queried by time without reading label files (--no_index skips it).
+
+        --metrics <file.jsonl> records the time spent in each stage (model load, inference, copy,
+        log write ...) and --summary prints it, see common/metrics.py.
+
+        --backend onnx runs the model exported by model_training/export_model.py with onnxruntime
+        (faster on CPU only hosts like the Pi), compare the two with benchmarks/compare_backends.py.
+
+        For many short runs keep the model loaded in inference_server.py and run jobs with
+        inference_client.py (same arguments), which starts inferencing without loading anything.
+
+        Try a few batch sizes on each machine, the images per second printed at the end
+        shows which one is fastest (CPU hosts often gain little past 4 - 8).
 
 '''
 
@@ -14,119 +34,299 @@ import os
 from ultralytics import YOLO
 import shutil
 import argparse
-import csv
-import sys 
+import sys
+import time
+import queue
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common.analyst_log import open_log
+from common.detection_index import DetectionIndex, index_path
+from common import metrics
 
 ###################################################################
 # CONFIGURATION DEFAULTS
 model_path = "models/fkw_whistle_classifier_2.0.pt"   # Update with your trained model path
-# model_path = 'models/yolo11n.pt' # For debugging 
+# model_path = 'models/yolo11n.pt' # For debugging
 image_count = 1                                     # Set the number of images to process
+batch_size = 1                                      # Number of images per YOLO call
+inference_logs_path = 'dataset_prediction/analyst_logs/inference_logs.csv' # .csv or .db/.sqlite, see common/analyst_log.py
+prefetch_workers = 0                                # Threads decoding upcoming images (0 = let YOLO read each image itself)
+prefetch_depth = 2                                  # Number of batches decoded ahead of the model
+labels_directory = 'runs/detect/predict/labels'     # Where YOLO label files go when images are prefetched
+backend = 'pytorch'                                 # 'pytorch' (.pt) or 'onnx' (.onnx from model_training/export_model.py, run by onnxruntime)
 ###################################################################
-input_dir = ''
-# TODO: create condition that prints 'out of files' if all files in directory have been analyzed 
+# TODO: create condition that prints 'out of files' if all files in directory have been analyzed
 
-parser = argparse.ArgumentParser()
-parser.add_argument("input_directory", help="process images in this directory")
-parser.add_argument("-o", "--output", help="choose a location for image outputs")
-parser.add_argument("-c", "--count", type=int, default=1, help="choose number of images to analyze")
-parser.add_argument("--no_logs", action="store_true", help="do not log image files to analyst logs or check existing logs.")
+def select_images(input_dir, count, log=None):
+    '''
+    Pick 'count' number of JPEG images in a directory that have not been analyzed yet.
+    log is the inference log, None ignores existing logs.
+    '''
+    selected = []
+    for image_file in [f for f in os.listdir(input_dir) if f.endswith(".jpg")]:
+        image_path = os.path.join(input_dir, image_file)
 
-analyst_logging = True # Default to true 
-args = parser.parse_args() 
+        if not os.path.isfile(image_path):
+            print(f'Image [{image_path}] not found')
+            continue
+        if (len(selected) >= count):
+            print(f"Max file analysis count [{count}] reached")
+            break
 
-if (args.input_directory):
-    input_dir = args.input_directory
-else: 
-    parser.error("Please specify input directory")
-
-if (args.output):
-    output_dir = args.output
-    os.makedirs(output_dir, exist_ok=True)
-else:
-    output_dir = None 
-    
-if (args.count):
-    count = int(args.count)
-else:
-    count = 1 
-
-if (args.no_logs):
-    '''If no log is inacted, do not check logs and do not add to logs'''
-    analyst_logging = False
-    print("No logs, ignoring existing logs, not writing to new logs")
-
-
-# DEBUG 
-print(f'Input directory = [{input_dir}]')
-if (output_dir):
-    print(f'Output directory = [{output_dir}]')
-print(f'Count = [{count}]')
-
-# Load YOLO model
-model = YOLO(model_path)
-
-# Get list of JPEG images in directory
-image_files = [f for f in os.listdir(input_dir) if f.endswith(".jpg")]
-
-# Iterate through images
-i = 0
-for image_file in image_files:
-    '''
-    Run inference on 'count' number of images.
-    Save names into a csv, check for doubles. 
-    '''
-    image_path = os.path.join(input_dir, image_file) 
-    print(f"Image path = [{image_path}]")
-    
-    if os.path.isfile(image_path):
-        if (i > args.count): 
-            print(f"Max file analysis count [{args.count}] reached, exiting...")
-            sys.exit(0)
-    
-        with open('dataset_prediction/analyst_logs/inference_logs.csv', mode='a+', newline='') as inference_logs: 
-        
-            inference_logs.seek(0) # Move cursor to the start of the existing data
-            reader = csv.reader(inference_logs)
-           
-           # Check to see if file has already been analyzed (path included)
-            if any(len(row) > 0 and row[0] == image_path for row in reader):
-                if analyst_logging == True:
-                    print(f"Already analyzed [{image_path}]")
-                    continue 
-            
-            # Run YOLO inference
-            else:
-                csv_entry = [] 
-                writer = csv.writer(inference_logs)
-
-                # Include the image name
-                csv_entry.append(image_path)
-                
-                if analyst_logging == True:
-                    # Only print logged ___ if logging enabled
-                    print(f"Logged [{image_path}] as analyzed")
-                i = i + 1 # Only increment i if you have analyzed a file
-                result = model(image_path, verbose=False, save_txt=True)
-            
-                # Check if there are any detections
-                detection_count = 0 
-                for result in result:
-                    detection_count = len(result.boxes)
-                    csv_entry.append(detection_count) 
-
-               
+        # Check to see if file has already been analyzed (path included)
+        if log is not None and image_path in log:
+            print(f"Already analyzed [{image_path}]")
+            continue
+
+        selected.append(image_path)
+
+    return selected
+
+def load_model(model_path, backend=backend):
+    '''
+    Load a YOLO model. With backend 'onnx' the exported ONNX model (model_training/export_model.py) is
+    run by onnxruntime on the CPU: a .pt path is swapped for the .onnx next to it, or give the .onnx
+    (ex: the _int8.onnx) directly.
+    '''
+    with metrics.stage('model_load'):
+        if backend == 'onnx':
+            if not model_path.endswith('.onnx'):
+                onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+                if not os.path.exists(onnx_path):
+                    raise FileNotFoundError(f"No ONNX model [{onnx_path}], export it with: python3 model_training/export_model.py {model_path}")
+                model_path = onnx_path
+            return YOLO(model_path, task='detect')
+        return YOLO(model_path)
+
+def log_entry(image_path, result, output_dir=None):
+    '''
+    Turn one YOLO result into an analyst log entry and copy the image to output_dir if there are any detections.
+    Returns: image path, number detections, 'Copied' if the image was copied.
+    '''
+    csv_entry = [image_path]
+
+    # Check if there are any detections
+    detection_count = len(result.boxes)
+    csv_entry.append(detection_count)
+
+    if (detection_count >=1):
+        if (output_dir):
+            with metrics.stage('copy'):
+                shutil.copy2(image_path, output_dir)
+            # Store whether or not the image have been copied to new directory
+            csv_entry.append('Copied')
+
+    return csv_entry
+
+def predict_paths(model, image_paths):
+    '''
+    Run YOLO inference on a list of images as one batch, label files are written as YOLO does.
+    Returns one YOLO result per image, in the same order as image_paths.
+    '''
+    # YOLO sorts a list source, match results back to their image by (absolute) path
+    # (label files are written while the results stream, so they are part of the inference time)
+    with metrics.stage('inference'):
+        results = model.predict(image_paths, batch=len(image_paths), stream=True, verbose=False, save_txt=True)
+        results = {os.path.abspath(result.path): result for result in results}
+    metrics.count('images_inferenced', len(image_paths))
+    return [results[os.path.abspath(image_path)] for image_path in image_paths]
+
+def detection_boxes(result):
+    '''Every detection of a YOLO result as [class, confidence, x, y, width, height] (normalized, YOLO label format).'''
+    return [[int(c), round(float(conf), 4)] + [round(v, 6) for v in box]
+            for c, conf, box in zip(result.boxes.cls.tolist(), result.boxes.conf.tolist(), result.boxes.xywhn.tolist())]
+
+def infer_batch(model, image_paths, output_dir=None, index=None):
+    '''
+    Run YOLO inference on a list of images as one batch, the boxes go to the detection index if one is given.
+    Returns one analyst log entry per image, in the same order as image_paths.
+    '''
+    for image_path in image_paths:
+        print(f"Image path = [{image_path}]")
+
+    results = predict_paths(model, image_paths)
+    if index is not None:
+        for image_path, result in zip(image_paths, results):
+            index.add(image_path, detection_boxes(result))
+    return [log_entry(image_path, result, output_dir) for image_path, result in zip(image_paths, results)]
+
+class AsyncWriter:
+    '''
+    Runs file copies, label files and log writes on a background thread, in the order they are submitted,
+    so inference never waits on the filesystem. At most max_pending tasks wait at once.
+    Each task is timed as the stage it is submitted under (see common/metrics.py), None if it times itself.
+    '''
+
+    def __init__(self, max_pending=64):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            stage, function, args = task
+            try:
+                with metrics.stage(stage) if stage else nullcontext():
+                    function(*args)
+            except Exception as e:
+                print(f"Write failed: {e}")
+                self.error = self.error or e
+
+    def submit(self, stage, function, *args):
+        self.tasks.put((stage, function, args))
+
+    def close(self):
+        '''Wait for every submitted task to finish, raises the first error a task hit.'''
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def prefetch_batches(image_paths, batch, workers=prefetch_workers or 2, depth=prefetch_depth):
+    '''
+    Yield batches of (image path, decoded BGR image) while worker threads decode the next batches.
+    At most 'depth' decoded batches wait for the model, so memory stays bounded.
+    Images that cannot be read are reported and left out.
+    '''
+    def decode(image_path):
+        with metrics.stage('decode'):
+            return image_path, cv2.imread(image_path)
+
+    def finished(futures):
+        decoded = [future.result() for future in futures]
+        for image_path, image in decoded:
+            if image is None:
+                print(f'Image [{image_path}] could not be read')
+        return [(image_path, image) for image_path, image in decoded if image is not None]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for i in range(0, len(image_paths), batch):
+            in_flight.append([pool.submit(decode, image_path) for image_path in image_paths[i : i + batch]])
+            if len(in_flight) > depth:
+                yield finished(in_flight.popleft())
+        while in_flight:
+            yield finished(in_flight.popleft())
+
+def infer_prefetched(model, image_paths, output_dir=None, batch=batch_size, workers=prefetch_workers or 2,
+                     log=None, labels_dir=labels_directory, index=None):
+    '''
+    Inference with the three stages overlapped: image decoding (worker threads), YOLO (this thread)
+    and copies / label files / log writes (AsyncWriter). The time spent in each stage goes to common/metrics.py.
+    Returns the number of images inferenced.
+    '''
+    writer = AsyncWriter()
+    image_total = 0
+    try:
+        for decoded in prefetch_batches(image_paths, batch, workers):
+            if not decoded:
+                continue
+            with metrics.stage('inference'):
+                results = model.predict([image for _, image in decoded], batch=len(decoded), verbose=False)
+
+            for (image_path, _), result in zip(decoded, results):
+                print(f"Image path = [{image_path}]")
+                detection_count = len(result.boxes)
+                csv_entry = [image_path, detection_count]
+                if index is not None:
+                    index.add(image_path, detection_boxes(result))
                 if (detection_count >=1):
+                    label_path = os.path.join(labels_dir, os.path.splitext(os.path.basename(image_path))[0] + '.txt')
+                    writer.submit('label_write', result.save_txt, label_path)
                     if (output_dir):
-                        shutil.copy2(image_path, output_dir)
-                        # Store whether or not the image have been copied to new directory
+                        writer.submit('copy', shutil.copy2, image_path, output_dir)
                         csv_entry.append('Copied')
 
                 # Store: image path, number detections, if image was copied
-                if analyst_logging == True: 
-                    writer.writerow(csv_entry)
-    
-    else: 
-        print(f'Image [{image_path}] not found')
+                if log is not None:
+                    writer.submit(None, log.record, *csv_entry) # The log times its own writes
+            image_total += len(decoded)
+            metrics.count('images_inferenced', len(decoded))
+    finally:
+        writer.close()
+
+    return image_total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", help="process images in this directory")
+    parser.add_argument("-o", "--output", help="choose a location for image outputs")
+    parser.add_argument("-c", "--count", type=int, default=image_count, help="choose number of images to analyze")
+    parser.add_argument("-m", "--model", default=model_path, help="YOLO model to run")
+    parser.add_argument("--backend", choices=['pytorch', 'onnx'], default=backend, help="run the .pt with PyTorch or the exported .onnx with onnxruntime")
+    parser.add_argument("-b", "--batch", type=int, default=batch_size, help="number of images run through the model at once")
+    parser.add_argument("-p", "--prefetch", type=int, default=prefetch_workers,
+                        help="decode images ahead of the model with this many threads and write results in the background (0 = off)")
+    parser.add_argument("--labels_dir", default=labels_directory, help="where label files are written when prefetching")
+    parser.add_argument("--log", default=inference_logs_path, help="analyst log to check and write (.csv or .db/.sqlite)")
+    parser.add_argument("--no_logs", action="store_true", help="do not log image files to analyst logs or check existing logs.")
+    parser.add_argument("--index", default=index_path, help="detection index the boxes are added to (see common/detection_index.py)")
+    parser.add_argument("--no_index", action="store_true", help="do not add the boxes to the detection index")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    input_dir = args.input_directory
+
+    if (args.output):
+        output_dir = args.output
+        os.makedirs(output_dir, exist_ok=True)
+    else:
+        output_dir = None
+
+    if (args.no_logs):
+        '''If no log is inacted, do not check logs and do not add to logs'''
+        print("No logs, ignoring existing logs, not writing to new logs")
+
+    # DEBUG
+    print(f'Input directory = [{input_dir}]')
+    if (output_dir):
+        print(f'Output directory = [{output_dir}]')
+    print(f'Count = [{args.count}]')
+    print(f'Batch size = [{args.batch}]')
+
+    # With --prefetch the stages overlap, the summary shows how much of their time was hidden
+    metrics.start('inference_dataset', args.metrics, args.summary or args.prefetch > 0)
+    log = None if args.no_logs else open_log(args.log)
+    index = None if args.no_index else DetectionIndex(args.index)
+    if log is not None and index is not None:
+        log.flush_before(index) # An image is never logged as analyzed before its detections are in the index
+    try:
+        image_paths = select_images(input_dir, args.count, log)
+
+        # Load YOLO model
+        model = load_model(args.model, args.backend)
+
+        start = time.perf_counter()
+        if args.prefetch > 0:
+            infer_prefetched(model, image_paths, output_dir, args.batch, args.prefetch, log, args.labels_dir, index)
+        else:
+            for i in range(0, len(image_paths), args.batch):
+                for csv_entry in infer_batch(model, image_paths[i : i + args.batch], output_dir, index):
+
+                    # Store: image path, number detections, if image was copied
+                    if log is not None:
+                        log.record(*csv_entry)
+                        print(f"Logged [{csv_entry[0]}] as analyzed")
+
+        elapsed = time.perf_counter() - start
+        if image_paths:
+            print(f"Analyzed {len(image_paths)} images in {elapsed:.2f} s "
+                  f"({len(image_paths) / elapsed:.2f} images per second, batch size {args.batch})")
+    finally:
+        if log is not None:
+            log.close()
+        if index is not None:
+            index.close()
+        metrics.finish()
 
-  
\ No newline at end of file
+if __name__ == '__main__':
+    main()
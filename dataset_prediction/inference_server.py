@@ -0,0 +1,159 @@
+'''
+File:   inference_server.py
+
+Spec:   Long running inference server: imports ultralytics and loads the YOLO model once, then
+        takes jobs from inference_client.py over a local Unix socket, so short and frequent runs
+        (ex: on the Pi) do not pay the import and model load every time.
+
+        Jobs run one at a time in the order they connect (other clients wait in the socket's queue).
+        A job is run from the client's working directory, so relative paths, the analyst log and
+        YOLO's label files behave exactly like running inference_dataset.py there. The analyst log
+        is opened for each job (and written before answering), so it never goes stale when other
+        tools write to it between jobs. The same goes for the detection index (common/detection_index.py).
+
+I/O:    One JSON object per line each way.
+            {"job": "infer", "cwd": ..., "input_directory": ... or "images": [...], "count": ..., "output": ..., "batch": ..., "log": ..., "index": ...}
+            -> {"results": [{"path": ..., "detections": 1, "copied": true, "boxes": [[class, conf, x, y, w, h], ...]}], "seconds": ...}
+            {"job": "ping"}     -> {"model": ..., "uptime": ..., "jobs": ...}
+            {"job": "shutdown"} -> {"stopping": true}
+        A failed job answers {"error": "..."} and the server keeps running.
+
+Usage:  python3 dataset_prediction/inference_server.py -m <model.pt> [--backend onnx] [--socket /tmp/fkw_inference.sock]
+        Then run jobs with inference_client.py. Stop with Ctrl+C or inference_client.py --shutdown.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from dataset_prediction.inference_dataset import select_images, predict_paths, detection_boxes, log_entry, load_model, model_path, backend
+from dataset_prediction.inference_client import socket_path, image_count, batch_size
+from common.analyst_log import open_log
+from common.detection_index import DetectionIndex
+from common import metrics
+
+class JobHandler(socketserver.StreamRequestHandler):
+    '''Answers every request line of one connection.'''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                answer = self.server.run_job(json.loads(line))
+            except Exception as e:
+                print(f"Job failed: {e}")
+                answer = {'error': str(e)}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+class InferenceServer(socketserver.UnixStreamServer):
+    '''Unix socket server holding one loaded model, jobs are handled one at a time.'''
+
+    def __init__(self, path, model, model_name):
+        self.model = model
+        self.model_name = model_name
+        self.started = time.monotonic()
+        self.jobs = 0
+        self.stopping = False
+        self.home = os.getcwd()
+        super().__init__(path, JobHandler)
+
+    def run_job(self, request):
+        job = request.get('job')
+        if job == 'ping':
+            return {'model': self.model_name, 'uptime': round(time.monotonic() - self.started, 1), 'jobs': self.jobs}
+        if job == 'shutdown':
+            self.stopping = True
+            return {'stopping': True}
+        if job != 'infer':
+            raise ValueError(f"Unknown job [{job}]")
+
+        os.chdir(request.get('cwd') or self.home) # Relative paths mean the same thing as in the client
+        try:
+            return self.infer(request)
+        finally:
+            os.chdir(self.home)
+
+    def infer(self, request):
+        '''Select, inference, copy and log like inference_dataset.py, answer with every image's detections.'''
+        start = time.perf_counter()
+        output_dir = request.get('output')
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        batch = max(int(request.get('batch') or batch_size), 1)
+
+        log = open_log(request['log']) if request.get('log') else None
+        index = DetectionIndex(request['index']) if request.get('index') else None
+        if log is not None and index is not None:
+            log.flush_before(index) # An image is never logged as analyzed before its detections are in the index
+        try:
+            image_paths = request.get('images') or select_images(request['input_directory'], request.get('count', image_count), log)
+            missing = [image_path for image_path in image_paths if not os.path.isfile(image_path)]
+            if missing:
+                raise FileNotFoundError(f"Images not found: {', '.join(missing)}")
+            results = []
+            for i in range(0, len(image_paths), batch):
+                batch_paths = image_paths[i : i + batch]
+                for image_path, result in zip(batch_paths, predict_paths(self.model, batch_paths)):
+                    csv_entry = log_entry(image_path, result, output_dir)
+                    boxes = detection_boxes(result)
+                    if log is not None:
+                        log.record(*csv_entry)
+                    if index is not None:
+                        index.add(image_path, boxes)
+                    results.append({'path': image_path, 'detections': csv_entry[1], 'copied': len(csv_entry) > 2,
+                                    'boxes': boxes})
+        finally:
+            if log is not None:
+                log.close()
+            if index is not None:
+                index.close()
+
+        self.jobs += 1
+        seconds = time.perf_counter() - start
+        print(f"Job {self.jobs}: {len(results)} images in {seconds:.2f} s")
+        return {'results': results, 'seconds': round(seconds, 4)}
+
+def remove_stale_socket(path):
+    '''Remove a socket file left by a server that is gone, exit if a server is still answering on it.'''
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    print(f"An inference server is already running on [{path}]")
+    sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", default=model_path, help="YOLO model to keep loaded")
+    parser.add_argument("--backend", choices=['pytorch', 'onnx'], default=backend, help="run the .pt with PyTorch or the exported .onnx with onnxruntime")
+    parser.add_argument("--socket", default=socket_path, help="Unix socket to listen on")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    remove_stale_socket(args.socket)
+    metrics.start('inference_server', args.metrics, args.summary)
+    model = load_model(args.model, args.backend)
+
+    server = InferenceServer(args.socket, model, args.model)
+    print(f"Serving [{args.model}] on [{args.socket}] (Ctrl+C to stop)")
+    try:
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+'''
+File:   watch_recordings.py
+
+Spec:   Continuous version of analyze_dataset.py + inference_dataset.py for use while recording
+        is still going on (ex: on the Raspberry Pi aboard the vessel). The input directory is polled
+        for new wave files, a file is picked up once it is fully written (its size has stopped
+        changing for a few seconds and its header can be read), spectrograms are made with
+        stream_to_spectro() and the images are inferenced with a model that stays loaded.
+
+        Progress is kept in the analyst logs: a wave file is logged in the spectrogram log once
+        its images are made and inferenced (and the logs are flushed after every file), so a
+        restart skips everything that was already done. Samples left at the end of a file are
+        carried into the next file when it continues the recording. Every box also goes to the
+        detection index (common/detection_index.py), which is saved after every file as well.
+        With --prescreen images without band energy or tonal contours are skipped and recorded in the prescreen log
+        (see audio_transform/prescreen.py).
+
+Usage:  python3 dataset_prediction/watch_recordings.py <recording/directory> -o <image/directory> -p <positive/directory>
+
+        Stop with Ctrl+C, or use --idle_exit <seconds> to stop once no new file has appeared for that long.
+        --metrics <file.jsonl> / --summary record and print the time spent per stage (see common/metrics.py).
+'''
+
+import os
+import argparse
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from audio_transform.audio_to_spectro import stream_to_spectro, parse_channel, desired_channel, renderer, decimate
+from audio_transform.wav_reader import read_wav_header
+from audio_transform.prescreen import Prescreen, record_screened_out, prescreen_logs_path
+from dataset_prediction.inference_dataset import infer_batch, load_model, backend
+from common.analyst_log import open_log
+from common.detection_index import DetectionIndex, index_path
+from common import metrics
+
+###################################################################
+# CONFIGURATION DEFAULTS
+model_path = "models/fkw_whistle_classifier_2.0.pt"
+spectrogram_logs_path = 'audio_transform/analyst_logs/spectrogram_logs.csv'
+inference_logs_path = 'dataset_prediction/analyst_logs/inference_logs.csv'
+poll_interval = 5               # Seconds between directory scans
+settle_time = 10                # Seconds a file's size must stay the same before it counts as fully written
+###################################################################
+
+def is_complete(wave_file_path, last_seen, now, settle_time=settle_time):
+    '''
+    A file is complete once its size and modification time have not changed for settle_time seconds
+    and it has a readable wave header. last_seen maps path -> (size, mtime, first time that size was seen).
+    A file that is gone (renamed or deleted by the recorder since it was listed) is not complete.
+    '''
+    try:
+        stat = os.stat(wave_file_path)
+    except FileNotFoundError:
+        last_seen.pop(wave_file_path, None)
+        return False
+    size_and_time = (stat.st_size, stat.st_mtime)
+    if wave_file_path not in last_seen or last_seen[wave_file_path][:2] != size_and_time:
+        last_seen[wave_file_path] = size_and_time + (now,)
+        return False
+    if now - last_seen[wave_file_path][2] < settle_time:
+        return False
+    try:
+        return read_wav_header(wave_file_path).num_frames > 0
+    except (FileNotFoundError, ValueError):
+        return False
+
+def new_recordings(input_directory, spectrogram_log=None, poll=poll_interval, settle=settle_time, idle_exit=None):
+    '''
+    Generator of fully written wave files that are not in the spectrogram log, oldest name first.
+    Polls forever, or until no new file has been yielded for idle_exit seconds.
+    A file is only yielded once every file sorted before it has been yielded, so recordings stay in order.
+    '''
+    yielded = set()
+    last_seen = {}
+    last_new = time.monotonic()
+    while True:
+        waiting = False # True once a file is still being written, later files have to wait for it
+        for file in sorted(os.listdir(input_directory)):
+            wave_file_path = os.path.join(input_directory, file)
+            if not file.lower().endswith('.wav') or wave_file_path in yielded:
+                continue
+            if spectrogram_log is not None and wave_file_path in spectrogram_log:
+                yielded.add(wave_file_path)
+                continue
+            # Always check, so every file's settle clock keeps running while an earlier file is processed
+            if not is_complete(wave_file_path, last_seen, time.monotonic(), settle) or waiting:
+                waiting = True
+                continue
+            yielded.add(wave_file_path)
+            yield wave_file_path
+            last_new = time.monotonic()
+
+        if idle_exit is not None and not waiting and time.monotonic() - last_new > idle_exit:
+            print(f"No new recordings for {idle_exit} seconds, exiting...")
+            return
+        time.sleep(poll)
+
+def watch(model, input_directory, image_directory, positive_directory=None, channel=desired_channel, renderer=renderer,
+          spectrogram_log=None, inference_log=None, poll=poll_interval, settle=settle_time, idle_exit=None, index=None,
+          decimate=decimate, prescreen=None, prescreen_log=None):
+    '''Process new recordings as they appear, returns the number of wave files processed.'''
+    file_total = 0
+    recordings = new_recordings(input_directory, spectrogram_log, poll, settle, idle_exit)
+    for wave_file_path, image_names, error in stream_to_spectro(recordings, image_directory, channel, renderer=renderer, decimate=decimate,
+                                                                prescreen=prescreen):
+        if error is not None:
+            continue # Reported by stream_blocks(), not logged so it is tried again after a restart
+        start = time.perf_counter()
+        detection_total = 0
+        if image_names:
+            for csv_entry in infer_batch(model, image_names, positive_directory, index):
+                detection_total += csv_entry[1]
+                if inference_log is not None:
+                    inference_log.record(*csv_entry)
+
+        if prescreen is not None and prescreen_log is not None:
+            record_screened_out(prescreen_log, prescreen.take())
+        if spectrogram_log is not None:
+            spectrogram_log.record(wave_file_path)
+        for log in (inference_log, spectrogram_log, prescreen_log, index):
+            if log is not None:
+                log.flush() # Keep the logs (and the index) current so a restart resumes here
+        file_total += 1
+        print(f"Finished [{wave_file_path}]: {len(image_names)} images, {detection_total} detections "
+              f"(inference {time.perf_counter() - start:.2f} s)")
+    return file_total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_directory", help="directory the recorder writes wave files to")
+    parser.add_argument("-o", "--output", help="where spectrogram images are saved")
+    parser.add_argument("-p", "--positives", help="where images with detections are copied")
+    parser.add_argument("-ch", "--channel", type=parse_channel, default=desired_channel,
+                        help="audio channel to transform: a number, several (1,3,5) or auto / auto:1,3,5 (best band SNR)")
+    parser.add_argument("-r", "--renderer", choices=['matplotlib', 'raster'], default=renderer, help="how images are drawn, raster is much faster")
+    parser.add_argument("-d", "--decimate", action="store_true", help="downsample to the lowest rate that keeps the band before the FFT")
+    parser.add_argument("--prescreen", action="store_true", help="skip images without band energy or tonal contours")
+    parser.add_argument("-m", "--model", default=model_path, help="YOLO model to run")
+    parser.add_argument("--backend", choices=['pytorch', 'onnx'], default=backend, help="run the .pt with PyTorch or the exported .onnx with onnxruntime")
+    parser.add_argument("--poll", type=float, default=poll_interval, help="seconds between directory scans")
+    parser.add_argument("--settle", type=float, default=settle_time, help="seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--idle_exit", type=float, help="exit once no new file has appeared for this many seconds")
+    parser.add_argument("--spectrogram_log", default=spectrogram_logs_path, help="analyst log of processed wave files")
+    parser.add_argument("--inference_log", default=inference_logs_path, help="analyst log of image detections")
+    parser.add_argument("--prescreen_log", default=prescreen_logs_path, help="analyst log of the images the prescreen skipped")
+    parser.add_argument("--index", default=index_path, help="detection index the boxes are added to (see common/detection_index.py)")
+    parser.add_argument("--no_index", action="store_true", help="do not add the boxes to the detection index")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.output):
+        parser.error("Please specify output directory")
+    os.makedirs(args.output, exist_ok=True)
+    if args.positives:
+        os.makedirs(args.positives, exist_ok=True)
+
+    metrics.start('watch_recordings', args.metrics, args.summary)
+    model = load_model(args.model, args.backend) # Loaded once, stays loaded between files
+    spectrogram_log = open_log(args.spectrogram_log)
+    inference_log = open_log(args.inference_log)
+    prescreen = Prescreen() if args.prescreen else None
+    prescreen_log = open_log(args.prescreen_log) if args.prescreen else None
+    index = None if args.no_index else DetectionIndex(args.index)
+    if index is not None:
+        inference_log.flush_before(index) # Also when the inference log writes a full batch in the middle of a file
+    print(f"Watching [{args.input_directory}] (Ctrl+C to stop)")
+    try:
+        file_total = watch(model, args.input_directory, args.output, args.positives, args.channel, args.renderer,
+                           spectrogram_log, inference_log, args.poll, args.settle, args.idle_exit, index, args.decimate,
+                           prescreen, prescreen_log)
+        print(f"Processed {file_total} wave files")
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        spectrogram_log.close()
+        inference_log.close()
+        if prescreen_log is not None:
+            prescreen_log.close()
+        if index is not None:
+            index.close()
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
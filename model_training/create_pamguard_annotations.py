@@ -9,7 +9,8 @@ Spec:   This program looks at the spectrograms you have already made and assigns
 I/O:    This program expects a CSV with the following category names: 
             "","UID","UTC","freqBeg","freqEnd","freqMean","freqStdDev","duration","freqSlopeMean","freqAbsSlopeMean","freqPosSlopeMean","freqNegSlopeMean","freqSlopeRatio","freqStepUp","freqStepDown","numSweepsDwnFlat","numSweepsDwnUp","numSweepsFlatDwn","numSweepsFlatUp","numSweepsUpDwn","numSweepsUpFlat","numInflections","freqCofm","freqQuarter1","freqQuarter2","freqQuarter3","freqSpread","freqMin","freqMax","freqRange","freqMedian","freqCenter","freqRelBw","freqMaxMinRatio","freqBegEndRatio","freqNumSteps","stepDur","freqBegSweep","freqBegUp","freqBegDwn","freqEndSweep","freqEndUp","freqEndDwn","freqSweepUpPercent","freqSweepDwnPercent","freqSweepFlatPercent","inflMaxDelta","inflMinDelta","inflMaxMinDelta","inflMeanDelta","inflStdDevDelta","inflMedianDelta","inflDur","BinaryFile","eventId","detectorName","db","species"
         The aforementioned CSV should be a fairly straight forward product created
-        via exporting cruise data from R. 
+        via exporting cruise data from R. Only UTC, duration, freqMin, freqMax and species are read,
+        and the parsed columns are cached for the next run (see common/pamguard_csv.py).
 
 Note:   The last three digits is the AC number. Ex: 1705109 is LaskerAC109
 
@@ -17,49 +18,28 @@ Usage:  python3 model_training/create_pamguard_annotations.py <folder/with/spect
 '''
 
 import pandas as pd 
+import numpy as np
 import argparse
 from datetime import datetime, timedelta
 import os
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common.strip_geometry import frequency_range, top_of_spectrogram_freq, normalized_strip_height, normalized_stripe_ys
+from common.file_names import image_offset_seconds
+from common.pamguard_csv import load_pamguard_csv
+from common import metrics
+
 ###################################################################
 # CONFIGURATION DEFAULTS
-desired_species = 33 # False Killer Whale (not used currently)
+desired_species = 33 # False Killer Whale, written as class 0
 cruise_numbers = [1705, 1706] # Lasker, Sette (not used currently)
 file_and_datatime = [] # A list of spectrogram names versus their respective start time
-matched_PAM_annotations = [] # A list of annotations who's time intersect with existing spectrograms
-frequency_range = 5000 # The difference between the minimum and maximum frequencies shown in the spectrograms
-top_of_spectrogram_freq = 9000 # The frequency at the very top of the spectrogram strip 
-normalized_strip_height = 0.08394736909 # The vertical heigh of each strip (how thicc it is)
-normalized_stripe_ys = {
-    "y0": 0.00000000000000000,
-    "y1": 0.10163253864469451,
-    "y2": 0.20314887407501037,
-    "y3": 0.3059226305752359,
-    "y4": 0.4067793229338596,
-    "y5": 0.5089243688991303,
-    "y6": 0.6102942321889212,
-    "y7": 0.712957875364088,
-    "y8": 0.8144914649867669,
-    "y9": 0.9160526309037224
-
-} # Each number represents the normalized top of each strip
+matched_PAM_annotations = None # A table of annotations who's time intersect with existing spectrograms
 freq_to_norm_conversion_factor = normalized_strip_height / frequency_range # used to translate between a change in frequency to a change in norm
 time_to_norm_conversion_factor = 1 / 3 # the full screen is 1 unit and represents 3 seconds of time
 ###################################################################
 
-# Accept command line args
-parser = argparse.ArgumentParser()
-parser.add_argument("spectrogram_folder", help="this folder should contain the spectrograms you have already made.")
-parser.add_argument("csv_filepath", help="this csv file should contain vocalization localizations.")
-args = parser.parse_args()
-
-# TODO: add a function to choose output location 
-
-# Turn args into variables (style points)
-spectrogram_folder = args.spectrogram_folder 
-csv_filepath = args.csv_filepath
-
 ## HELPER FUNCTIONS 
 
 # Translate JPG file names to python datetimes 
@@ -74,9 +54,8 @@ def file_name_to_time(file_name):
     # Combine into datetime object
     dt = datetime.strptime(f"{date_part}_{time_part}", "%Y%m%d_%H%M%S")
 
-    # Check if '-0011' is in the filename and add 30 seconds if so
-    if '-0011' in file_name:
-        dt += timedelta(seconds=30)
+    # Images after the first start later in the recording, ex: '-0011' starts 30 seconds in, '-0021' 60 seconds in
+    dt += timedelta(seconds=image_offset_seconds(file_name))
 
     return dt
 
@@ -100,33 +79,14 @@ def load_original_annotations(path_to_annotations):
     '''
     This function compares times of existing spectrograms with annotation times.
     If an annotation time is within 30 seconds of a sepctrogram's time, key information
-    about the annotation is appended to the matched_PAM_annotations list. 
+    about the annotation is stored in the matched_PAM_annotations table. 
     '''
 
-    # Load CSV using pandas
-    df = pd.read_csv(path_to_annotations)
-
-    # Parse UTC column to datetime
-    df['UTC'] = pd.to_datetime(df['UTC'], format='mixed') # Potential bug here, some strings do not have the fractional element # format='%Y-%m-%d %H:%M:%S.%f'
-    # Loop through each row in the CSV
-    for _, row in df.iterrows():
-        annotation_time = row['UTC']
-
-        for fname, spectro_time in file_and_datatime:
-            time_diff = (annotation_time - spectro_time).total_seconds()
-        
-            if 0 <= time_diff <= 30:
-                    # Match found — store selected fields
-                    matched_PAM_annotations.append({
-                        'spectro_file': fname,
-                        'file_time': spectro_time,
-                        'UTC': annotation_time,
-                        'duration': row['duration'],
-                        'freqMin': row['freqMin'],
-                        'freqMax': row['freqMax'],
-                        'species': row['species']
-                    })
-                    #  break  # Found a match, no need to keep checking other spectros (removed, i want to find multiple matches)
+    # Only the used columns, UTC parsed with or without fractional seconds, cached after the first run (see common/pamguard_csv.py)
+    df = load_pamguard_csv(path_to_annotations)
+    global matched_PAM_annotations
+    with metrics.stage('match'):
+        matched_PAM_annotations = match_annotations(df, file_and_datatime)
 
     if(len(matched_PAM_annotations) == 0):
         print("None of the provided spectrograms match with the provided annotations... Exiting")
@@ -134,96 +94,160 @@ def load_original_annotations(path_to_annotations):
     
     return matched_PAM_annotations
 
-# Determine bounding box normalized x values and return strip numbers 
-def find_box_xs(spectrogram_start_time, bbox_start_time, bbox_duration): 
-    '''Find the difference between the spectrogram start time and bbox start time
-    to determine the strip that the bbox starts in. Normalize the duration to return coordinates
-    and also determine if the annotation occurs on multiple strips.
+def match_annotations(df, spectro_times, window_seconds=30):
     '''
-    left_over = 0 
+    Join annotations to spectrograms by time: an annotation matches every spectrogram that starts
+    0 to window_seconds (inclusive) before it. Every annotation can match many spectrograms and the other way around.
+    Spectrogram start times are sorted once, then a binary search finds each annotation's range of matches,
+    so the cost is O((annotations + spectrograms) log spectrograms) instead of annotations x spectrograms.
+    Returns a DataFrame with one row per match.
+    '''
+    df = df[df['UTC'].notna()]
+    spectro = pd.DataFrame(spectro_times, columns=['spectro_file', 'file_time']).sort_values('file_time', kind='stable')
+    starts = spectro['file_time'].to_numpy(dtype='datetime64[ns]')
+    annotation_times = df['UTC'].to_numpy(dtype='datetime64[ns]')
+
+    # Spectrograms starting in [annotation - window, annotation] are spectro[first:last]
+    first = np.searchsorted(starts, annotation_times - np.timedelta64(window_seconds, 's'), side='left')
+    last = np.searchsorted(starts, annotation_times, side='right')
+    counts = last - first
+
+    annotation_index = np.repeat(np.arange(len(df)), counts)
+    spectro_index = np.repeat(first, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
 
-    time_diff = (bbox_start_time - spectrogram_start_time).total_seconds()
+    matches = spectro.iloc[spectro_index].reset_index(drop=True)
+    annotations = df.iloc[annotation_index].reset_index(drop=True)
+    for column in ['UTC', 'duration', 'freqMin', 'freqMax', 'species']:
+        matches[column] = annotations[column]
+    return matches
 
+# Determine bounding box normalized x values and return strip numbers 
+def find_box_xs(time_diff, bbox_duration): 
+    '''Receive arrays of the seconds between the spectrogram start time and bbox start time
+    to determine the strip that each bbox starts in. Normalize the durations to return coordinates
+    and also determine if the annotation occurs on multiple strips (left_over > 0).
+    '''
     # Each strip is 3 seconds, find the remainder (modulo) then convert to normalized coordinates
     norm_start = ((time_diff % 3) - 1)* time_to_norm_conversion_factor # TODO: -1 IS ADDED BECAUSE I'M VISUALLY SEEING ANNOTATIONS ARE OFF TO THE RIGHT ON THE ACTUAL LOCATIONS
     # Normalize the duration then add to the normalized start time
     norm_stop = norm_start + (bbox_duration * time_to_norm_conversion_factor) 
-    if norm_stop > 1: # In the case the the bbox extends beyond one strip
-        left_over = norm_stop - 1 # How much of the bounding box continues onto the next row (normalized)
-        norm_stop = 1
+    # In the case the the bbox extends beyond one strip
+    left_over = np.maximum(norm_stop - 1, 0) # How much of the bounding box continues onto the next row (normalized)
+    norm_stop = np.minimum(norm_stop, 1)
 
     # Determine what row the annotations lives in
-    row_number = int(time_diff // 3) # 3 seconds per strip (0 - 9)
+    row_number = (time_diff // 3).astype(int) # 3 seconds per strip (0 - 9)
     
     return row_number, norm_start, norm_stop, left_over
 
 # Determine bounding box normalized y values
 def find_box_ys(freqHigh, freqLow, strip_number): 
-    '''Receive a strip number (from another function) then use the frequency
+    '''Receive arrays of strip numbers (from another function) then use the frequency
     min and max to find the normalized min and max. Note: y=0.0 is the TOP of the image.
     y0 (the first strip) starts at 0.0 and grows down! Frequency is translate as the difference between 
     the 9k (the top of the strip) and target value.'''
     # Check for valid strip number (between 1 and 10)
-    if not 0<=strip_number <= 9: 
+    if not np.all((0 <= strip_number) & (strip_number <= 9)): 
         print("Invalid strip number! There are 10 strips number from 0 to 9... Existing")
         sys.exit(1) 
     
-    norm_high = ((top_of_spectrogram_freq - freqHigh) * freq_to_norm_conversion_factor) + list(normalized_stripe_ys.values())[strip_number]
-    norm_low = ((top_of_spectrogram_freq - freqLow) * freq_to_norm_conversion_factor) + list(normalized_stripe_ys.values())[strip_number]
+    strip_tops = np.array(list(normalized_stripe_ys.values()))[strip_number]
+    norm_high = ((top_of_spectrogram_freq - freqHigh) * freq_to_norm_conversion_factor) + strip_tops
+    norm_low = ((top_of_spectrogram_freq - freqLow) * freq_to_norm_conversion_factor) + strip_tops
 
     return norm_high, norm_low
-    
-def export_annotations(matched_PAM_annotations): 
+
+def annotation_boxes(matches):
+    '''
+    Compute the YOLO box (x y width height format) of every matched annotation in one pass.
+    A box that runs past the end of its strip is cut at the strip edge and the rest (left_over)
+    becomes a second box at the start of the next strip (unless it was already the last strip).
+    Returns a DataFrame with spectro_file, class_index, x, y, width, height columns.
     '''
-    Turn each annotation into a text file in YOLO OBB format. 
+    time_diff = (matches['UTC'] - matches['file_time']).dt.total_seconds().to_numpy()
+    duration = matches['duration'].to_numpy(dtype=float)
+    freq_high = matches['freqMax'].to_numpy(dtype=float)
+    freq_low = matches['freqMin'].to_numpy(dtype=float)
+
+    row_number, norm_start, norm_stop, left_over = find_box_xs(time_diff, duration)
+
+    # Boxes that spill onto the next strip
+    spills = (left_over > 0) & (row_number < 9)
+    row_number = np.concatenate([row_number, row_number[spills] + 1])
+    norm_start = np.concatenate([norm_start, np.zeros(spills.sum())])
+    norm_stop = np.concatenate([norm_stop, np.minimum(left_over[spills], 1)])
+    freq_high = np.concatenate([freq_high, freq_high[spills]])
+    freq_low = np.concatenate([freq_low, freq_low[spills]])
+    order = np.concatenate([np.arange(len(matches)), np.flatnonzero(spills)]) # Which annotation each box came from
+
+    norm_high, norm_low = find_box_ys(freq_high, freq_low, row_number)
+
+    # Using the x1,y1 x2,y2 x3,y3 x 4,y4 format
+    # line = f"{class_index} {norm_start} {norm_high} {norm_stop} {norm_high} {norm_start} {norm_low} {norm_stop} {norm_low}\n"
+
+    # Using the x y width height format 
+    width = norm_stop - norm_start
+    height = norm_low - norm_high # y=0 is the TOP of the figure 
+    species = matches['species'].to_numpy()[order]
+
+    boxes = pd.DataFrame({
+        'spectro_file': matches['spectro_file'].to_numpy()[order],
+        'class_index': np.where(species == desired_species, '0', species.astype(str)),
+        'x': norm_start + (width/2),
+        'y': norm_high + (height/2),
+        'width': width,
+        'height': height,
+        'annotation': order,
+    })
+    # Keep each annotation's spill box right after it
+    return boxes.sort_values('annotation', kind='stable').drop(columns='annotation')
+
+def export_annotations(matched_PAM_annotations, annotations_directory='annotations'): 
     '''
-    if not os.path.exists('annotations'):
+    Turn the annotations of each spectrogram into one text file in YOLO format.
+    Each file is written once with all of its lines (existing files are replaced, so reruns do not duplicate lines).
+    '''
+    if not os.path.exists(annotations_directory):
         print("annotations directory does not exist, please create an 'annotations' directory in your project root.")
         return
-    
-    for ann in matched_PAM_annotations: # [:10] (if testing only the first ten)
+
+    boxes = annotation_boxes(matched_PAM_annotations)
+    # tolist() gives python floats, so numbers are written exactly like before
+    lines = [f"{c} {x} {y} {w} {h}\n" for c, x, y, w, h in zip(
+        boxes['class_index'].tolist(), boxes['x'].tolist(), boxes['y'].tolist(), boxes['width'].tolist(), boxes['height'].tolist())]
+
+    for spectro_file, line_numbers in pd.Series(range(len(lines))).groupby(boxes['spectro_file'].to_numpy(), sort=False):
         # Create file name based on associated .jpg file
-        base_name = os.path.splitext(ann['spectro_file'])[0]
-        text_file_name = f'annotations/{base_name}.txt'
-        try:
-            with open(text_file_name, 'a') as file:  # open in append mode
-                class_index = ann['species']
-                if class_index == 33:
-                    class_index = '0'
-
-                bbox_start_time = ann['UTC'] 
-                bbox_duration = ann['duration']
-                freq_high = ann['freqMax']
-                freq_low = ann['freqMin']
-                # FILE_NAME = ann['spectro_file'] # Stored for reference if needed
-                file_start_time = ann['file_time']
-                
-                row_number, norm_start, norm_stop, left_over = find_box_xs(file_start_time, bbox_start_time, bbox_duration)
-                norm_high, norm_low = find_box_ys(freq_high, freq_low, row_number)
-
-                # Using the x1,y1 x2,y2 x3,y3 x 4,y4 format
-                # line = f"{class_index} {norm_start} {norm_high} {norm_stop} {norm_high} {norm_start} {norm_low} {norm_stop} {norm_low}\n"
-                
-                # Using the x y width height format 
-                width = norm_stop - norm_start
-                height = norm_low - norm_high # y=0 is the TOP of the figure 
-                middle_point_x = norm_start + (width/2)
-                middle_point_y = norm_high + (height/2)
-                
-                line = f"{class_index} {middle_point_x} {middle_point_y} {width} {height}\n"
-
-                file.write(line)
-        except FileNotFoundError:
-            print("annotations directory does not exist, please create an 'annotations' directory in your project root.")
-            return
+        base_name = os.path.splitext(spectro_file)[0]
+        with open(os.path.join(annotations_directory, f'{base_name}.txt'), 'w') as file:
+            file.writelines(lines[i] for i in line_numbers)
 
     print('finished dakine')
 
 
-print("Creating YOLO OBB annotations from PAMGuard annotations. :)\n")
+def main():
+    # Accept command line args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spectrogram_folder", help="this folder should contain the spectrograms you have already made.")
+    parser.add_argument("csv_filepath", help="this csv file should contain vocalization localizations.")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # TODO: add a function to choose output location 
+
+    print("Creating YOLO OBB annotations from PAMGuard annotations. :)\n")
+
+    metrics.start('create_pamguard_annotations', args.metrics, args.summary)
+    try:
+        with metrics.stage('spectrogram_list'):
+            find_spectro_times(args.spectrogram_folder)
 
-find_spectro_times(spectrogram_folder)
+        load_original_annotations(args.csv_filepath)
 
-load_original_annotations(csv_filepath)
+        with metrics.stage('label_write'):
+            export_annotations(matched_PAM_annotations)
+    finally:
+        metrics.finish()
 
-export_annotations(matched_PAM_annotations)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
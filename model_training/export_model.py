@@ -0,0 +1,118 @@
+'''
+File:   export_model.py
+
+Spec:   Export a trained YOLO model (.pt) to ONNX for CPU inference with onnxruntime
+        (ex: on the Raspberry Pi, see --backend onnx in dataset_prediction/inference_dataset.py),
+        optionally with an int8 quantized copy:
+            --int8                          dynamic quantization (8 bit weights, no data needed)
+            --int8 --calibration <images>   static quantization, activation ranges measured on
+                                            real spectrogram images (usually more accurate and faster)
+        The models are written next to the .pt: <model>.onnx and <model>_int8.onnx.
+        Check what quantization costs with benchmarks/compare_backends.py before deploying.
+
+Note:   Needs the onnx and onnxruntime packages (pip install onnx onnxruntime).
+
+Usage:  python3 model_training/export_model.py models/fkw_whistle_classifier_2.0.pt
+        python3 model_training/export_model.py models/fkw_whistle_classifier_2.0.pt --int8 --calibration <image/directory>
+'''
+
+import os
+import argparse
+import tempfile
+import numpy as np
+import cv2
+from ultralytics import YOLO
+
+###################################################################
+# CONFIGURATION DEFAULTS
+model_path = "models/fkw_whistle_classifier_2.0.pt"
+image_size = 640                # Model input size, same as training (train_model.py)
+calibration_count = 100         # Images used to measure activation ranges for static quantization
+###################################################################
+
+def export_onnx(pt_path, imgsz=image_size):
+    '''Export to ONNX with a dynamic batch size (so batched inference works), returns the .onnx path.'''
+    return YOLO(pt_path).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+
+def letterbox(image, imgsz=image_size):
+    '''Resize keeping the aspect ratio and pad to imgsz x imgsz with gray, like YOLO's preprocessing. Returns 1x3xHxW float32 RGB in 0 - 1.'''
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    new_height, new_width = round(height * scale), round(width * scale)
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    padded = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top, left = (imgsz - new_height) // 2, (imgsz - new_width) // 2
+    padded[top:top + new_height, left:left + new_width] = resized
+    return (padded[:, :, ::-1].transpose(2, 0, 1)[None] / 255.0).astype(np.float32)
+
+def calibration_reader(onnx_path, image_directory, count=calibration_count, imgsz=image_size):
+    '''onnxruntime CalibrationDataReader feeding up to 'count' letterboxed images from a directory.'''
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader
+
+    input_name = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    image_paths = sorted(os.path.join(image_directory, f) for f in os.listdir(image_directory) if f.lower().endswith(('.jpg', '.jpeg', '.png')))[:count]
+    if not image_paths:
+        raise ValueError(f"No calibration images in [{image_directory}]")
+    print(f"Calibrating with {len(image_paths)} images from [{image_directory}]")
+
+    class ImageReader(CalibrationDataReader):
+        def __init__(self):
+            self.images = iter(image_paths)
+
+        def get_next(self):
+            for image_path in self.images:
+                image = cv2.imread(image_path)
+                if image is not None:
+                    return {input_name: letterbox(image, imgsz)}
+            return None
+
+    return ImageReader()
+
+def quantize_int8(onnx_path, calibration_directory=None, imgsz=image_size):
+    '''
+    Write an int8 copy of an ONNX model, static with calibration images or dynamic without.
+    The metadata YOLO stores in the model (class names, stride, image size) is carried over so
+    ultralytics can load the quantized model like the original. Returns the int8 model path.
+    '''
+    import onnx
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    int8_path = f"{os.path.splitext(onnx_path)[0]}_int8.onnx"
+    with tempfile.TemporaryDirectory() as temporary:
+        prepared = os.path.join(temporary, 'prepared.onnx')
+        # Shape inference and graph clean up, recommended before quantizing (symbolic shapes fail on the dynamic batch axis)
+        quant_pre_process(onnx_path, prepared, skip_symbolic_shape=True)
+        if calibration_directory:
+            quantize_static(prepared, int8_path, calibration_reader(prepared, calibration_directory, imgsz=imgsz),
+                            quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        else:
+            # onnxruntime's CPU ConvInteger only takes uint8 weights
+            quantize_dynamic(prepared, int8_path, weight_type=QuantType.QUInt8)
+
+    original = onnx.load(onnx_path)
+    quantized = onnx.load(int8_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(original.metadata_props)
+    onnx.save(quantized, int8_path)
+    return int8_path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", nargs='?', default=model_path, help="trained YOLO .pt model")
+    parser.add_argument("--imgsz", type=int, default=image_size, help="model input size (the size it was trained at)")
+    parser.add_argument("--int8", action="store_true", help="also write an int8 quantized model")
+    parser.add_argument("--calibration", help="image directory for static int8 quantization (dynamic without)")
+    args = parser.parse_args()
+
+    onnx_path = export_onnx(args.model, args.imgsz)
+    print(f"Exported [{onnx_path}] ({os.path.getsize(onnx_path) / 1024**2:.1f} MB)")
+    if args.int8:
+        int8_path = quantize_int8(onnx_path, args.calibration, args.imgsz)
+        print(f"Quantized [{int8_path}] ({os.path.getsize(int8_path) / 1024**2:.1f} MB, "
+              f"{'static' if args.calibration else 'dynamic'})")
+
+if __name__ == '__main__':
+    main()
@@ -1,129 +1,200 @@
 '''
-File:   split_od_data.py
+File:   split_dataset.py
 
 Spec:   Split object detection data according to YOLO spec. See: https://docs.ultralytics.com/datasets/detect/#ultralytics-yolo-format
-        Remember to export data from label studio (or other annotation software) in the YOLO OBB format. 
-        
-Usage:  python3 model_training/split_dataset.py <path/to/labels> <path/to/images> -o <output/directory> 
-
+        Remember to export data from label studio (or other annotation software) in the YOLO OBB format.
+
+        Each label (and its image) goes to train, val or test according to a hash of its name, so the split
+        does not depend on listing order, and labels added later are assigned to a split without moving
+        the ones that are already there (changing the ratio does move files).
+        Files are placed by a pool of threads with --mode:
+            hardlink    (default) no second copy of the data, falls back to copying across file systems
+            symlink     links to the original files, which have to stay where they are
+            copy        independent copies
+        A manifest (split_manifest.json in the output directory) records every label's split and the size
+        and modification time of its files, so a rerun only places new or changed files and removes
+        the files of labels that are gone.
+
+Usage:  python3 model_training/split_dataset.py <path/to/labels> <path/to/images> -o <output/directory>
+        python3 model_training/split_dataset.py <path/to/labels> <path/to/images> -o <output/directory> --mode copy -r 0.8 0.1 0.1
+
+        --metrics <file.jsonl> / --summary record and print the time spent per stage (see common/metrics.py).
 '''
 
-import os 
+import os
 import argparse
 import shutil
 import sys
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common import metrics
 
 ###################################################################
 # CONFIGURATION DEFAULTS
 output_directory = 'split_outputs'
 split_ratio = {"train": 0.7, "val": 0.2, "test": 0.1}
+mode = 'hardlink'                       # 'hardlink', 'symlink' or 'copy'
+workers = 8                             # Threads placing files (they mostly wait on the file system)
+manifest_name = 'split_manifest.json'
+image_extension = '.jpg'
 ###################################################################
 
-# Accept command line inputs
-parser = argparse.ArgumentParser()
-parser.add_argument("labels", help="what directory of the YOLO OBB labels stored in?")
-parser.add_argument("images", help="What image directory are labels associated with?")
-parser.add_argument("-o", "--output", help="where do you want the train, val, and test directories to appear?")
-# parser.add_argument("-r", "--ratio", help="define the split ratio") # TODO: complete this
-args = parser.parse_args() 
-
-
-# Accept label and image directories from command line args
-raw_label_dir = args.labels
-raw_image_dir = args.images
-
-# Check if label & image directories exist
-if os.path.isdir(raw_label_dir) == False:
-    print(f'{raw_label_dir} does not exist, exiting...')
-    sys.exit(1)
-if os.path.isdir(raw_image_dir) == False:
-    print(f'{raw_image_dir} does not exist, exiting...')
-    sys.exit(1)
-
-# DEBUG:
-print(f"Raw label directory: [{raw_label_dir}]")
-print(f'Raw image directory: [{raw_image_dir}]')
-
-if args.output:
-    output_directory = args.output
-
-# Check that split ratio adds to one
-if ( .99 < (split_ratio['train'] + split_ratio['val'] + split_ratio ['test']) < 1.01 ):
-    pass
-else:
-    print("Watch out!!!! your splitt ratio != 1!")
-    os._exit(1) 
-
-# Create paths to describe the dataset output folder structure
-image_train_out = os.path.join(output_directory, 'images/train')
-image_val_out = os.path.join(output_directory, 'images/val')
-image_test_out = os.path.join(output_directory, 'images/test')
-label_train_out = os.path.join(output_directory, 'labels/train')
-label_val_out = os.path.join(output_directory, 'labels/val')
-label_test_out = os.path.join(output_directory, 'labels/test')
-
-
-# Make appropriate directories for output 
-os.makedirs(output_directory, exist_ok=True)
-if os.path.exists(output_directory):
+def assign_split(name, ratio=split_ratio):
+    '''train, val or test for a label: a hash of its name is a stable position in [0, 1) compared with the cumulative ratio.'''
+    position = int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], 'big') / 2**64
+    cumulative = 0.0
+    for split, share in ratio.items():
+        cumulative += share
+        if position < cumulative:
+            return split
+    return split # Ratio adds to a hair under one
+
+def signature(path):
+    '''[size, modification time] of a file, None if it does not exist.'''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def place_file(source, destination, mode=mode):
+    '''Hard link, symlink or copy source to destination (replacing what is there), returns the mode actually used.'''
+    with metrics.stage('place'):
+        remove_file(destination)
+        if mode == 'hardlink':
+            try:
+                os.link(source, destination)
+                return mode
+            except OSError: # Another file system, or one without hard links
+                mode = 'copy'
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(source), destination)
+        else:
+            shutil.copy2(source, destination)
+    return mode
+
+def output_paths(output_directory, split, label_name, record):
+    '''Where a label and its image (if it has one) are placed in a split.'''
+    paths = [os.path.join(output_directory, 'labels', split, label_name)]
+    if record['image'] is not None:
+        paths.append(os.path.join(output_directory, 'images', split, os.path.splitext(label_name)[0] + image_extension))
+    return paths
+
+def load_manifest(path):
+    '''Label name -> record of the previous run, empty if there was none.'''
+    try:
+        with open(path) as file:
+            return json.load(file)['files']
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+def save_manifest(path, files, ratio):
+    temporary_path = f"{path}.tmp" # Written whole then renamed, an interrupted run keeps the old manifest
+    with open(temporary_path, 'w') as file:
+        json.dump({'ratio': ratio, 'files': files}, file, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+def split_dataset(raw_label_dir, raw_image_dir, output_directory=output_directory, ratio=split_ratio, mode=mode, workers=workers):
+    '''
+    Place every label and its image in output_directory/{images,labels}/{train,val,test}.
+    Returns the number of labels placed, left as they were and removed.
+    '''
+    for kind in ('images', 'labels'):
+        for split in ratio:
+            os.makedirs(os.path.join(output_directory, kind, split), exist_ok=True)
     print(f'output directory = {output_directory}')
-os.makedirs(image_train_out, exist_ok=True)
-os.makedirs(image_val_out, exist_ok=True)
-os.makedirs(image_test_out, exist_ok=True)
-os.makedirs(label_train_out, exist_ok=True)
-os.makedirs(label_val_out, exist_ok=True)
-os.makedirs(label_test_out, exist_ok=True)
-
-# Copy labels into desired directories
-num_annotations = len(os.listdir(raw_label_dir))
-print(f'Number of annotations: {num_annotations}')
-for i, item in enumerate(os.listdir(raw_label_dir)):
-    '''Sort images and labels by copying them into respective directories'''
-    # Labels 
-    label_name = item 
-    input_label_path = os.path.join(raw_label_dir, item)
-
-    # Images
-    image_name, _ = os.path.splitext(label_name)  # Remove the .txt extension
-    image_name = image_name + '.jpg'
-    input_image_path = os.path.join(raw_image_dir, image_name)
-
-    # Copy to TRAIN 
-    if( i < (num_annotations * split_ratio['train']) ):
-        # Label
-        if os.path.exists(input_label_path):  
-            shutil.copy(input_label_path, label_train_out)
-        else: 
-            print(f"Label name does not exist: {input_label_path}")
-        # Image 
-        if os.path.exists(input_image_path):
-            shutil.copy(input_image_path, image_train_out)
-        else: 
-            print(f"Image name does not exist: {input_image_path}")
-
-    # Copy to VALIDATE
-    elif( i < (num_annotations * (split_ratio['train'] + split_ratio['val']))): 
-        # Label
-        if os.path.exists(input_label_path):
-            shutil.copy(input_label_path, label_val_out)
-        else: 
-            print(f"Label name does not exist: {input_label_path}")
-        # Image 
-        if os.path.exists(input_image_path):
-            shutil.copy(input_image_path, image_val_out)
-        else: 
-            print(f"Image name does not exist: {input_image_path}")
 
-    # Copy to TEST  
-    else:
-        # Label
-        if os.path.exists(input_label_path):
-            shutil.copy(input_label_path, label_test_out)
-        else: 
-            print(f"Label name does not exist: {input_label_path}")
-        # Image 
-        if os.path.exists(input_image_path):
-            shutil.copy(input_image_path, image_test_out)
-        else: 
+    manifest_path = os.path.join(output_directory, manifest_name)
+    previous = load_manifest(manifest_path)
+    image_names = set(os.listdir(raw_image_dir))
+    label_names = sorted(entry.name for entry in os.scandir(raw_label_dir) if entry.is_file())
+    print(f'Number of annotations: {len(label_names)}')
+
+    files, tasks, unchanged = {}, [], 0
+    for label_name in label_names:
+        '''Sort images and labels into their split, only what changed since the last run'''
+        input_label_path = os.path.join(raw_label_dir, label_name)
+        image_name = os.path.splitext(label_name)[0] + image_extension  # Swap the .txt extension
+        input_image_path = os.path.join(raw_image_dir, image_name)
+        if image_name not in image_names:
             print(f"Image name does not exist: {input_image_path}")
 
+        split = assign_split(os.path.splitext(label_name)[0], ratio)
+        record = {'split': split, 'mode': mode, 'label': signature(input_label_path),
+                  'image': signature(input_image_path) if image_name in image_names else None}
+        files[label_name] = record
+        destinations = output_paths(output_directory, split, label_name, record)
+
+        old = previous.get(label_name)
+        if old == record and all(os.path.lexists(path) for path in destinations):
+            unchanged += 1
+            continue
+        if old is not None:
+            for path in output_paths(output_directory, old['split'], label_name, old):
+                remove_file(path)
+        tasks.append((input_label_path, destinations[0]))
+        if record['image'] is not None:
+            tasks.append((input_image_path, destinations[1]))
+
+    removed = [label_name for label_name in previous if label_name not in files]
+    for label_name in removed:
+        for path in output_paths(output_directory, previous[label_name]['split'], label_name, previous[label_name]):
+            remove_file(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        used = list(pool.map(lambda task: place_file(*task, mode), tasks))
+    metrics.count('files', len(tasks))
+    if mode == 'hardlink' and 'copy' in used:
+        print(f"{used.count('copy')} files were copied, they could not be hard linked (output on another file system?)")
+
+    save_manifest(manifest_path, files, ratio)
+    placed = len(files) - unchanged
+    print(f"Placed {placed} labels ({len(tasks)} files, {mode}), {unchanged} unchanged, {len(removed)} removed")
+    return placed, unchanged, len(removed)
+
+def main():
+    # Accept command line inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument("labels", help="what directory of the YOLO OBB labels stored in?")
+    parser.add_argument("images", help="What image directory are labels associated with?")
+    parser.add_argument("-o", "--output", default=output_directory, help="where do you want the train, val, and test directories to appear?")
+    parser.add_argument("-r", "--ratio", type=float, nargs=3, metavar=('TRAIN', 'VAL', 'TEST'),
+                        default=list(split_ratio.values()), help="define the split ratio")
+    parser.add_argument("--mode", choices=['hardlink', 'symlink', 'copy'], default=mode, help="how files are placed in the splits")
+    parser.add_argument("-w", "--workers", type=int, default=workers, help="number of threads placing files")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Check if label & image directories exist
+    for directory in (args.labels, args.images):
+        if os.path.isdir(directory) == False:
+            print(f'{directory} does not exist, exiting...')
+            sys.exit(1)
+
+    # DEBUG:
+    print(f"Raw label directory: [{args.labels}]")
+    print(f'Raw image directory: [{args.images}]')
+
+    # Check that split ratio adds to one
+    ratio = dict(zip(split_ratio, args.ratio))
+    if not (.99 < sum(ratio.values()) < 1.01):
+        print("Watch out!!!! your splitt ratio != 1!")
+        sys.exit(1)
+
+    metrics.start('split_dataset', args.metrics, args.summary)
+    try:
+        split_dataset(args.labels, args.images, args.output, ratio, args.mode, args.workers)
+    finally:
+        metrics.finish()
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,259 @@
 '''
-File:   train_od_model.py
+File:   train_model.py
 
 Spec:   Once data is properly formatted, train_model can be used
         to apply transfer learning to a YOLO object dection model.
 
-Usage:  python3 model_training/train_model.py <path/to/dataset.yaml> 
- 
+        Made for CPU only training machines, where most of an epoch can go to decoding and resizing
+        the large 300 dpi spectrogram JPEGs:
+            --preprocess <directory>    stores the dataset once at the training resolution (images resized,
+                                        labels are normalized so they are linked as they are) and trains on
+                                        that copy, later runs only resize images that are new or changed
+                                        (all of them when --imgsz changed) and remove the ones that are gone
+            --cache ram|disk            YOLO keeps decoded images in RAM or as .npy files next to the images
+        Every epoch prints its throughput (training images per second), how much of the training time
+        was spent waiting on the data loader and an estimate of the time left, so a run can be sized
+        from its first epochs.
+
+Usage:  python3 model_training/train_model.py <path/to/dataset.yaml>
+        python3 model_training/train_model.py <path/to/dataset.yaml> --epochs 50 -b 16 -w 8 --cache ram --patience 20 --preprocess <directory>
+        python3 model_training/train_model.py --resume runs/detect/train/weights/last.pt
+
+        --metrics <file.jsonl> / --summary record and print the time spent per stage (see common/metrics.py).
 '''
 
-from ultralytics import YOLO 
+import os
+import sys
+import time
+import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import yaml
+from ultralytics import YOLO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Make the project root importable
+from common import metrics
 
 ###################################################################
 # CONFIGURATION DEFAULTS
 number_of_classes = 1
 class_names = ['whistle']
+base_model = 'yolo11n.pt'       # Pretrained weights transfer learning starts from
+epochs = 100
+image_size = 640                # Training resolution (longest image side)
+batch_size = 16
+workers = 8                     # Data loader worker processes
+patience = 100                  # Stop after this many epochs without improvement on val
+preprocess_workers = 8          # Threads resizing images for --preprocess
+jpeg_quality = 95
 ###################################################################
 
+def image_directories(data):
+    '''(split, image directory) of every split in a dataset.yaml (a directory or a list of them each).'''
+    root = data.get('path', '')
+    for split in ('train', 'val', 'test'):
+        entries = data.get(split)
+        if not entries:
+            continue
+        for entry in ([entries] if isinstance(entries, str) else entries):
+            yield split, entry if os.path.isabs(entry) else os.path.join(root, entry)
+
+def label_directory(image_directory):
+    '''YOLO finds labels by swapping the last /images/ of an image path for /labels/.'''
+    head, _, tail = image_directory.rpartition(f'{os.sep}images')
+    return f'{head}{os.sep}labels{tail}' if head else os.path.join(os.path.dirname(image_directory), 'labels')
+
+def resize_image(source, destination, imgsz=image_size):
+    '''Resize so the longest side is imgsz (never enlarged) and write it as a JPEG.'''
+    with metrics.stage('decode'):
+        image = cv2.imread(source)
+    if image is None:
+        print(f"Could not read [{source}], skipping")
+        return
+    with metrics.stage('resize'):
+        scale = imgsz / max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(image, (round(image.shape[1] * scale), round(image.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    with metrics.stage('write'):
+        cv2.imwrite(destination, image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError: # Another file system, or one without hard links
+        shutil.copy2(source, destination)
+
+def remove_stale(directory, stems, extension):
+    '''Remove the files in directory whose name (without extension) is not in stems, returns how many.'''
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.name.endswith(extension) and os.path.splitext(entry.name)[0] not in stems:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+def preprocess_dataset(yaml_path, output_directory, imgsz=image_size, workers=preprocess_workers):
+    '''
+    Store the dataset at the training resolution in output_directory (images/<split>, labels/<split>) and
+    write a dataset.yaml for it. Images already resized from an unchanged source at the same resolution are kept
+    (the resolution is recorded in preprocess.yaml), images and labels whose source is gone are removed. Returns the new yaml path.
+    '''
+    with open(yaml_path) as file:
+        data = yaml.safe_load(file)
+    root = data.get('path') or os.path.dirname(os.path.abspath(yaml_path))
+    data['path'] = root if os.path.isabs(root) else os.path.join(os.path.dirname(os.path.abspath(yaml_path)), root)
+
+    # Images resized for another resolution (or JPEG quality) are all made again
+    stamp_path = os.path.join(output_directory, 'preprocess.yaml')
+    stamp = {'imgsz': imgsz, 'jpeg_quality': jpeg_quality}
+    previous = None
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as file:
+            previous = yaml.safe_load(file)
+    if previous != stamp and os.path.isdir(os.path.join(output_directory, 'images')):
+        print(f"[{output_directory}] was preprocessed with {previous or 'unknown settings'}, resizing every image again for {stamp}")
+    same_settings = previous == stamp
+
+    tasks, kept, removed = [], 0, 0
+    image_stems, label_stems = {}, {} # split -> names (without extension) still in the source dataset
+    for split, image_directory in image_directories(data):
+        image_out = os.path.join(output_directory, 'images', split)
+        label_out = os.path.join(output_directory, 'labels', split)
+        os.makedirs(image_out, exist_ok=True)
+        os.makedirs(label_out, exist_ok=True)
+        labels = label_directory(image_directory)
+        split_images, split_labels = image_stems.setdefault(split, set()), label_stems.setdefault(split, set())
+
+        for entry in os.scandir(image_directory):
+            if not entry.name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            split_images.add(stem)
+            destination = os.path.join(image_out, f"{stem}.jpg")
+            if same_settings and os.path.exists(destination) and os.path.getmtime(destination) >= entry.stat().st_mtime:
+                kept += 1
+            else:
+                tasks.append((entry.path, destination))
+
+            label_source, label_destination = os.path.join(labels, f"{stem}.txt"), os.path.join(label_out, f"{stem}.txt")
+            if os.path.exists(label_source):
+                split_labels.add(stem)
+                if os.path.exists(label_destination):
+                    os.remove(label_destination)
+                link_or_copy(label_source, label_destination)
+
+    # Images dropped from the dataset and labels deleted upstream (ex: an image re-labelled as a negative)
+    for split in image_stems:
+        removed += remove_stale(os.path.join(output_directory, 'images', split), image_stems[split], '.jpg')
+        removed += remove_stale(os.path.join(output_directory, 'labels', split), label_stems[split], '.txt')
+    if removed:
+        print(f"Removed {removed} preprocessed images and labels whose source is gone")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool: # OpenCV releases the GIL while decoding and resizing
+        list(pool.map(lambda task: resize_image(*task, imgsz), tasks))
+    metrics.count('images', len(tasks))
+    with open(stamp_path, 'w') as file:
+        yaml.safe_dump(stamp, file)
+    print(f"Preprocessed {len(tasks)} images to {imgsz} px in {time.perf_counter() - start:.1f} s ({kept} already done) -> [{output_directory}]")
+
+    splits = {split for split, _ in image_directories(data)}
+    preprocessed = {'path': os.path.abspath(output_directory)}
+    preprocessed.update({split: f'images/{split}' for split in ('train', 'val', 'test') if split in splits})
+    preprocessed.update({key: value for key, value in data.items() if key not in ('train', 'val', 'test', 'path', 'download')})
+    preprocessed_yaml = os.path.join(output_directory, 'dataset.yaml')
+    with open(preprocessed_yaml, 'w') as file:
+        yaml.safe_dump(preprocessed, file, sort_keys=False)
+    return preprocessed_yaml
+
+class EpochReport:
+    '''YOLO callbacks timing every epoch: training throughput, data loader wait and the time left.'''
+
+    def __init__(self):
+        self.epoch_start = None
+        self.batch_end = None
+        self.data_wait = 0.0
+        self.train_seconds = None   # Set by each training epoch, None once it has been reported
+        self.epoch_times = []
+
+    def attach(self, model):
+        for event in ('on_train_epoch_start', 'on_train_batch_start', 'on_train_batch_end', 'on_train_epoch_end', 'on_fit_epoch_end'):
+            model.add_callback(event, getattr(self, event))
+
+    def on_train_epoch_start(self, trainer):
+        self.epoch_start = self.batch_end = time.perf_counter()
+        self.data_wait = 0.0
+
+    def on_train_batch_start(self, trainer):
+        self.data_wait += time.perf_counter() - self.batch_end # Waiting for the data loader's next batch
+
+    def on_train_batch_end(self, trainer):
+        self.batch_end = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer):
+        self.train_seconds = time.perf_counter() - self.epoch_start
+        metrics.add('train_epoch', self.train_seconds)
+        metrics.add('data_wait', self.data_wait)
+
+    def on_fit_epoch_end(self, trainer):
+        '''After validation, the whole epoch is done (the final validation of best.pt also ends here, it is not an epoch).'''
+        if self.train_seconds is None:
+            return
+        epoch_seconds = time.perf_counter() - self.epoch_start
+        self.epoch_times.append(epoch_seconds)
+        images = len(trainer.train_loader.dataset)
+        metrics.count('images_trained', images)
+        remaining = (trainer.epochs - trainer.epoch - 1) * sum(self.epoch_times) / len(self.epoch_times)
+        print(f"Epoch {trainer.epoch + 1}/{trainer.epochs}: {images / self.train_seconds:.1f} images per second "
+              f"({images} images, train {self.train_seconds:.1f} s, {100 * self.data_wait / self.train_seconds:.0f}% waiting on data), "
+              f"epoch {epoch_seconds:.1f} s, about {remaining / 3600:.1f} h left (if it does not stop early)")
+        self.train_seconds = None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yamlpath", nargs='?', help="Path to the dataset.yaml file is or will be")
+    # parser.add_argument("--create-yaml", help="Do you want to create a dataset.yaml file?")
+    parser.add_argument("--model", default=base_model, help="weights to start from")
+    parser.add_argument("--epochs", type=int, default=epochs, help="number of epochs")
+    parser.add_argument("--imgsz", type=int, default=image_size, help="training resolution")
+    parser.add_argument("-b", "--batch", type=int, default=batch_size, help="batch size")
+    parser.add_argument("-w", "--workers", type=int, default=workers, help="data loader worker processes")
+    parser.add_argument("--cache", choices=['ram', 'disk'], help="keep decoded images in RAM or on disk (.npy) between epochs")
+    parser.add_argument("--patience", type=int, default=patience, help="stop after this many epochs without improvement")
+    parser.add_argument("--device", help="ex: cpu, 0 (first GPU), default picks one")
+    parser.add_argument("--preprocess", help="store the dataset at --imgsz in this directory first and train on it")
+    parser.add_argument("--resume", help="continue an interrupted run from its last.pt (ex: runs/detect/train/weights/last.pt)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.yamlpath or args.resume):
+        parser.error("Please specify a dataset.yaml (or --resume)")
 
-parser = argparse.ArgumentParser()
-parser.add_argument("yamlpath", help="Path to the dataset.yaml file is or will be")
-# parser.add_argument("--create-yaml", help="Do you want to create a dataset.yaml file?")
-args = parser.parse_args()
+    metrics.start('train_model', args.metrics, args.summary)
+    try:
+        report = EpochReport()
+        if args.resume:
+            # Every setting, the dataset included, comes from the interrupted run
+            model = YOLO(args.resume)
+            report.attach(model)
+            model.train(resume=True)
+            return
 
-yaml_path = args.yamlpath                       # In this format: </home/gpu_enjoyer/datasets/FKW_OD_Spectrograms/formatted_dataset/dataset.yaml>
+        yaml_path = args.yamlpath                       # In this format: </home/gpu_enjoyer/datasets/FKW_OD_Spectrograms/formatted_dataset/dataset.yaml>
+        if args.preprocess:
+            yaml_path = preprocess_dataset(yaml_path, args.preprocess, args.imgsz)
 
-model = YOLO('yolo11n.pt')
+        with metrics.stage('model_load'):
+            model = YOLO(args.model)
+        report.attach(model)
 
-# The dataset.yaml lives with the dataset
-results = model.train(data=yaml_path, epochs=100, imgsz=640)
+        # The dataset.yaml lives with the dataset
+        settings = {'device': args.device} if args.device else {}
+        model.train(data=yaml_path, epochs=args.epochs, imgsz=args.imgsz, batch=args.batch, workers=args.workers,
+                    cache=args.cache or False, patience=args.patience, **settings)
+    finally:
+        metrics.finish()
 
-# TODO: add number of epochs as an arg 
\ No newline at end of file
+if __name__ == '__main__':
+    main()